@@ -85,6 +85,21 @@ AUTH_PASSWORD_VALIDATORS = [
 
 CORS_ALLOWED_ORIGINS = ["http://127.0.0.1:8080",]
 
+# Подсчет количества фильмов в списке API: exact, cached или estimated
+MOVIES_API_COUNT_STRATEGY = os.environ.get('MOVIES_API_COUNT_STRATEGY', 'exact')
+# Время жизни кешированного количества
+MOVIES_API_COUNT_CACHE_TIMEOUT = int(os.environ.get('MOVIES_API_COUNT_CACHE_TIMEOUT', 60))
+
+# Кеш в таблице PostgreSQL общий для всех процессов gunicorn, поэтому сброс версии
+# кешированных количеств по сигналам видят все процессы. Таблица создается
+# командой createcachetable при запуске контейнера.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': os.environ.get('DJANGO_CACHE_TABLE', 'django_cache'),
+    },
+}
+
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
 LANGUAGE_CODE = 'ru-RU'
@@ -2,6 +2,8 @@
 
 python manage.py migrate
 
+python manage.py createcachetable
+
 echo "
 from django.contrib.auth.models import User;
 User.objects.create_superuser('admin', 'admin@admin.com', 'admin')
@@ -0,0 +1,156 @@
+import base64
+import hashlib
+import json
+from datetime import datetime
+from typing import Optional
+from uuid import UUID
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import F, Q
+from django.db.models.query import QuerySet
+from django.utils.functional import cached_property
+
+# Направления курсора
+NEXT = 'next'
+PREV = 'prev'
+
+
+# Ключ версии кешированных количеств, сбрасывается сигналами изменения фильмов
+COUNT_VERSION_CACHE_KEY = 'movies_api_count_version'
+
+
+class InvalidCursor(ValueError):
+    """Курсор не удалось разобрать."""
+
+
+def encode_cursor(row: dict, direction: str) -> str:
+    """Непрозрачный курсор на позицию (modified, id) фильма."""
+    data = {'m': row['cursor_modified'].isoformat(), 'id': str(row['id']), 'd': direction}
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, UUID, str]:
+    """Разбор курсора в позицию (modified, id) и направление."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(data, dict) or not all(isinstance(data.get(key), str) for key in ('m', 'id', 'd')):
+            raise InvalidCursor(cursor)
+        modified, pk, direction = datetime.fromisoformat(data['m']), UUID(data['id']), data['d']
+    except (ValueError, TypeError, KeyError, AttributeError) as err:
+        raise InvalidCursor(cursor) from err
+    if direction not in (NEXT, PREV):
+        raise InvalidCursor(cursor)
+    return modified, pk, direction
+
+
+def get_cursor_page_queryset(queryset: QuerySet, cursor: Optional[str], page_size: int) -> tuple[QuerySet, str]:
+    """Запрос страницы фильмов по ключу (modified, id) с одной лишней строкой для проверки продолжения.
+
+    :param queryset: Queryset значений фильмов, содержащих id.
+    :param cursor: Курсор из next или prev предыдущего ответа, пустой для первой страницы.
+    :param page_size: Количество фильмов на странице.
+    :return: Кортеж из запроса страницы и направления курсора.
+    :raises InvalidCursor: Курсор не удалось разобрать.
+    """
+    queryset = queryset.annotate(cursor_modified=F('modified'))
+    direction = NEXT
+    if cursor:
+        modified, pk, direction = decode_cursor(cursor)
+        if direction == NEXT:
+            queryset = queryset.filter(modified__gte=modified).filter(Q(modified__gt=modified) | Q(id__gt=pk))
+        else:
+            queryset = queryset.filter(modified__lte=modified).filter(Q(modified__lt=modified) | Q(id__lt=pk))
+
+    if direction == NEXT:
+        return queryset.order_by('modified', 'id')[:page_size + 1], direction
+    return queryset.order_by('-modified', '-id')[:page_size + 1], direction
+
+
+def paginate_by_cursor(queryset: QuerySet, cursor: Optional[str], page_size: int) -> dict:
+    """Страница фильмов по ключу (modified, id).
+
+    Страница выбирается диапазоном по индексу film_work (modified, id) без OFFSET,
+    поэтому время ответа не зависит от глубины страницы.
+
+    :param queryset: Queryset значений фильмов, содержащих id.
+    :param cursor: Курсор из next или prev предыдущего ответа, пустой для первой страницы.
+    :param page_size: Количество фильмов на странице.
+    :return: Словарь со ссылками prev, next и списком фильмов result.
+    :raises InvalidCursor: Курсор не удалось разобрать.
+    """
+    page_queryset, direction = get_cursor_page_queryset(queryset, cursor, page_size)
+    rows = list(page_queryset)
+    has_more = len(rows) > page_size
+
+    if direction == NEXT:
+        rows = rows[:page_size]
+        prev_cursor = encode_cursor(rows[0], PREV) if cursor and rows else None
+        next_cursor = encode_cursor(rows[-1], NEXT) if has_more else None
+    else:
+        rows = rows[:page_size][::-1]
+        prev_cursor = encode_cursor(rows[0], PREV) if has_more else None
+        next_cursor = encode_cursor(rows[-1], NEXT) if rows else None
+
+    for row in rows:
+        del row['cursor_modified']
+
+    return {
+        'prev': prev_cursor,
+        'next': next_cursor,
+        'result': rows,
+    }
+
+
+def invalidate_count_cache() -> None:
+    """Сброс кешированных количеств фильмов сменой версии ключей."""
+    try:
+        cache.incr(COUNT_VERSION_CACHE_KEY)
+    except ValueError:
+        cache.set(COUNT_VERSION_CACHE_KEY, 1, None)
+
+
+class CountStrategyPaginator(Paginator):
+    """Пагинатор с выбором способа подсчета количества фильмов.
+
+    Способ задается MOVIES_API_COUNT_STRATEGY:
+    exact - COUNT(*) на каждый запрос;
+    cached - COUNT(*), закешированный до изменения или удаления фильма;
+    estimated - оценка количества строк из статистики планировщика для списка без фильтров,
+    для списка с фильтрами - как cached.
+    """
+
+    @cached_property
+    def count(self) -> int:
+        strategy = settings.MOVIES_API_COUNT_STRATEGY
+        if strategy == 'estimated' and not self.object_list.query.where:
+            estimated = self.get_estimated_count()
+            if estimated is not None:
+                return estimated
+            strategy = 'cached'
+        if strategy in ('cached', 'estimated'):
+            return self.get_cached_count()
+        return super().count
+
+    def get_cached_count(self) -> int:
+        version = cache.get(COUNT_VERSION_CACHE_KEY, 0)
+        query_hash = hashlib.md5(str(self.object_list.query).encode()).hexdigest()
+        return cache.get_or_set(
+            f'movies_api_count:{version}:{query_hash}',
+            lambda: Paginator.count.func(self),
+            settings.MOVIES_API_COUNT_CACHE_TIMEOUT,
+        )
+
+    def get_estimated_count(self) -> Optional[int]:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'select reltuples::bigint from pg_class where oid = %s::regclass',
+                (self.object_list.model._meta.db_table.replace('"."', '.'),),
+            )
+            row = cursor.fetchone()
+        # Таблица еще не анализировалась
+        if not row or row[0] <= 0:
+            return None
+        return row[0]
@@ -0,0 +1,28 @@
+from typing import Any
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, JsonResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+class FastJsonResponse(HttpResponse):
+    """JSON ответ, сериализуемый orjson.
+
+    UUID, datetime и date orjson кодирует сам, остальные типы, например
+    ленивые строки переводов, обрабатывает DjangoJSONEncoder.
+    """
+
+    def __init__(self, data: Any, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=orjson.dumps(data, default=DjangoJSONEncoder().default), **kwargs)
+
+
+def json_response(data: Any, **kwargs) -> HttpResponse:
+    """JSON ответ на orjson, если он установлен, иначе стандартный JsonResponse."""
+    if orjson is None:
+        return JsonResponse(data, **kwargs)
+    return FastJsonResponse(data, **kwargs)
@@ -1,13 +1,14 @@
 from django.http import HttpResponse
 from django.core.handlers.wsgi import WSGIRequest
 from django.db.models.query import QuerySet
-from django.contrib.postgres.aggregates import ArrayAgg
-from django.db.models import Q
-from django.http import JsonResponse
+from django.contrib.postgres.expressions import ArraySubquery
+from django.db.models import OuterRef
 from django.views.generic import DetailView
 from django.views.generic.list import BaseListView
 
-from movies.models import Filmwork
+from movies.api.v1.pagination import CountStrategyPaginator, InvalidCursor, paginate_by_cursor
+from movies.api.v1.responses import json_response
+from movies.models import Filmwork, GenreFilmwork, PersonFilmwork
 from movies.enums import RoleInFilm
 
 
@@ -16,9 +17,10 @@ class MoviesApiMixin:
     http_method_names = ['get']
 
     def get_queryset(self) -> QuerySet:
+        # Каждый массив собирается своим коррелированным подзапросом, поэтому
+        # PostgreSQL не перемножает жанры на участников фильма и не группирует строки
         queryset = (
             self.model.objects.all()
-            .prefetch_related('genres', 'persons')
             .values(
                 'id',
                 'title',
@@ -28,55 +30,70 @@ class MoviesApiMixin:
                 'type',
             )
             .annotate(
-                genres=ArrayAgg(
-                    "genres__name",
-                    distinct=True,
-                )
-            )
-            .annotate(
-                actors=ArrayAgg(
-                    'personfilmwork__person__full_name',
-                    filter=Q(personfilmwork__role=RoleInFilm.actor),
-                    distinct=True,
-                )
-            )
-            .annotate(
-                directors=ArrayAgg(
-                    'personfilmwork__person__full_name',
-                    filter=Q(personfilmwork__role=RoleInFilm.director),
-                    distinct=True,
-                )
-            )
-            .annotate(
-                writers=ArrayAgg(
-                    'personfilmwork__person__full_name',
-                    filter=Q(personfilmwork__role=RoleInFilm.writer),
-                    distinct=True,
-                )
+                genres=ArraySubquery(
+                    GenreFilmwork.objects
+                    .filter(film_work=OuterRef('pk'))
+                    .order_by('genre__name')
+                    .values('genre__name')
+                    .distinct()
+                ),
+                actors=self.get_persons_subquery(RoleInFilm.actor),
+                directors=self.get_persons_subquery(RoleInFilm.director),
+                writers=self.get_persons_subquery(RoleInFilm.writer),
             )
         )
         return queryset
 
+    @staticmethod
+    def get_persons_subquery(role: RoleInFilm) -> ArraySubquery:
+        return ArraySubquery(
+            PersonFilmwork.objects
+            .filter(film_work=OuterRef('pk'), role=role)
+            .order_by('person__full_name')
+            .values('person__full_name')
+            .distinct()
+        )
+
     def render_to_response(self, context, **response_kwargs):
-        return JsonResponse(context)
+        return json_response(context)
 
 
 class MoviesListApi(MoviesApiMixin, BaseListView):
     # Кол-во объектов на одной странице при пагинации
     paginate_by = 50
+    # Способ подсчета count и total_pages задается MOVIES_API_COUNT_STRATEGY
+    paginator_class = CountStrategyPaginator
+
+    def get(self, request, *args, **kwargs):
+        # Пагинация курсором включается параметром cursor, пустой cursor - первая страница
+        if 'cursor' in request.GET:
+            try:
+                context = paginate_by_cursor(
+                    self.get_queryset(),
+                    request.GET['cursor'],
+                    self.paginate_by,
+                )
+            except InvalidCursor:
+                return json_response({'error': 'Invalid cursor'}, status=400)
+            return self.render_to_response(context)
+        return super().get(request, *args, **kwargs)
 
     def get_context_data(self, *, object_list=None, **kwargs):
-        queryset = self.get_queryset()
-        paginator, page, queryset, is_paginated = self.paginate_queryset(
-            queryset,
+        # Страница выбирается по одним id фильмов: подзапросы массивов в списке полей
+        # PostgreSQL вычисляет и для строк, пропущенных OFFSET, поэтому они выполняются
+        # отдельным запросом только для фильмов страницы
+        paginator, page, page_ids, is_paginated = self.paginate_queryset(
+            self.model.objects.order_by('modified', 'id').values_list('id', flat=True),
             self.paginate_by
         )
+        page_ids = list(page_ids)
+        films = {film['id']: film for film in self.get_queryset().filter(id__in=page_ids)}
         return {
             'count': paginator.count,
             'total_pages': paginator.num_pages,
             'prev': page.number - 1 if page.number > 1 else None,
             'next': page.number + 1 if page.number < paginator.num_pages else None,
-            'result': list(queryset)
+            'result': list(films[film_id] for film_id in page_ids if film_id in films)
         }
 
 
@@ -9,3 +9,7 @@ class MoviesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'movies'
     verbose_name = _('movies')
+
+    def ready(self):
+        """Connect signal handlers."""
+        from movies import signals  # noqa: F401
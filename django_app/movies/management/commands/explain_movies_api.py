@@ -0,0 +1,56 @@
+"""Print EXPLAIN ANALYZE plans of the movies API queries."""
+import re
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+from movies.api.v1.pagination import get_cursor_page_queryset, paginate_by_cursor
+from movies.api.v1.views import MoviesListApi
+from movies.models import Filmwork
+
+# Индексы связующих таблиц, по которым подзапросы массивов выбирают строки одного фильма
+FILM_WORK_ID_INDEXES = (
+    'genre_film_work_film_work_id',
+    'person_film_work_film_work_id',
+)
+
+
+class Command(BaseCommand):
+    """Explain the list page, the cursor page and the detail query of the movies API."""
+
+    help = 'Print EXPLAIN ANALYZE plans of the movies API queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page', type=int, default=1, help='Page number of the list query')
+
+    def handle(self, *args, **options):
+        request = RequestFactory().get('/api/v1/movies/')
+        list_view = MoviesListApi()
+        list_view.setup(request)
+        queryset = list_view.get_queryset()
+        page_size = list_view.paginate_by
+
+        offset = (options['page'] - 1) * page_size
+        # Список выбирается в два запроса, как в MoviesListApi.get_context_data
+        page_ids_queryset = Filmwork.objects.order_by('modified', 'id').values_list('id', flat=True)
+        page_ids_queryset = page_ids_queryset[offset:offset + page_size]
+        self.explain(f'List page {options["page"]} ids', page_ids_queryset, check_indexes=False)
+        self.explain(f'List page {options["page"]}', queryset.filter(id__in=list(page_ids_queryset)))
+
+        first_page = paginate_by_cursor(queryset, None, page_size)
+        self.explain('Cursor first page', get_cursor_page_queryset(queryset, None, page_size)[0])
+        if first_page['next']:
+            self.explain('Cursor next page', get_cursor_page_queryset(queryset, first_page['next'], page_size)[0])
+
+        film = queryset.order_by('modified', 'id').values_list('id', flat=True).first()
+        if film is not None:
+            self.explain('Detail', queryset.filter(pk=film))
+
+    def explain(self, title, queryset, check_indexes=True):
+        plan = queryset.explain(analyze=True, buffers=True)
+        self.stdout.write(self.style.MIGRATE_HEADING(f'== {title}'))
+        self.stdout.write(plan)
+        for index in FILM_WORK_ID_INDEXES if check_indexes else ():
+            used = re.search(rf'(Index (Only )?Scan using|Bitmap Index Scan on) {index}', plan) is not None
+            self.stdout.write(f'-- {index}: {"used" if used else "NOT USED"}')
+        self.stdout.write('')
@@ -0,0 +1,86 @@
+"""Generate a synthetic movies catalog for query plans and benchmarks."""
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+
+class Command(BaseCommand):
+    """Fill content tables with generated films, persons and genres."""
+
+    help = 'Generate a synthetic movies catalog (requires a superuser to skip ETL notify triggers)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--films', type=int, default=100_000)
+        parser.add_argument('--persons', type=int, default=50_000)
+        parser.add_argument('--genres', type=int, default=30)
+        parser.add_argument('--genres-per-film', type=int, default=3)
+        parser.add_argument('--persons-per-film', type=int, default=15)
+
+    def handle(self, *args, **options):
+        params = {
+            'films': options['films'],
+            'persons': options['persons'],
+            'genres': options['genres'],
+            'genres_per_film': min(options['genres_per_film'], options['genres']),
+            'persons_per_film': min(options['persons_per_film'], options['persons']),
+        }
+        with transaction.atomic(), connection.cursor() as cursor:
+            # Уведомления ETL по каждой сгенерированной строке не нужны
+            cursor.execute('set local session_replication_role = replica')
+            cursor.execute(
+                """
+                create temp table generated_genre on commit drop as
+                select n, gen_random_uuid() as id from generate_series(1, %(genres)s) as n;
+
+                create temp table generated_person on commit drop as
+                select n, gen_random_uuid() as id from generate_series(1, %(persons)s) as n;
+
+                create temp table generated_film on commit drop as
+                select n, gen_random_uuid() as id, now() - n * interval '1 minute' as modified
+                from generate_series(1, %(films)s) as n;
+
+                insert into content.genre (id, name, description, created, modified)
+                select id, 'Generated genre ' || id, '', now(), now() from generated_genre;
+
+                insert into content.person (id, full_name, created, modified)
+                select id, 'Generated person ' || n, now(), now() from generated_person;
+
+                insert into content.film_work
+                    (id, title, description, creation_date, rating, type, created, modified)
+                select
+                    id,
+                    'Generated film ' || id,
+                    'Generated description ' || n,
+                    current_date - (n %% 20000),
+                    round((n %% 100)::numeric / 10, 1),
+                    (case when n %% 10 = 0 then 'tv_show' else 'movie' end)::type_enum,
+                    modified,
+                    modified
+                from generated_film;
+
+                insert into content.genre_film_work (id, genre_id, film_work_id, created)
+                select gen_random_uuid(), genre.id, film.id, now()
+                from generated_film as film
+                cross join generate_series(0, %(genres_per_film)s - 1) as slot
+                join generated_genre as genre on genre.n = (film.n + slot) %% %(genres)s + 1;
+
+                insert into content.person_film_work (id, person_id, film_work_id, role, created)
+                select
+                    gen_random_uuid(),
+                    person.id,
+                    film.id,
+                    (case when slot = 0 then 'director' when slot < 3 then 'writer' else 'actor' end)::role_enum,
+                    now()
+                from generated_film as film
+                cross join generate_series(0, %(persons_per_film)s - 1) as slot
+                join generated_person as person
+                    on person.n = (film.n * %(persons_per_film)s + slot) %% %(persons)s + 1;
+                """,
+                params,
+            )
+        with connection.cursor() as cursor:
+            for table in ('genre', 'person', 'film_work', 'genre_film_work', 'person_film_work'):
+                cursor.execute(f'analyze content.{table}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated {params["films"]} films, {params["persons"]} persons, {params["genres"]} genres'
+        ))
@@ -0,0 +1,66 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    initial = False
+
+    dependencies = [
+        ('movies', '0003_add_enum_and_role_type'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+            create or replace function content.notify_etl_change() returns trigger as $$
+            declare
+                changed_row record;
+            begin
+                if tg_op = 'DELETE' then
+                    changed_row := old;
+                else
+                    changed_row := new;
+                end if;
+
+                -- tg_argv[0] - поле с UUID, который нужен ETL: id записи или film_work_id для связей
+                perform pg_notify(
+                    'etl_changes',
+                    json_build_object(
+                        'table', tg_table_name,
+                        'id', to_jsonb(changed_row) ->> tg_argv[0]
+                    )::text
+                );
+                return null;
+            end;
+            $$ language plpgsql;
+
+            create trigger film_work_notify_etl
+                after insert or update or delete on content.film_work
+                for each row execute function content.notify_etl_change('id');
+
+            create trigger person_notify_etl
+                after insert or update or delete on content.person
+                for each row execute function content.notify_etl_change('id');
+
+            create trigger genre_notify_etl
+                after insert or update or delete on content.genre
+                for each row execute function content.notify_etl_change('id');
+
+            create trigger person_film_work_notify_etl
+                after insert or update or delete on content.person_film_work
+                for each row execute function content.notify_etl_change('film_work_id');
+
+            create trigger genre_film_work_notify_etl
+                after insert or update or delete on content.genre_film_work
+                for each row execute function content.notify_etl_change('film_work_id');
+            """,
+            reverse_sql="""
+            drop trigger if exists film_work_notify_etl on content.film_work;
+            drop trigger if exists person_notify_etl on content.person;
+            drop trigger if exists genre_notify_etl on content.genre;
+            drop trigger if exists person_film_work_notify_etl on content.person_film_work;
+            drop trigger if exists genre_film_work_notify_etl on content.genre_film_work;
+            drop function if exists content.notify_etl_change();
+            """,
+        )
+    ]
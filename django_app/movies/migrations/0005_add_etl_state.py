@@ -0,0 +1,26 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    initial = False
+
+    dependencies = [
+        ('movies', '0004_add_etl_notify_triggers'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+            -- Состояние ETL по шардам, см. etl_app/coordination.py
+            create table if not exists content.etl_state (
+                shard text primary key,
+                state jsonb not null,
+                modified timestamp with time zone not null default now()
+            );
+            """,
+            reverse_sql="""
+            drop table if exists content.etl_state;
+            """,
+        )
+    ]
@@ -120,6 +120,10 @@ class Filmwork(UUIDMixin, TimeStampedMixin):
         db_table = "content\".\"film_work"
         verbose_name = _('film_work')
         verbose_name_plural = _('film_works')
+        indexes = [
+            # Ключ пагинации курсором в API и выборки измененных фильмов в ETL
+            models.Index(fields=['modified', 'id'], name='film_work_modified_id_idx'),
+        ]
 
     def __str__(self):
         return self.title
@@ -0,0 +1,13 @@
+"""Movies signals."""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from movies.api.v1.pagination import invalidate_count_cache
+from movies.models import Filmwork
+
+
+@receiver(post_save, sender=Filmwork)
+@receiver(post_delete, sender=Filmwork)
+def invalidate_movies_count(sender, **kwargs):
+    """Reset cached movie counts of the list API."""
+    invalidate_count_cache()
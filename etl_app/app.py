@@ -1,239 +1,387 @@
-from itertools import groupby
 from time import sleep
-from typing import List, Any
+from typing import Any, Callable, Iterable, List, Optional, Union
 
 from etl_app.config import settings
+from etl_app.coordination import SHARDS, SHARD_STATE_KEYS, ShardLeases
 from etl_app.logger import logger
+from etl_app.pipeline import Pipeline
 from etl_app.utils import (
+    BatchCheckpoints,
+    IdleBackoff,
     JsonFileStorage,
+    NotifiedFilmworks,
+    PostgresStorage,
     State,
+    get_state_lag,
 )
+from etl_app.extract.postgres import PostgresDB
 from etl_app.extract.utils import (
     get_movies_database,
     get_filmworks,
     get_filmworks_by_changed_persons,
     get_filmworks_by_changed_genre,
+    get_filmworks_additional_data,
+    get_filmworks_persons_data,
+    get_filmworks_genres_data,
+    get_filmworks_uuid_from_notifies,
+    ETL_NOTIFY_CHANNEL,
 )
-from etl_app.transfrom.transform_dataclasses import Movie
+from etl_app.transfrom.transform_dataclasses import Movie, MovieUpdate
+from etl_app.load.documents import encode_bulk_chunks
+from etl_app.load.elastic import log_elastic_stats
+from etl_app.load.hashes import get_content_hash_store, is_content_hash_enabled
 from etl_app.load.utils import (
+    IndexNotFoundError,
+    alias_indexes,
     create_index_movie,
-    get_prepared_data,
     insert_data_to_elastic,
 )
 
+# Ключи состояния ETL: ключ (modified, id) последней записи по таблицам
+# и незавершенные выборки фильмов по измененным персонам и жанрам
+STATE_KEYS = (
+    'state_filmwork_modified',
+    'state_filmwork_id',
+    'state_person_modified',
+    'state_person_id',
+    'state_genre_modified',
+    'state_genre_id',
+    'state_person_fanout',
+    'state_genre_fanout',
+)
+
+# Соответствие колонок облегченных запросов полям документа для частичного обновления
+PARTIAL_UPDATE_FIELDS = {
+    'genres': 'genre',
+    'directors': 'director',
+    'actors_names': 'actors_names',
+    'writers_names': 'writers_names',
+    'actors': 'actors',
+    'writers': 'writers',
+}
+
+
+def get_etl_state(movies_db: PostgresDB, leases: Optional[ShardLeases] = None) -> State:
+    """Получение хранилища состояния ETL, состояние читается один раз.
+
+    :param movies_db: Объект пула подключений к БД.
+    :param leases: Шарды текущего процесса, если задано, состояние хранится в БД по шардам.
+    :return: Хранилище состояния ETL.
+    """
+    if leases is not None:
+        storage = PostgresStorage(movies_db, shard_keys=SHARD_STATE_KEYS, owned_shards=leases.owned)
+    else:
+        storage = JsonFileStorage(
+            settings.ETL_STATE_FILENAME,
+            checkpoint_log_path=settings.ETL_STATE_CHECKPOINT_LOG or None,
+        )
+    return State(storage, save_interval_sec=settings.ETL_STATE_SAVE_INTERVAL_SEC)
+
 
-def load_state(etl_state_filename: str) -> dict:
+def load_state(state: State) -> dict:
     """Загрузка состояния.
 
-    :param etl_state_filename: Имя файла для загрузки состояния.
+    :param state: Хранилище состояния ETL.
     :return: Возвращает словарь состояний.
     """
     logger.info(f' -> Этап получение состояния')
-    storage = JsonFileStorage(etl_state_filename)
-    state = State(storage)
-
-    state_filmwork_modified = state.get_state('state_filmwork_modified')
-    logger.info(f' - state_filmwork_modified: {state_filmwork_modified}')
 
-    state_person_modified = state.get_state('state_person_modified')
-    logger.info(f' - state_person_modified: {state_person_modified}')
-
-    state_genre_modified = state.get_state('state_genre_modified')
-    logger.info(f' - state_genre_modified: {state_genre_modified}')
+    result = dict()
+    for state_key in STATE_KEYS:
+        value = state.get_state(state_key)
+        result[state_key] = value
+        logger.info(f' - {state_key}: {bool(value) if isinstance(value, dict) else value}')
 
     logger.info(f' <- Этап получение состояния')
-
-    result = {
-        'state_filmwork_modified': state_filmwork_modified,
-        'state_person_modified': state_person_modified,
-        'state_genre_modified': state_genre_modified,
-    }
     return result
 
 
-def extract(state: dict, extract_batch: int = 100) -> tuple[list[Any], dict]:
+def extract(
+        movies_db: PostgresDB,
+        state: dict,
+        extract_batch: int = 100,
+        fanout_batch: int = 1000,
+        notified_filmworks_uuid: Iterable[str] = (),
+        shards: Iterable[str] = SHARDS,
+) -> tuple[list[Any], dict, bool, list[tuple[Optional[str], dict]]]:
     """Загрузка данных.
 
+    Источники изменений (фильмы, персоны, жанры) собирают только UUID фильмов
+    в общее множество, поэтому данные по каждому фильму запрашиваются один раз за итерацию,
+    даже если фильм затронут сразу несколькими источниками.
+
+    :param movies_db: Объект пула подключений к БД, живет всё время работы ETL.
     :param state: Словарь состояний для таблиц из которых извлекаем данные.
     :param extract_batch: Сколько записей собирать при изменении состояния по таблицам.
-    :return: Возвращает кортеж из списка с данными из БД и словарь состояний.
-             Данных в списке может быть более 100 строк т.к. изменение 1 жанра, может
-             повлечь изменения более 100 фильмов, данным моментом по задаче пренебрегаем.
+    :param fanout_batch: Сколько фильмов собирать за раз по измененным персонам и жанрам.
+    :param notified_filmworks_uuid: UUID фильмов из уведомлений LISTEN/NOTIFY.
+    :param shards: Источники изменений, которые обрабатывает текущий процесс, см. etl_app.coordination.
+                   Фильмы из уведомлений обрабатывает процесс с шардом filmwork.
+    :return: Возвращает кортеж из списка с данными из БД, словарь состояний, признак
+             наличия необработанных изменений (хотя бы одна таблица вернула полный батч
+             или выборка фильмов по персонам и жанрам не завершена) и контрольные точки
+             источников изменений по порядку, см. BatchCheckpoints.
     """
     logger.info(f' -> Этап извлечения данных')
 
-    # Получения объекта базы данных movies
-    movies_db = get_movies_database()
-
-    # Создание списка хранения извлеченных данных
-    extracted_data = list()
-
-    logger.info(f' - Кейс изменение записей в таблице film_work')
-    filmwork_data, state_filmwork_modified = get_filmworks(
-        movies_db,
-        state_filmwork_modified=state.get('state_filmwork_modified'),
-        batch=extract_batch
-    )
-    extracted_data += filmwork_data
-
-    logger.info(f' - Кейс изменение записей в таблице person')
-    person_data, state_person_modified = get_filmworks_by_changed_persons(
-        movies_db,
-        state_person_modified=state.get('state_person_modified'),
-        batch=extract_batch
+    # Множество UUID фильмов, которые затронуты изменениями
+    filmworks_uuid = set()
+    # Сколько UUID фильмов вернули источники изменений с учетом повторов
+    filmworks_uuid_total = 0
+
+    shards = set(shards)
+    filmwork_checkpoints, filmwork_has_more = list(), False
+    person_checkpoints, person_has_more = list(), False
+    genre_checkpoints, genre_has_more = list(), False
+
+    if 'filmwork' in shards:
+        logger.info(f' - Кейс изменение записей в таблице film_work')
+        filmwork_checkpoints, filmwork_has_more = get_filmworks(
+            movies_db,
+            state_filmwork_modified=state.get('state_filmwork_modified'),
+            state_filmwork_id=state.get('state_filmwork_id'),
+            batch=extract_batch
+        )
+    else:
+        notified_filmworks_uuid = ()
+    filmwork_uuid = list(filmwork_uuid for filmwork_uuid, state_update in filmwork_checkpoints)
+    filmworks_uuid.update(filmwork_uuid)
+    filmworks_uuid_total += len(filmwork_uuid)
+
+    if 'person' in shards:
+        logger.info(f' - Кейс изменение записей в таблице person')
+        person_checkpoints, person_has_more = get_filmworks_by_changed_persons(
+            movies_db,
+            state_person_modified=state.get('state_person_modified'),
+            state_person_id=state.get('state_person_id'),
+            state_person_fanout=state.get('state_person_fanout'),
+            batch=extract_batch,
+            fanout_batch=fanout_batch,
+        )
+    person_filmwork_uuid = list(
+        filmwork_uuid for filmwork_uuid, state_update in person_checkpoints if filmwork_uuid is not None
     )
-    extracted_data += person_data
-
-    logger.info(f' - Кейс изменение записей в таблице genre')
-    genre_data, state_genre_modified = get_filmworks_by_changed_genre(
-        movies_db,
-        state_genre_modified=state.get('state_genre_modified'),
-        batch=extract_batch
+    filmworks_uuid.update(person_filmwork_uuid)
+    filmworks_uuid_total += len(person_filmwork_uuid)
+
+    if 'genre' in shards:
+        logger.info(f' - Кейс изменение записей в таблице genre')
+        genre_checkpoints, genre_has_more = get_filmworks_by_changed_genre(
+            movies_db,
+            state_genre_modified=state.get('state_genre_modified'),
+            state_genre_id=state.get('state_genre_id'),
+            state_genre_fanout=state.get('state_genre_fanout'),
+            batch=extract_batch,
+            fanout_batch=fanout_batch,
+        )
+    genre_filmwork_uuid = list(
+        filmwork_uuid for filmwork_uuid, state_update in genre_checkpoints if filmwork_uuid is not None
     )
-    extracted_data += genre_data
-
-    movies_db.close()
+    filmworks_uuid.update(genre_filmwork_uuid)
+    filmworks_uuid_total += len(genre_filmwork_uuid)
+
+    # Изменения связей фильмов с персонами и жанрами не меняют modified фильма,
+    # такие фильмы приходят только из уведомлений
+    notified_filmworks_uuid = list(notified_filmworks_uuid)
+    if notified_filmworks_uuid:
+        logger.info(f' - Фильмов из уведомлений об изменениях: {len(notified_filmworks_uuid)}')
+    filmworks_uuid.update(notified_filmworks_uuid)
+    filmworks_uuid_total += len(notified_filmworks_uuid)
+
+    if filmworks_uuid_total:
+        logger.info(
+            f' - Уникальных фильмов {len(filmworks_uuid)} из {filmworks_uuid_total}, '
+            f'коэффициент дедупликации {filmworks_uuid_total / len(filmworks_uuid):.2f}'
+        )
 
-    state = {
-        'state_filmwork_modified': state_filmwork_modified,
-        'state_person_modified': state_person_modified,
-        'state_genre_modified': state_genre_modified,
+    if settings.ETL_PARTIAL_UPDATES_ENABLED:
+        # Фильмы, затронутые только изменением персон или жанров, обновляются частично,
+        # полные документы собираются только для измененных фильмов
+        full_filmworks_uuid = set(filmwork_uuid).union(notified_filmworks_uuid)
+        person_filmworks_uuid = set(person_filmwork_uuid).difference(full_filmworks_uuid)
+        genre_filmworks_uuid = set(genre_filmwork_uuid).difference(full_filmworks_uuid)
+        logger.info(
+            f' - Получение данных по фильмам: полностью {len(full_filmworks_uuid)}, '
+            f'участники {len(person_filmworks_uuid)}, жанры {len(genre_filmworks_uuid)}'
+        )
+        extracted_data = get_filmworks_additional_data(movies_db, full_filmworks_uuid)
+        extracted_data += get_filmworks_persons_data(movies_db, person_filmworks_uuid)
+        extracted_data += get_filmworks_genres_data(movies_db, genre_filmworks_uuid)
+    else:
+        logger.info(f' - Получение данных по фильмам')
+        extracted_data = get_filmworks_additional_data(movies_db, filmworks_uuid)
+
+    movies_db.log_stats()
+
+    # Состояние после батча - состояние после последней контрольной точки каждого источника
+    checkpoints = filmwork_checkpoints + person_checkpoints + genre_checkpoints
+    state = dict(state)
+    for filmwork_uuid, state_update in checkpoints:
+        state.update(state_update)
+
+    # Отставание состояний от текущего времени, пока таблица возвращает полный батч
+    # это и есть отставание ETL от изменений в БД
+    has_more = {
+        'state_filmwork_modified': filmwork_has_more,
+        'state_person_modified': person_has_more,
+        'state_genre_modified': genre_has_more,
     }
+    for state_key, state_has_more in has_more.items():
+        logger.info(
+            f' - {state_key}: отставание {get_state_lag(state[state_key])}, '
+            f'полный батч: {state_has_more}'
+        )
 
     logger.info(f' <- Этап извлечения данных')
-    return extracted_data, state
+    return extracted_data, state, any(has_more.values()), checkpoints
 
 
-def transform(extracted_data: List[Any]) -> List[Movie]:
+def transform(extracted_data: List[Any]) -> List[Union[Movie, MovieUpdate]]:
     """Трансформация данных.
 
-    :param extracted_data: Список с данными из БД.
-    :return: Список сгруппированных данных по фильмам в объектах Movie.
+    Группировка и дедупликация выполняются в БД, трансформация только упаковывает
+    каждую строку в Movie и работает за линейное время от количества фильмов.
+    Строки облегченных запросов по участникам и жанрам упаковываются в MovieUpdate,
+    строки одного фильма объединяются в одно частичное обновление.
+
+    :param extracted_data: Список с данными из БД, по одной уникальной строке на фильм.
+    :return: Список данных по фильмам в объектах Movie и MovieUpdate.
     """
     logger.info(f' -> Этап трансформации данных')
 
     # Список для результата трансформации
     transformed_data = list()
-
-    # Предварительно сортируем данные для применения groupby
-    data = sorted(extracted_data, key=lambda x: x.fw_id)
-
-    # Группируем данные
-    for key, group_items in groupby(data, key=lambda x: x.fw_id):
-        # print(key)
-        # ffaec4b6-477d-4247-add0-dbe2ad91b3dd
-
-        # Зададим данные по умолчанию
-        filmwork_id = ''
-        filmwork_imdb_rating = 0.0
-        filmwork_title = ''
-        filmwork_description = ''
-        filmwork_genre = list()
-        filmwork_director = list()
-        filmwork_actors_names = list()
-        filmwork_writers_names = list()
-        filmwork_actors = list()
-        filmwork_writers = list()
-
-        # Заполним данные из группированных строк
-        for filmwork in group_items:
-
-            # print(filmwork)
-            # Record(
-            #   fw_id='9d284e83-21f0-4073-aac0-4abee51193d8',
-            #   title='Star Trek: Insurrection',
-            #   description="While on a mission ...",
-            #   rating=6.4,
-            #   type='movie',
-            #   created=datetime.datetime(2021, 6, 16, 20, 14, 9, 223239, tzinfo=datetime.timezone.utc),
-            #   modified=datetime.datetime(2021, 6, 16, 20, 14, 9, 223256, tzinfo=datetime.timezone.utc),
-            #   role='actor',
-            #   id='972c86a5-16f4-432b-b9b3-54965291ddb0',
-            #   full_name='Brent Spiner',
-            #   name='Adventure'
-            # )
-            # ...
-
-            if not filmwork_id:
-                filmwork_id = filmwork.fw_id
-                filmwork_imdb_rating = filmwork.rating
-                filmwork_title = filmwork.title
-                filmwork_description = filmwork.description
-
-            if filmwork.name not in filmwork_genre:
-                filmwork_genre.append(filmwork.name)
-
-            if filmwork.role == 'director' and \
-                    filmwork.full_name not in filmwork_director:
-                filmwork_director.append(filmwork.full_name)
-
-            elif filmwork.role == 'actor' and \
-                    filmwork.id not in list(actor.get('id') for actor in filmwork_actors):
-                filmwork_actors.append({'id': filmwork.id, 'name': filmwork.full_name})
-                filmwork_actors_names.append(filmwork.full_name)
-
-            elif filmwork.role == 'writer' and \
-                    filmwork.id not in list(writer.get('id') for writer in filmwork_writers):
-                filmwork_writers.append({'id': filmwork.id, 'name': filmwork.full_name})
-                filmwork_writers_names.append(filmwork.full_name)
+    # Частичные обновления по UUID фильма
+    updates = dict()
+
+    for filmwork in extracted_data:
+
+        if not hasattr(filmwork, 'title'):
+            update = updates.setdefault(filmwork.fw_id, MovieUpdate(id=filmwork.fw_id, fields=dict()))
+            update.fields.update(
+                (field, getattr(filmwork, column))
+                for column, field in PARTIAL_UPDATE_FIELDS.items()
+                if hasattr(filmwork, column)
+            )
+            continue
+
+        # print(filmwork)
+        # Record(
+        #   fw_id='9d284e83-21f0-4073-aac0-4abee51193d8',
+        #   title='Star Trek: Insurrection',
+        #   description="While on a mission ...",
+        #   rating=6.4,
+        #   type='movie',
+        #   created=datetime.datetime(2021, 6, 16, 20, 14, 9, 223239, tzinfo=datetime.timezone.utc),
+        #   modified=datetime.datetime(2021, 6, 16, 20, 14, 9, 223256, tzinfo=datetime.timezone.utc),
+        #   genres=['Action', 'Adventure'],
+        #   directors=['Jonathan Frakes'],
+        #   actors_names=['Brent Spiner', ...],
+        #   writers_names=['Michael Piller', ...],
+        #   actors=[{'id': '972c86a5-16f4-432b-b9b3-54965291ddb0', 'name': 'Brent Spiner'}, ...],
+        #   writers=[{'id': '...', 'name': 'Michael Piller'}, ...],
+        # )
 
         # Упаковываем данные в датакласс для elastic
         filmwork_elastic = Movie(
-            id=filmwork_id,
-            imdb_rating=filmwork_imdb_rating,
-            title=filmwork_title,
-            description=filmwork_description,
-            genre=filmwork_genre,
-            director=filmwork_director,
-            actors_names=filmwork_actors_names,
-            writers_names=filmwork_writers_names,
-            actors=filmwork_actors,
-            writers=filmwork_writers,
+            id=filmwork.fw_id,
+            imdb_rating=filmwork.rating,
+            title=filmwork.title,
+            description=filmwork.description,
+            genre=filmwork.genres,
+            director=filmwork.directors,
+            actors_names=filmwork.actors_names,
+            writers_names=filmwork.writers_names,
+            actors=filmwork.actors,
+            writers=filmwork.writers,
         )
 
         transformed_data.append(filmwork_elastic)
 
+    transformed_data.extend(updates.values())
+
     logger.info(f' <- Этап трансформации данных')
     return transformed_data
 
 
-def load(transformed_data: List[Movie], load_batch=100) -> None:
+def load(
+        transformed_data: List[Union[Movie, MovieUpdate]],
+        load_batch=100,
+        es_index: Optional[str] = None,
+        skip_unchanged: bool = True,
+        on_loaded: Optional[Callable[[Iterable[str]], None]] = None,
+) -> None:
     """Загрузка данных.
 
-    :param transformed_data: Список сгруппированных данных по фильмам в объектах Movie.
-    :param load_batch: Размер данных которые будем загружать в Elasticsearch за итерацию.
+    При ETL_CONTENT_HASH_ENABLED документы, содержимое которых не изменилось
+    с прошлой загрузки, не отправляются в Elasticsearch (кроме ETL_SHARDING_ENABLED,
+    см. etl_app.load.hashes).
+
+    :param transformed_data: Список данных по фильмам в объектах Movie и MovieUpdate.
+    :param load_batch: Максимальное количество документов в одном bulk запросе к Elasticsearch.
+    :param es_index: Имя индекса или псевдонима в Elasticsearch, по умолчанию ELASTIC_INDEX.
+    :param skip_unchanged: Отбрасывать неизмененные документы, для перестройки индекса
+                           нужно загрузить все документы.
+    :param on_loaded: Вызывается с UUID фильмов, загрузку которых подтвердил Elasticsearch,
+                      по мере подтверждения bulk запросов в порядке transformed_data.
     """
+    es_index = es_index or settings.ELASTIC_INDEX
     logger.info(f' -> Этап загрузки данных')
 
-    # Создадим индекс movie если его не было
-    create_index_movie(
-        es_url_with_index=settings.es_url_with_index,
-        es_index_file=settings.ELASTIC_INDEX_FILE,
-        es_index_timeout=settings.ELASTIC_INDEX_TIMEOUT,
-    )
+    if not transformed_data:
+        logger.info(f' <- Нет данных для загрузки')
+        return
 
     logger.info(f' - Загрузки данных')
-    # Загрузка данных в Elasticsearch
-    operations_count = len(transformed_data) // load_batch + 1
-    for batch_number in range(operations_count):
-        batch_data = transformed_data[load_batch * batch_number:load_batch*(batch_number+1)]
-        bulk_data = get_prepared_data(batch_data)
-        insert_data_to_elastic(bulk_data=bulk_data, es_url=settings.es_url)
+    hash_store = get_content_hash_store() if is_content_hash_enabled() else None
+    stored_hashes = dict()
+    if hash_store is not None and skip_unchanged:
+        stored_hashes = hash_store.get_hashes(movie.id for movie in transformed_data if isinstance(movie, Movie))
+
+    while True:
+        # Создадим индекс movie если его не было, наличие индекса проверяется один раз
+        create_index_movie(
+            es_index=es_index,
+            es_index_file=settings.ELASTIC_INDEX_FILE,
+            es_index_timeout=settings.ELASTIC_INDEX_TIMEOUT,
+        )
+        # Документы кодируются в пачки по мере отправки, после ошибки индекса пачки кодируются заново
+        chunks = encode_bulk_chunks(
+            transformed_data,
+            es_index=es_index,
+            chunk_size=load_batch,
+            max_chunk_bytes=settings.ELASTIC_BULK_MAX_BYTES,
+            hash_documents=hash_store is not None,
+            stored_hashes=stored_hashes,
+        )
+        try:
+            insert_data_to_elastic(
+                chunks,
+                thread_count=settings.ELASTIC_BULK_THREADS,
+                on_chunk_loaded=on_loaded,
+                require_alias=es_index in alias_indexes,
+                hash_store=hash_store,
+            )
+            break
+        except IndexNotFoundError as err:
+            logger.warning(f' - {err}, повторная проверка индекса')
+
     logger.info(f' - Загрузки данных завершена')
+    log_elastic_stats()
 
     logger.info(f' <- Этап загрузки данных')
 
 
-def save_state(state_dict: dict) -> None:
+def save_state(state: State, state_dict: dict, shards: Optional[Iterable[str]] = None) -> None:
     """Сохранение состояния.
 
+    :param state: Хранилище состояния ETL.
     :param state_dict: Словарь состояний после итерации ETL.
+    :param shards: Шарды, которыми процесс владел при извлечении, None - все.
     """
     logger.info(f' -> Этап сохранение состояния')
     try:
-        storage = JsonFileStorage(settings.ETL_STATE_FILENAME)
-        state = State(storage)
-        state.set_state(state_dict)
+        state.set_state(state_dict, shards)
         logger.info(f' - Успешное сохранение состояния')
 
     except Exception as err:
@@ -242,39 +390,178 @@ def save_state(state_dict: dict) -> None:
     logger.info(f' <- Этап сохранение состояния')
 
 
-def main(timeout_sec: int = 5, extract_batch: int = 10, load_batch: int = 10) -> None:
+def wait_for_changes(movies_db: PostgresDB, backoff: IdleBackoff, has_data: bool) -> set[str]:
+    """Пауза перед следующей итерацией, когда все изменения обработаны.
+
+    При ETL_LISTEN_ENABLED пауза прерывается уведомлением NOTIFY об изменении в БД.
+
+    :param movies_db: Объект пула подключений к БД.
+    :param backoff: Адаптивная пауза между итерациями.
+    :param has_data: Признак того, что последняя итерация извлекла данные.
+    :return: UUID фильмов из уведомлений об изменениях.
+    """
+    if has_data:
+        backoff.reset()
+
+    logger.info(f' Пауза перед итерациями {backoff.current} секунд')
+    if settings.ETL_LISTEN_ENABLED:
+        payloads = movies_db.wait_notifies(backoff.current)
+        if payloads:
+            logger.info(f' Получено уведомлений об изменениях: {len(payloads)}')
+            backoff.reset()
+            return get_filmworks_uuid_from_notifies(payloads)
+    else:
+        sleep(backoff.current)
+
+    if not has_data:
+        backoff.increase()
+    return set()
+
+
+def main(
+        timeout_sec: int = 5,
+        timeout_max_sec: int = 60,
+        extract_batch: int = 10,
+        fanout_batch: int = 1000,
+        load_batch: int = 10,
+) -> None:
     """Основной цикл ETL.
 
+    Пока хотя бы одна таблица возвращает полный батч, итерации идут без паузы (режим догоняния).
+    Когда все изменения обработаны, пауза между итерациями увеличивается вдвое
+    от timeout_sec до timeout_max_sec и сбрасывается при появлении новых данных.
+
+    При ETL_LISTEN_ENABLED пауза прерывается уведомлением NOTIFY об изменении в БД,
+    а опрос таблиц по состоянию остается для подбора пропущенных изменений.
+
+    При ETL_PIPELINE_ENABLED этапы работают конвейером, см. etl_app.pipeline.
+
+    При ETL_SHARDING_ENABLED можно запустить несколько процессов ETL, источники изменений
+    распределяются между ними advisory блокировками, см. etl_app.coordination.
+
     :param timeout_sec: Пауза перед итерациями в секундах.
+    :param timeout_max_sec: Максимальная пауза перед итерациями в секундах при отсутствии изменений.
     :param extract_batch: Размер для выгрузки данных за раз.
+    :param fanout_batch: Размер для выгрузки фильмов по измененным персонам и жанрам за раз.
     :param load_batch: Размер для загрузки данных за раз.
     """
+    # Пул подключений к БД movies держим всё время работы ETL
+    movies_db = get_movies_database()
+    backoff = IdleBackoff(timeout_sec, timeout_max_sec)
+
+    # UUID фильмов из уведомлений, обрабатываются на следующих итерациях не больше ETL_NOTIFY_BATCH за раз
+    notified_filmworks = NotifiedFilmworks(settings.ETL_NOTIFY_BATCH)
+
+    # При ETL_SHARDING_ENABLED процесс обрабатывает только захваченные шарды
+    leases = ShardLeases(movies_db, settings.ETL_SHARDS_MAX) if settings.ETL_SHARDING_ENABLED else None
+
+    # Состояние извлечения, в конвейерном режиме опережает сохраненное состояние
+    etl_state = get_etl_state(movies_db, leases)
+    state = load_state(etl_state)
+
+    def extract_batch_data() -> tuple[list[Any], BatchCheckpoints, bool]:
+        nonlocal state
+        shards = SHARDS
+        if leases is not None:
+            # Отложенное состояние освобождаемых шардов сохраняется до передачи их другим процессам
+            acquired = leases.refresh(before_release=etl_state.flush)
+            if acquired:
+                # Состояние захваченных шардов могли сдвинуть процессы, которые держали их раньше
+                stored_state = etl_state.storage.retrieve_state()
+                state = dict(state, **{
+                    state_key: stored_state.get(state_key, '')
+                    for shard in acquired
+                    for state_key in SHARD_STATE_KEYS[shard]
+                })
+            shards = set(leases.owned)
+
+        # Фильмы из уведомлений обрабатывает процесс с шардом filmwork
+        if 'filmwork' not in shards:
+            notified_filmworks.clear()
+        notified_filmworks_uuid = notified_filmworks.take()
+
+        extracted_data, batch_state, has_more, checkpoints = extract(
+            movies_db,
+            state=state,
+            extract_batch=extract_batch,
+            fanout_batch=fanout_batch,
+            notified_filmworks_uuid=notified_filmworks_uuid,
+            shards=shards,
+        )
+        # Состояние шардов, захваченных после извлечения, батч не знает и записывать не должен
+        batch_checkpoints = BatchCheckpoints(
+            state, batch_state, checkpoints, shards=shards if leases is not None else None
+        )
+        state = batch_state
+        if notified_filmworks:
+            logger.info(f' Фильмов из уведомлений перенесено на следующую итерацию: {len(notified_filmworks)}')
+            has_more = True
+        if has_more:
+            logger.info(f' Есть необработанные изменения, следующая итерация без паузы')
+            backoff.reset()
+        return extracted_data, batch_checkpoints, has_more
+
+    def load_batch_data(transformed_data: List[Union[Movie, MovieUpdate]], batch_checkpoints: BatchCheckpoints) -> None:
+        # Документы загружаются в порядке контрольных точек, после каждого подтвержденного
+        # bulk запроса состояние сдвигается до последнего загруженного подряд фильма
+        transformed_data.sort(key=lambda movie: batch_checkpoints.position(movie.id))
+
+        def on_loaded(filmworks_uuid: Iterable[str]) -> None:
+            if batch_checkpoints.acknowledge(filmworks_uuid):
+                etl_state.set_state(batch_checkpoints.state, batch_checkpoints.shards)
+
+        # Фильмы, удаленные между выборкой UUID и выборкой данных, загружать не нужно
+        on_loaded(batch_checkpoints.filmworks_uuid.difference(movie.id for movie in transformed_data))
+        load(transformed_data, load_batch=load_batch, on_loaded=on_loaded)
+
+    def save_batch_state(batch_checkpoints: BatchCheckpoints) -> None:
+        save_state(etl_state, batch_checkpoints.final_state, batch_checkpoints.shards)
+
+    def wait_for_batch_changes(has_data: bool) -> None:
+        notified_filmworks.add(wait_for_changes(movies_db, backoff, has_data))
 
-    while True:
+    try:
+        if settings.ETL_LISTEN_ENABLED:
+            movies_db.listen(ETL_NOTIFY_CHANNEL)
+
+        if settings.ETL_PIPELINE_ENABLED:
+            Pipeline(
+                extract=extract_batch_data,
+                transform=transform,
+                load=load_batch_data,
+                save_state=save_batch_state,
+                wait_for_changes=wait_for_batch_changes,
+                queue_size=settings.ETL_PIPELINE_QUEUE_SIZE,
+            ).run()
+            return
 
-        # Получение состояния
-        state = load_state(settings.ETL_STATE_FILENAME)
+        while True:
 
-        # Извлекаем данные
-        extracted_data, state = extract(state=state, extract_batch=extract_batch)
+            # Извлекаем данные
+            extracted_data, batch_checkpoints, has_more = extract_batch_data()
 
-        # Преобразуем данные
-        transformed_data = transform(extracted_data)
+            # Преобразуем данные
+            transformed_data = transform(extracted_data)
 
-        # Загрузка данных
-        load(transformed_data, load_batch=load_batch)
+            # Загрузка данных с сохранением контрольных точек
+            load_batch_data(transformed_data, batch_checkpoints)
 
-        # Сохранение состояния
-        save_state(state)
+            # Сохранение состояния
+            save_batch_state(batch_checkpoints)
 
-        # Пауза перед следующим циклом
-        logger.info(f' Пауза перед итерациями {timeout_sec} секунд')
-        sleep(timeout_sec)
+            # Режим догоняния: остались необработанные изменения, паузу пропускаем
+            if not has_more:
+                wait_for_batch_changes(bool(extracted_data))
+    finally:
+        etl_state.flush()
+        movies_db.close()
 
 
 if __name__ == '__main__':
     main(
         timeout_sec=settings.ETL_TIMEOUT_SEC,
+        timeout_max_sec=settings.ETL_TIMEOUT_MAX_SEC,
         extract_batch=settings.ETL_EXTRACT_BATCH,
+        fanout_batch=settings.ETL_FANOUT_BATCH,
         load_batch=settings.ETL_LOAD_BATCH,
     )
@@ -0,0 +1,77 @@
+"""Замеры производительности ETL.
+
+Запуск из корня репозитория (в контейнере etl_app - из /): python3 -m etl_app.benchmarks.<модуль>.
+Результаты замеров записаны в BENCHMARKS.md в корне репозитория.
+"""
+
+from random import Random
+from statistics import median
+from time import perf_counter
+from typing import Callable, Iterable, List, Sequence
+from uuid import UUID
+
+from etl_app.transfrom.transform_dataclasses import Movie
+
+
+def measure(func: Callable[[], object], repeat: int = 5) -> float:
+    """Медиана времени выполнения функции.
+
+    :param func: Замеряемая функция без аргументов.
+    :param repeat: Количество запусков.
+    :return: Медиана времени выполнения в миллисекундах.
+    """
+    timings = list()
+    for _ in range(repeat):
+        started = perf_counter()
+        func()
+        timings.append((perf_counter() - started) * 1000)
+    return median(timings)
+
+
+def print_table(header: Sequence[str], rows: Iterable[Sequence[object]]) -> None:
+    """Вывод результатов замеров таблицей markdown.
+
+    :param header: Заголовки столбцов.
+    :param rows: Строки таблицы, числа с плавающей точкой выводятся с двумя знаками.
+    """
+    print('| ' + ' | '.join(header) + ' |')
+    print('|' + '|'.join('---' for _ in header) + '|')
+    for row in rows:
+        print('| ' + ' | '.join(f'{value:.2f}' if isinstance(value, float) else str(value) for value in row) + ' |')
+
+
+def generate_movies(count: int, actors_per_film: int = 10, seed: int = 0) -> List[Movie]:
+    """Фильмы с полями типичного размера: описание, три жанра, режиссер, сценаристы и актеры.
+
+    :param count: Количество фильмов.
+    :param actors_per_film: Количество актеров в фильме.
+    :param seed: Начальное значение генератора случайных чисел.
+    :return: Список фильмов.
+    """
+    random = Random(seed)
+    words = ('фильм', 'история', 'город', 'любовь', 'война', 'space', 'journey', 'night', 'дом', 'star')
+
+    def get_person() -> dict:
+        return {
+            'id': str(UUID(int=random.getrandbits(128), version=4)),
+            'name': f'{random.choice(("Анна", "John", "Мария", "Peter"))} {random.choice(("Иванова", "Smith", "Петров"))}',
+        }
+
+    movies = list()
+    for number in range(count):
+        directors = list(get_person() for _ in range(1))
+        writers = list(get_person() for _ in range(2))
+        actors = list(get_person() for _ in range(actors_per_film))
+        movies.append(Movie(
+            id=str(UUID(int=random.getrandbits(128), version=4)),
+            imdb_rating=round(random.uniform(1, 10), 1),
+            title=' '.join(random.choices(words, k=3)).capitalize(),
+            description=' '.join(random.choices(words, k=40)).capitalize() + '.',
+            genre=random.sample(('Action', 'Drama', 'Comedy', 'Sci-Fi', 'Документальный'), 3),
+            director=list(person['name'] for person in directors),
+            actors_names=list(person['name'] for person in actors),
+            writers_names=list(person['name'] for person in writers),
+            actors=actors,
+            writers=writers,
+        ))
+    return movies
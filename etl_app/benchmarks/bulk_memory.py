@@ -0,0 +1,105 @@
+"""Замер памяти подготовки bulk запросов: прежние словари действий против encode_bulk_chunks.
+
+Прежняя загрузка строила словарь действия с _source на каждый фильм, helpers.bulk клиента
+раскладывал его на действие и документ и сериализовал стандартным json. Сейчас
+encode_bulk_chunks по мере отправки кодирует фильмы пачки сразу в один буфер NDJSON
+и считает хеши _source по тем же байтам. В обоих вариантах тело bulk запроса собирается
+пачками и сразу освобождается, как после отправки.
+
+Выводится пик памяти по tracemalloc и количество блоков памяти, которые держит
+подготовка до конца загрузки батча (словари действий или кеши строк фильмов).
+
+    python3 -m etl_app.benchmarks.bulk_memory
+"""
+
+import argparse
+import gc
+import tracemalloc
+from typing import Any, Callable, List
+
+from elasticsearch.helpers import expand_action
+from elasticsearch.helpers.actions import _chunk_actions
+from elasticsearch.serializer import JsonSerializer
+
+from etl_app.benchmarks import generate_movies, measure, print_table
+from etl_app.load.documents import encode_bulk_chunks
+from etl_app.transfrom.transform_dataclasses import Movie
+
+ES_INDEX = 'movies'
+CHUNK_SIZE = 500
+MAX_CHUNK_BYTES = 10 * 1024 * 1024
+
+
+def get_prepared_data(batch_data: List[Movie]) -> List[dict]:
+    """Прежняя подготовка данных: словарь действия с _source на каждый фильм."""
+    return list(
+        {
+            '_index': ES_INDEX,
+            '_id': film.id,
+            '_source': {
+                'id': film.id,
+                'imdb_rating': film.imdb_rating,
+                'title': film.title,
+                'description': film.description,
+                'genre': film.genre,
+                'director': film.director,
+                'actors_names': film.actors_names,
+                'writers_names': film.writers_names,
+                'actors': film.actors,
+                'writers': film.writers,
+            },
+        }
+        for film in batch_data
+    )
+
+
+def legacy_bulk(movies: List[Movie]) -> List[dict]:
+    """Прежний путь: словари действий, helpers.bulk и стандартный json клиента."""
+    prepared_data = get_prepared_data(movies)
+    serializer = JsonSerializer()
+    for bulk_data, bulk_actions in _chunk_actions(
+        map(expand_action, prepared_data), CHUNK_SIZE, MAX_CHUNK_BYTES, serializer
+    ):
+        # Тело запроса собирает NDJSON сериализатор клиента
+        body = b'\n'.join(bulk_actions) + b'\n'
+        del body
+    return prepared_data
+
+
+def current_bulk(movies: List[Movie]) -> None:
+    """Текущий путь: encode_bulk_chunks с хешами содержимого, тело запроса как в send_bulk_request."""
+    for chunk in encode_bulk_chunks(movies, ES_INDEX, CHUNK_SIZE, MAX_CHUNK_BYTES, hash_documents=True):
+        body = b''.join(chunk.lines())
+        del body
+
+
+def trace(func: Callable[[List[Movie]], Any], movies: List[Movie]) -> tuple[float, int]:
+    """Пик памяти в МиБ и количество блоков памяти, которые держит результат func."""
+    gc.collect()
+    tracemalloc.start()
+    result = func(movies)
+    snapshot = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    blocks = sum(stat.count for stat in snapshot.statistics('filename'))
+    return peak / 1024 / 1024, blocks
+
+
+def main(films_count: int, repeat: int) -> None:
+    movies = generate_movies(films_count)
+    rows = list()
+    for name, func in (('Словари действий + helpers.bulk', legacy_bulk), ('encode_bulk_chunks', current_bulk)):
+        peak, blocks = trace(func, movies)
+        rows.append((name, peak, blocks, measure(lambda: func(movies), repeat)))
+
+    print(f'Фильмов: {films_count}, документов в bulk запросе: {CHUNK_SIZE}')
+    print_table(('Подготовка', 'Пик памяти, МиБ', 'Блоков памяти после загрузки', 'Время, мс'), rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--films', type=int, default=10_000, help='Количество фильмов')
+    parser.add_argument('--repeat', type=int, default=5, help='Количество запусков для замера времени')
+    arguments = parser.parse_args()
+    main(arguments.films, arguments.repeat)
@@ -0,0 +1,103 @@
+"""Замер запроса данных по фильмам: PREPARE / EXECUTE с uuid[] против IN списка в тексте запроса.
+
+Для каждого размера списка UUID выводятся время планирования и выполнения из EXPLAIN ANALYZE
+и полное время запроса на клиенте. psycopg2 подставляет массив в текст EXECUTE на клиенте,
+поэтому объем передачи сопоставим, экономия - на разборе и планировании. Нужна БД movies с фильмами, например после
+python manage.py generate_movies_catalog. Если фильмов меньше, список дополняется
+несуществующими UUID.
+
+    python3 -m etl_app.benchmarks.prepared_queries
+"""
+
+import argparse
+import json
+from statistics import median
+from uuid import uuid4
+
+from etl_app.benchmarks import measure, print_table
+from etl_app.extract.queries import get_filmworks_additional_query_by_filmwork_uuid
+from etl_app.extract.utils import get_movies_database
+
+SIZES = (10, 1_000, 50_000)
+PREPARED_NAME = 'benchmark_filmworks_additional'
+
+
+def get_filmworks_uuid(cursor, size: int) -> list[str]:
+    """UUID существующих фильмов, дополненные случайными до size."""
+    cursor.execute('select id from content.film_work order by id limit %s', (size,))
+    filmworks_uuid = list(str(row[0]) for row in cursor.fetchall())
+    filmworks_uuid.extend(str(uuid4()) for _ in range(size - len(filmworks_uuid)))
+    return filmworks_uuid
+
+
+def get_inline_query(filmworks_uuid: list[str]) -> str:
+    """Запрос в прежнем виде: UUID фильмов подставлены в текст запроса IN списком."""
+    in_list = "'" + "', '".join(filmworks_uuid) + "'"
+    return get_filmworks_additional_query_by_filmwork_uuid().replace('= any($1::uuid[])', f'in ({in_list})')
+
+
+def explain(cursor, sql: str, params=None) -> tuple[float, float]:
+    """Время планирования и выполнения запроса из EXPLAIN ANALYZE в миллисекундах."""
+    cursor.execute(f'explain (analyze, format json) {sql}', params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Planning Time'], plan[0]['Execution Time']
+
+
+def median_explain(cursor, sql: str, params, repeat: int) -> tuple[float, float]:
+    """Медианы времени планирования и выполнения по repeat запускам EXPLAIN ANALYZE."""
+    results = list(explain(cursor, sql, params) for _ in range(repeat))
+    planning = median(list(planning for planning, execution in results))
+    execution = median(list(execution for planning, execution in results))
+    return planning, execution
+
+
+def main(repeat: int) -> None:
+    movies_db = get_movies_database()
+    rows = list()
+    try:
+        with movies_db.connection() as connection, connection.cursor() as cursor:
+            cursor.execute(
+                f'prepare {PREPARED_NAME} (uuid[]) as {get_filmworks_additional_query_by_filmwork_uuid()}'
+            )
+            for size in SIZES:
+                filmworks_uuid = get_filmworks_uuid(cursor, size)
+                inline_query = get_inline_query(filmworks_uuid)
+                execute_query = f'execute {PREPARED_NAME} (%s::uuid[])'
+
+                def run_inline():
+                    cursor.execute(inline_query)
+                    cursor.fetchall()
+
+                def run_prepared():
+                    cursor.execute(execute_query, (filmworks_uuid,))
+                    cursor.fetchall()
+
+                inline_planning, inline_execution = median_explain(cursor, inline_query, None, repeat)
+                prepared_planning, prepared_execution = median_explain(
+                    cursor, execute_query, (filmworks_uuid,), repeat
+                )
+                rows.append((
+                    size, 'IN список', len(inline_query), inline_planning, inline_execution,
+                    measure(run_inline, repeat),
+                ))
+                rows.append((
+                    size, 'PREPARE / EXECUTE', len(cursor.mogrify(execute_query, (filmworks_uuid,))),
+                    prepared_planning, prepared_execution, measure(run_prepared, repeat),
+                ))
+            cursor.execute(f'deallocate {PREPARED_NAME}')
+    finally:
+        movies_db.close()
+
+    print_table(
+        ('UUID', 'Запрос', 'Текст запроса с параметрами, байт',
+         'Планирование, мс', 'Выполнение, мс', 'Запрос на клиенте, мс'),
+        rows,
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='Количество запусков каждого запроса')
+    main(parser.parse_args().repeat)
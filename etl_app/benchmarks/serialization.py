@@ -0,0 +1,67 @@
+"""Замер сериализации документов фильмов: orjson против стандартного json клиента Elasticsearch.
+
+Прежняя загрузка собирала словарь из полей Movie и сериализовала его JsonSerializer клиента
+на стандартном json. Сейчас serialize_document отдает dataclass в orjson напрямую, без orjson -
+так же строит словарь из полей. asdict с глубоким копированием полей приведен для сравнения.
+Замер проверяет, что все варианты дают одинаковый JSON после разбора.
+
+    python3 -m etl_app.benchmarks.serialization
+"""
+
+import argparse
+import json
+from dataclasses import asdict, fields
+
+from elasticsearch.serializer import JsonSerializer
+
+from etl_app.benchmarks import generate_movies, measure, print_table
+from etl_app.load.elastic import orjson, serialize_document
+from etl_app.transfrom.transform_dataclasses import Movie
+
+ACTORS_PER_FILM = (10, 100)
+
+
+def main(films_count: int, repeat: int) -> None:
+    if orjson is None:
+        raise SystemExit('orjson не установлен, serialize_document использует стандартный json')
+
+    stdlib_serializer = JsonSerializer()
+    movie_fields = list(field.name for field in fields(Movie))
+    variants = (
+        ('Словарь полей + json', lambda movie: stdlib_serializer.dumps(
+            {name: getattr(movie, name) for name in movie_fields}
+        )),
+        ('asdict + json', lambda movie: stdlib_serializer.dumps(asdict(movie))),
+        ('orjson', serialize_document),
+    )
+    rows = list()
+    for actors_per_film in ACTORS_PER_FILM:
+        movies = generate_movies(films_count, actors_per_film)
+        expected = None
+        for name, serialize in variants:
+            documents = list(serialize(movie) for movie in movies)
+            parsed = list(map(json.loads, documents))
+            if expected is None:
+                expected = parsed
+            elif parsed != expected:
+                raise AssertionError(f'Документы варианта {name} отличаются')
+
+            elapsed_ms = measure(lambda: list(serialize(movie) for movie in movies), repeat)
+            rows.append((
+                actors_per_film,
+                name,
+                sum(map(len, documents)) // films_count,
+                elapsed_ms,
+                elapsed_ms * 1000 / films_count,
+            ))
+
+    print(f'Фильмов: {films_count}')
+    print_table(('Актеров на фильм', 'Сериализация', 'Документ, байт', 'Все фильмы, мс', 'Документ, мкс'), rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--films', type=int, default=10_000, help='Количество фильмов')
+    parser.add_argument('--repeat', type=int, default=5, help='Количество запусков каждого варианта')
+    arguments = parser.parse_args()
+    main(arguments.films, arguments.repeat)
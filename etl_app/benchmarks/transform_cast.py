@@ -0,0 +1,264 @@
+"""Замер transform() при 100, 1 000 и 10 000 участников на фильм.
+
+Прежний transform() получал строку на каждое сочетание фильм x жанр x участник, сортировал их
+и проверял повтор участника поиском по списку. Сейчас жанры и участники агрегируются в БД,
+и transform() упаковывает одну строку на фильм. Замер сравнивает оба варианта на одних
+и тех же данных и проверяет, что результат совпадает с учетом порядка: прежний порядок жанров
+и участников зависел от порядка строк запроса и не был определен, поэтому результат прежнего
+варианта приводится к порядку текущего запроса (см. order_like_query).
+
+С --postgres фильмы дополнительно записываются в БД movies в транзакции, которая затем
+откатывается, и замеряются прежний запрос (строка на фильм x жанр x участник) и текущий
+запрос с агрегацией в БД: часть работы transform() перенесена в запрос.
+
+    python3 -m etl_app.benchmarks.transform_cast [--postgres]
+"""
+
+import argparse
+from collections import namedtuple
+from datetime import datetime, timezone
+from itertools import groupby
+from random import Random
+from uuid import UUID
+
+from psycopg2.extras import NamedTupleCursor, execute_values
+
+from etl_app.app import transform
+from etl_app.benchmarks import measure, print_table
+from etl_app.extract.queries import get_filmworks_additional_query_by_filmwork_uuid
+from etl_app.extract.utils import get_movies_database
+from etl_app.transfrom.transform_dataclasses import Movie
+
+CAST_SIZES = (100, 1_000, 10_000)
+GENRES_PER_FILM = 3
+# Первый участник - режиссер, следующие два - сценаристы, остальные - актеры
+WRITERS_PER_FILM = 2
+
+LegacyRow = namedtuple(
+    'LegacyRow',
+    'fw_id title description rating type created modified role id full_name name',
+)
+FilmworkRow = namedtuple(
+    'FilmworkRow',
+    'fw_id title description rating type created modified genres directors actors_names writers_names actors writers',
+)
+
+# Прежний запрос данных по фильмам, UUID передаются массивом вместо IN списка
+LEGACY_QUERY = """
+    select
+        fw.id as fw_id, fw.title, fw.description, fw.rating, fw.type, fw.created, fw.modified,
+        pfw.role, p.id, p.full_name, g.name
+    from content.film_work fw
+    left join content.person_film_work pfw on pfw.film_work_id = fw.id
+    left join content.person p on p.id = pfw.person_id
+    left join content.genre_film_work gfw on gfw.film_work_id = fw.id
+    left join content.genre g on g.id = gfw.genre_id
+    where fw.id = any(%s::uuid[])
+"""
+
+
+def get_uuid(random: Random) -> str:
+    return str(UUID(int=random.getrandbits(128), version=4))
+
+
+def generate_films(films_count: int, cast_size: int, seed: int = 0) -> tuple[list[LegacyRow], list[FilmworkRow]]:
+    """Строки прежнего запроса (фильм x жанр x участник) и текущего (одна строка на фильм)."""
+    random = Random(seed)
+    now = datetime.now(timezone.utc)
+    legacy_rows = list()
+    filmwork_rows = list()
+    for number in range(films_count):
+        fw_id = get_uuid(random)
+        genres = list(f'Benchmark genre {genre}' for genre in range(GENRES_PER_FILM))
+        persons = list((get_uuid(random), f'Person {number}-{person}') for person in range(cast_size))
+        roles = list(
+            'director' if index == 0 else 'writer' if index <= WRITERS_PER_FILM else 'actor'
+            for index in range(cast_size)
+        )
+        film = dict(fw_id=fw_id, title=f'Benchmark film {fw_id}', description='', rating=7.5, type='movie',
+                    created=now, modified=now)
+
+        legacy_rows.extend(
+            LegacyRow(**film, role=role, id=person_id, full_name=full_name, name=genre)
+            for (person_id, full_name), role in zip(persons, roles)
+            for genre in genres
+        )
+
+        # БД упорядочивает актеров и сценаристов по UUID персоны
+        cast = sorted(zip(persons, roles))
+        actors = list({'id': person_id, 'name': full_name} for (person_id, full_name), role in cast if role == 'actor')
+        writers = list({'id': person_id, 'name': full_name} for (person_id, full_name), role in cast if role == 'writer')
+        filmwork_rows.append(FilmworkRow(
+            **film,
+            genres=genres,
+            directors=sorted(full_name for (person_id, full_name), role in cast if role == 'director'),
+            actors_names=list(actor['name'] for actor in actors),
+            writers_names=list(writer['name'] for writer in writers),
+            actors=actors,
+            writers=writers,
+        ))
+
+    # Строки прежнего запроса приходили без упорядочивания
+    random.shuffle(legacy_rows)
+    return legacy_rows, filmwork_rows
+
+
+def legacy_transform(extracted_data: list[LegacyRow]) -> list[Movie]:
+    """Прежний transform(): сортировка, groupby и поиск повторов участников по спискам."""
+    transformed_data = list()
+    data = sorted(extracted_data, key=lambda x: x.fw_id)
+    for key, group_items in groupby(data, key=lambda x: x.fw_id):
+        movie = Movie(id='', imdb_rating=0.0, title='', description='', genre=list(), director=list(),
+                      actors_names=list(), writers_names=list(), actors=list(), writers=list())
+        for filmwork in group_items:
+            if not movie.id:
+                movie.id = filmwork.fw_id
+                movie.imdb_rating = filmwork.rating
+                movie.title = filmwork.title
+                movie.description = filmwork.description
+            if filmwork.name not in movie.genre:
+                movie.genre.append(filmwork.name)
+            if filmwork.role == 'director' and filmwork.full_name not in movie.director:
+                movie.director.append(filmwork.full_name)
+            elif filmwork.role == 'actor' and filmwork.id not in list(actor.get('id') for actor in movie.actors):
+                movie.actors.append({'id': filmwork.id, 'name': filmwork.full_name})
+                movie.actors_names.append(filmwork.full_name)
+            elif filmwork.role == 'writer' and filmwork.id not in list(writer.get('id') for writer in movie.writers):
+                movie.writers.append({'id': filmwork.id, 'name': filmwork.full_name})
+                movie.writers_names.append(filmwork.full_name)
+        transformed_data.append(movie)
+    return transformed_data
+
+
+def order_like_query(movies: list[Movie]) -> list[Movie]:
+    """Результат прежнего transform() в порядке текущего запроса.
+
+    Жанры и режиссеры упорядочены по имени, актеры и сценаристы и их имена - по UUID персоны.
+    """
+    for movie in movies:
+        movie.genre = sorted(movie.genre)
+        movie.director = sorted(movie.director)
+        movie.actors = sorted(movie.actors, key=lambda actor: actor['id'])
+        movie.writers = sorted(movie.writers, key=lambda writer: writer['id'])
+        movie.actors_names = list(actor['name'] for actor in movie.actors)
+        movie.writers_names = list(writer['name'] for writer in movie.writers)
+    return movies
+
+
+def normalize(movies: list[Movie]) -> dict:
+    """Результат transform() без учета порядка фильмов, но с учетом порядка жанров и участников."""
+    return {
+        movie.id: (
+            movie.title,
+            list(movie.genre),
+            list(movie.director),
+            list(movie.actors_names),
+            list(movie.writers_names),
+            list((str(actor['id']), actor['name']) for actor in movie.actors),
+            list((str(writer['id']), writer['name']) for writer in movie.writers),
+        )
+        for movie in movies
+    }
+
+
+def insert_films(cursor, legacy_rows: list[LegacyRow]) -> None:
+    """Запись фильмов, жанров, персон и связей из строк прежнего запроса в таблицы content."""
+    films = {row.fw_id: row for row in legacy_rows}
+    genres = {name: get_uuid(Random(name)) for name in set(row.name for row in legacy_rows)}
+    persons = {row.id: row.full_name for row in legacy_rows}
+    person_roles = set((row.fw_id, row.id, row.role) for row in legacy_rows)
+    film_genres = set((row.fw_id, genres[row.name]) for row in legacy_rows)
+
+    # Триггеры уведомлений ETL не нужны, транзакция все равно откатывается
+    cursor.execute('set local session_replication_role = replica')
+    execute_values(
+        cursor,
+        'insert into content.genre (id, name, description, created, modified) values %s',
+        list((genre_id, name, '', 'now', 'now') for name, genre_id in genres.items()),
+    )
+    execute_values(
+        cursor,
+        'insert into content.person (id, full_name, created, modified) values %s',
+        list((person_id, full_name, 'now', 'now') for person_id, full_name in persons.items()),
+    )
+    execute_values(
+        cursor,
+        'insert into content.film_work (id, title, description, rating, type, created, modified) values %s',
+        list((film.fw_id, film.title, film.description, film.rating, film.type, film.created, film.modified)
+             for film in films.values()),
+    )
+    execute_values(
+        cursor,
+        'insert into content.genre_film_work (id, film_work_id, genre_id, created) values %s',
+        list((get_uuid(Random(f'{fw_id}{genre_id}')), fw_id, genre_id, 'now') for fw_id, genre_id in film_genres),
+    )
+    execute_values(
+        cursor,
+        'insert into content.person_film_work (id, film_work_id, person_id, role, created) values %s',
+        list((get_uuid(Random(f'{fw_id}{person_id}{role}')), fw_id, person_id, role, 'now')
+             for fw_id, person_id, role in person_roles),
+    )
+    for table in ('genre', 'person', 'film_work', 'genre_film_work', 'person_film_work'):
+        cursor.execute(f'analyze content.{table}')
+
+
+def measure_queries(legacy_rows: list[LegacyRow], repeat: int) -> tuple[float, float]:
+    """Время прежнего и текущего запроса данных по фильмам в миллисекундах."""
+    filmworks_uuid = list({row.fw_id for row in legacy_rows})
+    current_query = get_filmworks_additional_query_by_filmwork_uuid().replace('$1', '%s')
+    movies_db = get_movies_database()
+    try:
+        with movies_db.connection() as connection:
+            # Соединения пула работают в autocommit, фильмы пишутся в транзакции и откатываются
+            connection.autocommit = False
+            try:
+                with connection.cursor(cursor_factory=NamedTupleCursor) as cursor:
+                    insert_films(cursor, legacy_rows)
+
+                    def run_legacy():
+                        cursor.execute(LEGACY_QUERY, (filmworks_uuid,))
+                        return legacy_transform(cursor.fetchall())
+
+                    def run_current():
+                        cursor.execute(current_query, (filmworks_uuid,))
+                        return transform(cursor.fetchall())
+
+                    if normalize(order_like_query(run_legacy())) != normalize(run_current()):
+                        raise AssertionError('Результат запросов из БД отличается')
+                    return measure(run_legacy, repeat), measure(run_current, repeat)
+            finally:
+                connection.rollback()
+                connection.autocommit = True
+    finally:
+        movies_db.close()
+
+
+def main(films_count: int, repeat: int, postgres: bool) -> None:
+    rows = list()
+    for cast_size in CAST_SIZES:
+        legacy_rows, filmwork_rows = generate_films(films_count, cast_size)
+        if normalize(order_like_query(legacy_transform(legacy_rows))) != normalize(transform(filmwork_rows)):
+            raise AssertionError(f'Результат transform() отличается при {cast_size} участниках')
+
+        legacy_ms = measure(lambda: legacy_transform(legacy_rows), repeat)
+        current_ms = measure(lambda: transform(filmwork_rows), repeat)
+        row = (cast_size, len(legacy_rows), legacy_ms, len(filmwork_rows), current_ms)
+        if postgres:
+            row += measure_queries(legacy_rows, repeat)
+        rows.append(row)
+
+    header = ('Участников на фильм', 'Строк прежнего запроса', 'Прежний transform, мс',
+              'Строк текущего запроса', 'Текущий transform, мс')
+    if postgres:
+        header += ('Прежний запрос + transform, мс', 'Текущий запрос + transform, мс')
+    print(f'Фильмов: {films_count}, жанров на фильм: {GENRES_PER_FILM}')
+    print_table(header, rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--films', type=int, default=5, help='Количество фильмов')
+    parser.add_argument('--repeat', type=int, default=3, help='Количество запусков каждого варианта')
+    parser.add_argument('--postgres', action='store_true', help='Замерить также запросы к БД movies')
+    arguments = parser.parse_args()
+    main(arguments.films, arguments.repeat, arguments.postgres)
@@ -7,6 +7,9 @@ class Settings(BaseSettings):
     DJANGO_DEBUG: Optional[bool]
     DJANGO_SECRET_KEY: Optional[str]
     DJANGO_ALLOWED_HOSTS: Optional[str]
+    DJANGO_CACHE_TABLE: Optional[str] = None
+    MOVIES_API_COUNT_STRATEGY: Optional[str] = None
+    MOVIES_API_COUNT_CACHE_TIMEOUT: Optional[int] = None
 
     # PostgreSQL
     POSTGRES_DB_NAME: str
@@ -15,6 +18,7 @@ class Settings(BaseSettings):
     POSTGRES_DB_HOST: str
     POSTGRES_DB_PORT: str
     POSTGRES_DB_OPTS: str
+    POSTGRES_POOL_MAX_SIZE: int = 3
 
     # SQLite
     SQLITE_DB_NAME: Optional[str]
@@ -25,11 +29,36 @@ class Settings(BaseSettings):
     ELASTIC_INDEX: str
     ELASTIC_INDEX_FILE: str
     ELASTIC_INDEX_TIMEOUT: int
+    ELASTIC_POOL_SIZE: int = 10
+    ELASTIC_HTTP_COMPRESS: bool = True
+    ELASTIC_REQUEST_TIMEOUT: int = 30
+    ELASTIC_BULK_MAX_BYTES: int = 10 * 1024 * 1024
+    ELASTIC_BULK_THREADS: int = 4
+    ELASTIC_BULK_RETRY_MAX: int = 10
+    ELASTIC_DEAD_LETTER_FILENAME: str = 'dead_letter.ndjson'
+    ELASTIC_INDEX_REPLICAS: int = 1
+    ELASTIC_INDEX_KEEP_VERSIONS: int = 1
 
     # ETL
     ETL_STATE_FILENAME: str
+    ETL_STATE_SAVE_INTERVAL_SEC: float = 0
+    ETL_STATE_CHECKPOINT_LOG: str = ''
+    ETL_CONTENT_HASH_ENABLED: bool = True
+    ETL_CONTENT_HASH_FILENAME: str = 'content_hash.sqlite'
     ETL_TIMEOUT_SEC: int
+    ETL_TIMEOUT_MAX_SEC: int = 60
     ETL_EXTRACT_BATCH: int
+    ETL_FANOUT_BATCH: int = 1000
+    ETL_PARTIAL_UPDATES_ENABLED: bool = False
+    ETL_LISTEN_ENABLED: bool = False
+    ETL_NOTIFY_BATCH: int = 1000
+    ETL_PIPELINE_ENABLED: bool = False
+    ETL_PIPELINE_QUEUE_SIZE: int = 2
+    ETL_SHARDING_ENABLED: bool = False
+    ETL_SHARDS_MAX: int = 3
+    ETL_REINDEX_WORKERS: int = 4
+    ETL_REINDEX_BATCH: int = 1000
+    ETL_REINDEX_BLUE_GREEN: bool = True
     ETL_LOAD_BATCH: int
 
     @property
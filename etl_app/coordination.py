@@ -0,0 +1,118 @@
+"""Распределение источников изменений между несколькими процессами ETL.
+
+Каждый источник изменений (film_work, person, genre) - отдельный шард. Процесс ETL
+захватывает шарды сессионными advisory блокировками PostgreSQL и извлекает изменения
+только из своих шардов. Если процесс падает, PostgreSQL снимает его блокировки вместе
+с соединением, и освободившиеся шарды захватывают оставшиеся процессы на следующей итерации.
+
+Каждый процесс держит разделяемую блокировку участника, по ней считается количество процессов.
+Процесс держит не больше своей доли шардов (округление вверх), лишние шарды освобождаются,
+когда запускаются новые процессы, и их захватывают процессы, у которых шардов меньше доли.
+
+Состояние каждого шарда хранится отдельной строкой в таблице content.etl_state,
+поэтому процессы сохраняют контрольные точки независимо друг от друга.
+"""
+
+from typing import Callable, Optional
+
+from etl_app.extract.postgres import PostgresDB
+from etl_app.logger import logger
+
+# Шарды в порядке захвата
+SHARDS = ('filmwork', 'person', 'genre')
+
+# Ключи состояния ETL, которые принадлежат шарду
+SHARD_STATE_KEYS = {
+    'filmwork': ('state_filmwork_modified', 'state_filmwork_id'),
+    'person': ('state_person_modified', 'state_person_id', 'state_person_fanout'),
+    'genre': ('state_genre_modified', 'state_genre_id', 'state_genre_fanout'),
+}
+
+# Первая часть ключа advisory блокировок шардов ETL, вторая часть - номер шарда
+LOCK_CLASS_ID = 0x45544C
+
+# Ключ разделяемой advisory блокировки, которую держит каждый процесс ETL
+MEMBERS_LOCK_CLASS_ID = 0x45544D
+MEMBERS_LOCK_OBJECT_ID = 0
+
+
+class ShardLeases:
+    """Шарды, захваченные текущим процессом ETL.
+
+    :param movies_db: Объект пула подключений к БД, блокировки держит его отдельное соединение.
+    :param max_shards: Сколько шардов может захватить один процесс, даже если он работает один.
+    """
+
+    def __init__(self, movies_db: PostgresDB, max_shards: int = len(SHARDS)) -> None:
+        self.movies_db = movies_db
+        self.max_shards = max_shards
+        self.owned = set()
+        self.member = False
+
+    def get_fair_share(self) -> int:
+        """Доля шардов текущего процесса.
+
+        :return: Количество шардов на процесс с округлением вверх, но не больше max_shards.
+        """
+        if not self.member:
+            self.member = self.movies_db.try_advisory_lock_shared(MEMBERS_LOCK_CLASS_ID, MEMBERS_LOCK_OBJECT_ID)
+        members = max(1, self.movies_db.count_advisory_lock_holders(MEMBERS_LOCK_CLASS_ID, MEMBERS_LOCK_OBJECT_ID))
+        return min(self.max_shards, -(-len(SHARDS) // members))
+
+    def release_extra(self, fair_share: int, before_release: Optional[Callable[[], None]] = None) -> set[str]:
+        """Освобождение шардов сверх доли процесса, начиная с последних по порядку.
+
+        Новый владелец шарда продолжит с его сохраненного состояния.
+
+        :param fair_share: Доля шардов текущего процесса.
+        :param before_release: Вызывается перед освобождением, чтобы сохранить отложенное состояние шардов.
+        :return: Множество освобожденных шардов.
+        """
+        owned = list(shard for shard in SHARDS if shard in self.owned)
+        released = set(owned[fair_share:])
+        if not released:
+            return released
+
+        if before_release is not None:
+            before_release()
+        for shard in released:
+            self.movies_db.advisory_unlock(LOCK_CLASS_ID, SHARDS.index(shard))
+            self.owned.discard(shard)
+        logger.info(f' Освобождены шарды {sorted(released)}, обрабатываются {sorted(self.owned)}')
+        return released
+
+    def refresh(self, before_release: Optional[Callable[[], None]] = None) -> set[str]:
+        """Проверка захваченных шардов, освобождение лишних и захват свободных в пределах доли.
+
+        :param before_release: Вызывается перед освобождением лишних шардов.
+        :return: Множество шардов, захваченных при этом вызове, их состояние нужно перечитать.
+        """
+        if (self.owned or self.member) and not self.movies_db.check_advisory_locks():
+            logger.warning(f' - Блокировки шардов потеряны: {sorted(self.owned)}')
+            self.owned.clear()
+            self.member = False
+
+        acquired = set()
+        try:
+            fair_share = self.get_fair_share()
+            self.release_extra(fair_share, before_release)
+        except Exception as err:
+            logger.warning(f' - Ошибка подсчета процессов ETL: {err}')
+            return acquired
+
+        for shard_number, shard in enumerate(SHARDS):
+            if len(self.owned) >= fair_share:
+                break
+            if shard in self.owned:
+                continue
+            try:
+                if self.movies_db.try_advisory_lock(LOCK_CLASS_ID, shard_number):
+                    self.owned.add(shard)
+                    acquired.add(shard)
+            except Exception as err:
+                logger.warning(f' - Ошибка захвата шарда {shard}: {err}')
+                break
+
+        if acquired:
+            logger.info(f' Захвачены шарды {sorted(acquired)}, обрабатываются {sorted(self.owned)}')
+        return acquired
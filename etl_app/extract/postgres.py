@@ -1,12 +1,28 @@
+import select
+from collections import Counter
+from contextlib import contextmanager
+from threading import Lock
+from typing import Optional, Sequence
+from weakref import WeakKeyDictionary
+
 import psycopg2
 from backoff import on_exception, expo
+from psycopg2.errors import InvalidSqlStatementName
 from psycopg2.extras import NamedTupleCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+from etl_app.logger import logger
 
 
 class PostgresDB:
     """Класс работы с БД.
-    Можно его будет при желании переписать на функции через try-finally и два with.
-    Но пока и так сойдет.
+
+    Держит пул соединений на всё время работы ETL, соединения переиспользуются
+    между итерациями. Пул открывает сразу max_connections соединений и держит их все:
+    psycopg2 закрывает возвращенное соединение, если свободных уже minconn, и при
+    меньшем minconn соединения открывались бы и закрывались заново при каждой
+    одновременной выдаче. Разорванное соединение выбрасывается из пула, а запрос
+    повторяется на новом соединении через backoff.
     """
 
     def __init__(
@@ -15,56 +31,331 @@ class PostgresDB:
             password: str,
             host: str,
             port: str,
-            database: str
+            database: str,
+            max_connections: int = 1,
     ):
         self.user = user
         self.password = password
         self.host = host
         self.port = port
         self.database = database
-        self._connection = None
-        self._cursor = None
+        self.max_connections = max_connections
+        self._pool = None
+        # Имена подготовленных запросов для каждого соединения пула. Ключ - сам объект
+        # соединения, а не id(): id закрытого соединения может достаться новому
+        self._prepared = WeakKeyDictionary()
+        # Статистика использования соединений
+        self._stats = Counter()
+        self._lock = Lock()
+        # Отдельное соединение для LISTEN, не входит в пул
+        self._listen_connection = None
+        self._listen_channel = None
+        # Соединение с открытой транзакцией в снимке данных, используется вместо пула
+        self._snapshot_connection = None
+        # Отдельное соединение для advisory блокировок, блокировки живут, пока оно открыто
+        self._lock_connection = None
         self._init()
 
     @on_exception(expo, Exception)
-    def connect(self):
-        if not self._connection:
-            self._connection = psycopg2.connect(
+    def connect(self) -> ThreadedConnectionPool:
+        if not self._pool or self._pool.closed:
+            self._pool = ThreadedConnectionPool(
+                self.max_connections,
+                self.max_connections,
                 user=self.user,
                 password=self.password,
                 host=self.host,
                 port=self.port,
                 database=self.database,
             )
-            return self._connection
-        return self._connection
+        return self._pool
 
-    @on_exception(expo, Exception)
-    def cursor(self):
-        if not self._cursor or self._cursor.closed:
-            if not self._connection:
-                self.connect()
-            self._cursor = self._connection.cursor(cursor_factory=NamedTupleCursor)
-            return self._cursor
-        return self._cursor
+    @contextmanager
+    def connection(self):
+        """Получение соединения из пула на время работы с ним.
 
-    @on_exception(expo, Exception)
-    def execute(self, sql: str):
+        Если соединение разорвано, оно закрывается и не возвращается в пул.
+        Транзакцию в снимке данных после разрыва соединения восстановить нельзя.
+        """
+        if self._snapshot_connection:
+            try:
+                yield self._snapshot_connection
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as err:
+                raise RuntimeError(f'Соединение со снимком данных разорвано: {err}') from err
+            return
+
+        connection = self._checkout()
+        broken = False
+        try:
+            yield connection
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            if broken:
+                self._discard(connection)
+            else:
+                self._pool.putconn(connection)
+
+    @on_exception(expo, (psycopg2.OperationalError, psycopg2.InterfaceError))
+    def execute(self, sql: str, params: Optional[Sequence] = None):
+        with self.connection() as connection:
+            return self._execute(connection, sql, params)
+
+    @on_exception(expo, (psycopg2.OperationalError, psycopg2.InterfaceError))
+    def execute_prepared(self, name: str, sql: str, params: Sequence, param_types: Sequence[str]):
+        """Выполнение подготовленного на стороне сервера запроса.
+
+        Запрос подготавливается (PREPARE) один раз на соединение пула,
+        далее выполняется через EXECUTE с переданными параметрами. Если сервер
+        не знает запрос (например, после DISCARD ALL или переподключения за pgbouncer),
+        запрос подготавливается заново.
+
+        :param name: Имя подготовленного запроса.
+        :param sql: Текст запроса с позиционными параметрами $1, $2, ...
+        :param params: Значения параметров запроса.
+        :param param_types: Типы параметров запроса в PostgreSQL, например ('uuid[]',).
+        :return: Список строк результата запроса.
+        """
+        # Явное приведение нужно для массивов: psycopg2 передает список строк как text[]
+        placeholders = ', '.join(f'%s::{param_type}' for param_type in param_types)
+        with self.connection() as connection:
+            prepared = self._prepared.setdefault(connection, set())
+            if name not in prepared:
+                self._prepare(connection, name, sql, param_types)
+                prepared.add(name)
+            try:
+                return self._execute(connection, f'execute {name} ({placeholders})', params)
+            except InvalidSqlStatementName:
+                if connection is self._snapshot_connection:
+                    # Ошибка прервала транзакцию снимка, повторить запрос в ней нельзя
+                    raise
+                logger.warning(f' - Подготовленный запрос {name} не найден на сервере, повторная подготовка')
+                self._prepare(connection, name, sql, param_types)
+                return self._execute(connection, f'execute {name} ({placeholders})', params)
+
+    def export_snapshot(self) -> str:
+        """Начать транзакцию REPEATABLE READ и экспортировать её снимок данных.
+
+        Транзакция держится на отдельном соединении до close(), все запросы
+        этого объекта выполняются в ней, а другие процессы могут читать данные
+        в этом же снимке через import_snapshot.
+
+        :return: Идентификатор снимка для import_snapshot.
+        """
+        connection = self._begin_snapshot()
+        with connection.cursor() as cursor:
+            cursor.execute('select pg_export_snapshot()')
+            return cursor.fetchone()[0]
+
+    def import_snapshot(self, snapshot_id: str) -> None:
+        """Читать данные в снимке, экспортированном другим соединением.
+
+        Транзакция держится на отдельном соединении до close(),
+        все запросы этого объекта выполняются в ней.
+
+        :param snapshot_id: Идентификатор снимка из export_snapshot.
+        """
+        connection = self._begin_snapshot()
+        with connection.cursor() as cursor:
+            cursor.execute('set transaction snapshot %s', (snapshot_id,))
+
+    @on_exception(expo, (psycopg2.OperationalError, psycopg2.InterfaceError))
+    def listen(self, channel: str) -> None:
+        """Подписка на уведомления канала через отдельное соединение.
+
+        :param channel: Имя канала NOTIFY.
+        """
+        self._listen_channel = channel
+        if self._listen_connection and not self._listen_connection.closed:
+            self._listen_connection.close()
+        self._listen_connection = self._connect_outside_pool()
+        with self._listen_connection.cursor() as cursor:
+            cursor.execute(f'listen {channel}')
+
+    def wait_notifies(self, timeout: float) -> list[str]:
+        """Ожидание уведомлений канала не дольше timeout секунд.
+
+        Если соединение разорвано, подписка восстанавливается, а пропущенные
+        за это время изменения подберет опрос таблиц по состоянию.
+
+        :param timeout: Максимальное время ожидания в секундах.
+        :return: Список payload полученных уведомлений, пустой если уведомлений не было.
+        """
+        connection = self._listen_connection
         try:
-            self._cursor.execute(sql)
-            return self._cursor.fetchall()
-        except Exception as err:
-            self._connection.rollback()
+            connection.poll()
+            if not connection.notifies:
+                if select.select([connection], [], [], timeout) != ([], [], []):
+                    connection.poll()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as err:
+            logger.warning(f' - Соединение LISTEN разорвано, повторная подписка: {err}')
+            self.listen(self._listen_channel)
+            return list()
+
+        payloads = list(notify.payload for notify in connection.notifies)
+        connection.notifies.clear()
+        return payloads
+
+    def try_advisory_lock(self, class_id: int, object_id: int) -> bool:
+        """Попытка захватить сессионную advisory блокировку без ожидания.
+
+        Блокировки берутся на отдельном соединении и держатся, пока оно открыто.
+        При разрыве соединения или завершении процесса PostgreSQL снимает их сам.
+
+        :param class_id: Первая часть ключа блокировки.
+        :param object_id: Вторая часть ключа блокировки.
+        :return: Вернуть True, если блокировка захвачена.
+        """
+        if self._lock_connection is None or self._lock_connection.closed:
+            self._lock_connection = self._connect_outside_pool()
+        with self._lock_connection.cursor() as cursor:
+            cursor.execute('select pg_try_advisory_lock(%s, %s)', (class_id, object_id))
+            return cursor.fetchone()[0]
+
+    def try_advisory_lock_shared(self, class_id: int, object_id: int) -> bool:
+        """Попытка захватить разделяемую сессионную advisory блокировку без ожидания.
+
+        Разделяемую блокировку одновременно держат все процессы, по ней их можно посчитать.
+
+        :param class_id: Первая часть ключа блокировки.
+        :param object_id: Вторая часть ключа блокировки.
+        :return: Вернуть True, если блокировка захвачена.
+        """
+        if self._lock_connection is None or self._lock_connection.closed:
+            self._lock_connection = self._connect_outside_pool()
+        with self._lock_connection.cursor() as cursor:
+            cursor.execute('select pg_try_advisory_lock_shared(%s, %s)', (class_id, object_id))
+            return cursor.fetchone()[0]
+
+    def advisory_unlock(self, class_id: int, object_id: int) -> bool:
+        """Освобождение сессионной advisory блокировки.
+
+        :param class_id: Первая часть ключа блокировки.
+        :param object_id: Вторая часть ключа блокировки.
+        :return: Вернуть True, если блокировка была захвачена этим процессом и освобождена.
+        """
+        if self._lock_connection is None or self._lock_connection.closed:
+            return False
+        with self._lock_connection.cursor() as cursor:
+            cursor.execute('select pg_advisory_unlock(%s, %s)', (class_id, object_id))
+            return cursor.fetchone()[0]
+
+    def count_advisory_lock_holders(self, class_id: int, object_id: int) -> int:
+        """Количество соединений, которые держат advisory блокировку в текущей БД.
+
+        :param class_id: Первая часть ключа блокировки.
+        :param object_id: Вторая часть ключа блокировки.
+        :return: Количество соединений с захваченной блокировкой.
+        """
+        rows = self.execute(
+            """
+            select count(*) as holders
+            from pg_locks
+            where locktype = 'advisory'
+              and database = (select oid from pg_database where datname = current_database())
+              and classid::bigint = %s
+              and objid::bigint = %s
+              and objsubid = 2
+              and granted
+            """,
+            (class_id, object_id),
+        )
+        return rows[0].holders if rows else 0
+
+    def check_advisory_locks(self) -> bool:
+        """Проверка соединения advisory блокировок.
+
+        :return: Вернуть False, если соединение разорвано и все блокировки потеряны.
+        """
+        if self._lock_connection is None or self._lock_connection.closed:
+            return False
+        try:
+            with self._lock_connection.cursor() as cursor:
+                cursor.execute('select 1')
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as err:
+            logger.warning(f' - Соединение advisory блокировок разорвано: {err}')
+            self._lock_connection.close()
+            self._lock_connection = None
+            return False
+
+    def log_stats(self) -> None:
+        """Вывод статистики переиспользования соединений."""
+        checkouts = self._stats['checkouts']
+        opened = self._stats['opened']
+        logger.info(
+            f' - Соединения с БД: выдано {checkouts}, открыто {opened}, '
+            f'переиспользовано {checkouts - opened}, разорвано {self._stats["discarded"]}'
+        )
 
     @on_exception(expo, Exception)
     def close(self):
-        if self._connection:
-            if self._cursor:
-                self._cursor.close()
-                self._cursor = None
-            self._connection.close()
-            self._connection = None
+        if self._listen_connection and not self._listen_connection.closed:
+            self._listen_connection.close()
+        self._listen_connection = None
+        if self._lock_connection and not self._lock_connection.closed:
+            self._lock_connection.close()
+        self._lock_connection = None
+        self._snapshot_connection = None
+        if self._pool and not self._pool.closed:
+            self._pool.closeall()
+        self._pool = None
+        self._prepared = WeakKeyDictionary()
+
+    @staticmethod
+    def _execute(connection, sql: str, params: Optional[Sequence] = None):
+        # Ошибки запроса пробрасываются: пустой результат вместо ошибки
+        # выглядит для ETL как отсутствие изменений
+        with connection.cursor(cursor_factory=NamedTupleCursor) as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    @staticmethod
+    def _prepare(connection, name: str, sql: str, param_types: Sequence[str]) -> None:
+        with connection.cursor() as cursor:
+            cursor.execute(f'prepare {name} ({", ".join(param_types)}) as {sql}')
+
+    @on_exception(expo, (psycopg2.OperationalError, psycopg2.InterfaceError))
+    def _checkout(self):
+        connection = self.connect().getconn()
+        if connection.closed:
+            self._discard(connection)
+            connection = self._pool.getconn()
+        with self._lock:
+            self._stats['checkouts'] += 1
+            if connection not in self._prepared:
+                # ETL только читает данные, незакрытые транзакции между итерациями не нужны
+                connection.autocommit = True
+                self._prepared[connection] = set()
+                self._stats['opened'] += 1
+        return connection
+
+    def _connect_outside_pool(self):
+        connection = psycopg2.connect(
+            user=self.user,
+            password=self.password,
+            host=self.host,
+            port=self.port,
+            database=self.database,
+        )
+        connection.autocommit = True
+        return connection
+
+    def _begin_snapshot(self):
+        # Пул откатывает незавершенные транзакции при возврате соединения,
+        # поэтому соединение со снимком забирается из пула до close()
+        connection = self._checkout()
+        with connection.cursor() as cursor:
+            cursor.execute('begin isolation level repeatable read read only')
+        self._snapshot_connection = connection
+        return connection
+
+    def _discard(self, connection) -> None:
+        with self._lock:
+            self._prepared.pop(connection, None)
+            self._stats['discarded'] += 1
+        self._pool.putconn(connection, close=True)
 
     def _init(self):
         self.connect()
-        self.cursor()
@@ -1,124 +1,244 @@
-def get_filmworks_query(state_modified: str = '', batch: int = 100) -> str:
+"""SQL запросы для извлечения данных.
+
+Запросы используют позиционные параметры ($1, $2, ...) и выполняются как
+подготовленные на стороне сервера (PREPARE / EXECUTE), поэтому текст запроса
+не меняется от итерации к итерации и PostgreSQL не планирует его заново.
+Списки UUID передаются одним параметром-массивом через = any($1::uuid[]).
+"""
+
+
+def get_filmworks_query() -> str:
     """Подготовка SQL запроса для получения измененных фильмов.
 
-    :param state_modified: Последняя обработанная запись.
-    :param batch: Сколько записей за раз запрашивать.
+    Записи выбираются по ключу (modified, id), поэтому записи с одинаковым modified
+    на границе батча не теряются.
+
+    Параметры: $1 - modified последней обработанной записи, $2 - UUID последней обработанной записи,
+    $3 - сколько записей за раз запрашивать.
+
     :return: Подготовленный SQL запрос.
     """
-    if state_modified:
-        filmworks_query = f"""
-        select id, modified from content.film_work
-        where modified > '{state_modified}'
-        order by modified limit {batch};
-        """
-    else:
-        filmworks_query = f"""
-        select id, modified from content.film_work
-        order by modified limit {batch};
-        """
+    filmworks_query = """
+    select id, modified from content.film_work
+    where (modified, id) > ($1::timestamptz, $2::uuid)
+    order by modified, id limit $3::integer
+    """
     return filmworks_query
 
 
-def get_persons_query(state_modified: str = '', batch: int = 100) -> str:
+def get_persons_query() -> str:
     """Подготовка SQL запроса для получения измененных участников фильмов.
 
-    :param state_modified: Последняя обработанная запись.
-    :param batch: Сколько записей за раз запрашивать.
+    Записи выбираются по ключу (modified, id), поэтому записи с одинаковым modified
+    на границе батча не теряются.
+
+    Параметры: $1 - modified последней обработанной записи, $2 - UUID последней обработанной записи,
+    $3 - сколько записей за раз запрашивать.
+
     :return: Подготовленный SQL запрос.
     """
-    if state_modified:
-        persons_query = f"""
-        select id, modified from content.person
-        where modified > '{state_modified}'
-        order by modified limit {batch};
-        """
-    else:
-        persons_query = f"""
-        select id, modified from content.person
-        order by modified limit {batch};
-        """
+    persons_query = """
+    select id, modified from content.person
+    where (modified, id) > ($1::timestamptz, $2::uuid)
+    order by modified, id limit $3::integer
+    """
     return persons_query
 
 
-def get_genres_query(state_modified: str = '', batch: int = 100) -> str:
+def get_genres_query() -> str:
     """Подготовка SQL запроса для получения измененных жанров фильмов.
 
-    :param state_modified: Последняя обработанная запись.
-    :param batch: Сколько записей за раз запрашивать.
+    Записи выбираются по ключу (modified, id), поэтому записи с одинаковым modified
+    на границе батча не теряются.
+
+    Параметры: $1 - modified последней обработанной записи, $2 - UUID последней обработанной записи,
+    $3 - сколько записей за раз запрашивать.
+
     :return: Подготовленный SQL запрос.
     """
-    if state_modified:
-        persons_query = f"""
-        select id, modified from content.genre
-        where modified > '{state_modified}'
-        order by modified limit {batch};
-        """
-    else:
-        persons_query = f"""
-        select id, modified from content.genre
-        order by modified limit {batch};
-        """
-    return persons_query
+    genres_query = """
+    select id, modified from content.genre
+    where (modified, id) > ($1::timestamptz, $2::uuid)
+    order by modified, id limit $3::integer
+    """
+    return genres_query
 
 
-def get_filmworks_query_by_person_uuid(persons: str) -> str:
+def get_filmworks_query_by_person_uuid() -> str:
     """Подготовка SQL запроса для получения фильмов на которые повлияло изменение их участников.
 
-    :param persons: Строка UUID участников фильмов через запятую.
+    Фильмы выбираются порциями в порядке UUID, начиная после последнего обработанного фильма.
+
+    Параметры: $1 - массив UUID участников фильмов, $2 - UUID последнего обработанного фильма,
+    $3 - сколько фильмов за раз запрашивать.
+
     :return: Подготовленный SQL запрос.
     """
-    filmworks_query = f"""
-    select fw.id, modified
-    from content.film_work fw
-    left join content.person_film_work pfw 
-        on pfw.film_work_id = fw.id
-    where pfw.person_id in ('{persons}')
-    order by fw.modified;
+    filmworks_query = """
+    select distinct pfw.film_work_id as id
+    from content.person_film_work pfw
+    where pfw.person_id = any($1::uuid[])
+        and pfw.film_work_id > $2::uuid
+    order by pfw.film_work_id
+    limit $3::integer
     """
     return filmworks_query
 
 
-def get_filmworks_query_by_genre_uuid(genres: str) -> str:
+def get_filmworks_query_by_genre_uuid() -> str:
     """Подготовка SQL запроса для получения фильмов на которые повлияло изменение жанра.
 
-    :param genres: Строка UUID жанров фильмов через запятую.
+    Фильмы выбираются порциями в порядке UUID, начиная после последнего обработанного фильма.
+
+    Параметры: $1 - массив UUID жанров фильмов, $2 - UUID последнего обработанного фильма,
+    $3 - сколько фильмов за раз запрашивать.
+
     :return: Подготовленный SQL запрос.
     """
-    filmworks_query = f"""
-    select fw.id, modified
-    from content.film_work fw
-    left join content.genre_film_work gfw 
-        on gfw.film_work_id = fw.id
-    where gfw.genre_id in ('{genres}')
-    order by fw.modified;
+    filmworks_query = """
+    select distinct gfw.film_work_id as id
+    from content.genre_film_work gfw
+    where gfw.genre_id = any($1::uuid[])
+        and gfw.film_work_id > $2::uuid
+    order by gfw.film_work_id
+    limit $3::integer
     """
     return filmworks_query
 
 
-def get_filmworks_additional_query_by_filmwork_uuid(filmworks: str) -> str:
+def get_filmworks_query_by_uuid_range() -> str:
+    """Подготовка SQL запроса для получения фильмов из диапазона UUID.
+
+    Используется при полной переиндексации, фильмы выбираются порциями в порядке UUID.
+
+    Параметры: $1 - UUID последнего обработанного фильма, $2 - верхняя граница диапазона UUID
+    включительно, $3 - сколько фильмов за раз запрашивать.
+
+    :return: Подготовленный SQL запрос.
+    """
+    filmworks_query = """
+    select id from content.film_work
+    where id > $1::uuid and id <= $2::uuid
+    order by id
+    limit $3::integer
+    """
+    return filmworks_query
+
+
+def get_filmworks_additional_query_by_filmwork_uuid() -> str:
     """Подготовка SQL запроса для получения дополнительной информации по фильмам, которые изменились.
 
-    :param filmworks: Строка UUID фильмов через запятую, для которых требуется собрать дополнительную информацию.
+    Жанры и участники агрегируются на стороне БД в отдельных lateral подзапросах,
+    поэтому каждый фильм возвращается ровно одной строкой без декартова произведения
+    участников на жанры. Персона встречается в фильме в одной роли не более одного раза
+    (уникальность person_film_work), поэтому актеры и сценаристы агрегируются без distinct,
+    а имена и объекты упорядочены одинаково по UUID персоны. Жанры и режиссеры упорядочены по имени.
+
+    Параметры: $1 - массив UUID фильмов, для которых требуется собрать дополнительную информацию.
+
     :return: Подготовленный SQL запрос.
     """
-    filmworks_additional_query = f"""
+    filmworks_additional_query = """
     select
-        fw.id as fw_id, 
-        fw.title, 
-        fw.description, 
-        fw.rating, 
-        fw.type, 
-        fw.created, 
-        fw.modified, 
-        pfw.role, 
-        p.id, 
-        p.full_name,
-        g.name
+        fw.id as fw_id,
+        fw.title,
+        fw.description,
+        fw.rating,
+        fw.type,
+        fw.created,
+        fw.modified,
+        coalesce(g.genres, '{}') as genres,
+        coalesce(p.directors, '{}') as directors,
+        coalesce(p.actors_names, '{}') as actors_names,
+        coalesce(p.writers_names, '{}') as writers_names,
+        coalesce(p.actors, '[]') as actors,
+        coalesce(p.writers, '[]') as writers
     from content.film_work fw
-    left join content.person_film_work pfw on pfw.film_work_id = fw.id
-    left join content.person p on p.id = pfw.person_id
-    left join content.genre_film_work gfw on gfw.film_work_id = fw.id
-    left join content.genre g on g.id = gfw.genre_id
-    where fw.id in ('{filmworks}');
+    left join lateral (
+        select array_agg(distinct g.name) as genres
+        from content.genre_film_work gfw
+        join content.genre g on g.id = gfw.genre_id
+        where gfw.film_work_id = fw.id
+    ) g on true
+    left join lateral (
+        select
+            array_agg(distinct p.full_name)
+                filter (where pfw.role = 'director') as directors,
+            array_agg(p.full_name order by p.id)
+                filter (where pfw.role = 'actor') as actors_names,
+            array_agg(p.full_name order by p.id)
+                filter (where pfw.role = 'writer') as writers_names,
+            jsonb_agg(jsonb_build_object('id', p.id, 'name', p.full_name) order by p.id)
+                filter (where pfw.role = 'actor') as actors,
+            jsonb_agg(jsonb_build_object('id', p.id, 'name', p.full_name) order by p.id)
+                filter (where pfw.role = 'writer') as writers
+        from content.person_film_work pfw
+        join content.person p on p.id = pfw.person_id
+        where pfw.film_work_id = fw.id
+    ) p on true
+    where fw.id = any($1::uuid[])
     """
     return filmworks_additional_query
+
+
+def get_filmworks_persons_query_by_filmwork_uuid() -> str:
+    """Подготовка SQL запроса для получения участников фильмов, затронутых изменением персон.
+
+    Облегченная версия get_filmworks_additional_query_by_filmwork_uuid: возвращает только
+    поля участников, без названия, описания и жанров фильма.
+
+    Параметры: $1 - массив UUID фильмов.
+
+    :return: Подготовленный SQL запрос.
+    """
+    filmworks_persons_query = """
+    select
+        fw.id as fw_id,
+        coalesce(p.directors, '{}') as directors,
+        coalesce(p.actors_names, '{}') as actors_names,
+        coalesce(p.writers_names, '{}') as writers_names,
+        coalesce(p.actors, '[]') as actors,
+        coalesce(p.writers, '[]') as writers
+    from content.film_work fw
+    left join lateral (
+        select
+            array_agg(distinct p.full_name)
+                filter (where pfw.role = 'director') as directors,
+            array_agg(p.full_name order by p.id)
+                filter (where pfw.role = 'actor') as actors_names,
+            array_agg(p.full_name order by p.id)
+                filter (where pfw.role = 'writer') as writers_names,
+            jsonb_agg(jsonb_build_object('id', p.id, 'name', p.full_name) order by p.id)
+                filter (where pfw.role = 'actor') as actors,
+            jsonb_agg(jsonb_build_object('id', p.id, 'name', p.full_name) order by p.id)
+                filter (where pfw.role = 'writer') as writers
+        from content.person_film_work pfw
+        join content.person p on p.id = pfw.person_id
+        where pfw.film_work_id = fw.id
+    ) p on true
+    where fw.id = any($1::uuid[])
+    """
+    return filmworks_persons_query
+
+
+def get_filmworks_genres_query_by_filmwork_uuid() -> str:
+    """Подготовка SQL запроса для получения жанров фильмов, затронутых изменением жанров.
+
+    Параметры: $1 - массив UUID фильмов.
+
+    :return: Подготовленный SQL запрос.
+    """
+    filmworks_genres_query = """
+    select
+        fw.id as fw_id,
+        coalesce(g.genres, '{}') as genres
+    from content.film_work fw
+    left join lateral (
+        select array_agg(distinct g.name) as genres
+        from content.genre_film_work gfw
+        join content.genre g on g.id = gfw.genre_id
+        where gfw.film_work_id = fw.id
+    ) g on true
+    where fw.id = any($1::uuid[])
+    """
+    return filmworks_genres_query
@@ -1,4 +1,5 @@
-from typing import Any, Tuple
+import json
+from typing import Any, Callable, Iterable, Optional, Tuple
 
 from etl_app.config import settings
 from etl_app.extract.postgres import PostgresDB
@@ -8,18 +9,30 @@ from etl_app.extract.queries import (
     get_genres_query,
     get_filmworks_query_by_person_uuid,
     get_filmworks_query_by_genre_uuid,
+    get_filmworks_query_by_uuid_range,
     get_filmworks_additional_query_by_filmwork_uuid,
+    get_filmworks_persons_query_by_filmwork_uuid,
+    get_filmworks_genres_query_by_filmwork_uuid,
 )
 
+# Минимальный UUID, с него начинается выборка фильмов по измененным персонам и жанрам
+MIN_UUID = '00000000-0000-0000-0000-000000000000'
+
+# Канал уведомлений об изменениях, зашит в триггеры миграции movies 0004_add_etl_notify_triggers
+ETL_NOTIFY_CHANNEL = 'etl_changes'
+# Таблицы, уведомления которых содержат UUID фильма
+FILMWORK_NOTIFY_TABLES = ('film_work', 'person_film_work', 'genre_film_work')
+
 
 def get_movies_database():
-    """Получение объекта подключения к БД"""
+    """Получение объекта пула подключений к БД"""
     movies_db = PostgresDB(
         user=settings.POSTGRES_DB_USER,
         password=settings.POSTGRES_DB_PASS,
         host=settings.POSTGRES_DB_HOST,
         port=settings.POSTGRES_DB_PORT,
         database=settings.POSTGRES_DB_NAME,
+        max_connections=settings.POSTGRES_POOL_MAX_SIZE,
     )
     return movies_db
 
@@ -27,144 +40,276 @@ def get_movies_database():
 def get_filmworks(
         movies_db: PostgresDB,
         state_filmwork_modified: str = '',
+        state_filmwork_id: str = '',
         batch: int = 100
-) -> Tuple[list[Any], str]:
-    """Получение данных по измененным фильмам при изменении информации о фильме.
+) -> Tuple[list[tuple[str, dict]], bool]:
+    """Получение идентификаторов измененных фильмов при изменении информации о фильме.
 
     :param movies_db: Объект подключения к базе данных.
-    :param state_filmwork_modified: Последняя обработанная запись.
+    :param state_filmwork_modified: Время изменения последней обработанной записи.
+    :param state_filmwork_id: UUID последней обработанной записи.
     :param batch: Сколько записей за раз запрашивать.
-    :return: Кортеж из списка строк по измененным фильмам из БД и время изменения последней записи.
+    :return: Кортеж из контрольных точек по измененным фильмам в порядке (modified, id)
+             и признака того, что батч заполнен полностью и в таблице могут остаться изменения.
+             Контрольная точка - пара из UUID фильма и состояния, которое можно сохранить
+             после загрузки фильма.
     """
-    # Определим данные для результата
-    filmworks_additional_data = list()
+    # Получаем идентификаторы фильмов
+    filmworks_data = movies_db.execute_prepared(
+        'get_filmworks',
+        get_filmworks_query(),
+        (state_filmwork_modified or '-infinity', state_filmwork_id or MIN_UUID, batch),
+        ('timestamptz', 'uuid', 'integer'),
+    ) or list()
+    has_more = bool(filmworks_data) and len(filmworks_data) >= batch
 
-    # Получаем строку идентификаторов фильмов
-    filmworks_query = get_filmworks_query(
-        state_modified=state_filmwork_modified,
-        batch=batch
+    checkpoints = list(
+        (filmwork_uuid, {'state_filmwork_modified': modified.isoformat(), 'state_filmwork_id': filmwork_uuid})
+        for filmwork_uuid, modified in filmworks_data
     )
-    filmworks_data = movies_db.execute(filmworks_query)
-
-    if filmworks_data:
-        state_filmwork_modified = max(
-            modified
-            for filmwork_uuid, modified
-            in (data for data in filmworks_data)
-        )
-        filmworks_uuid_list = list(
-            filmwork_uuid
-            for filmwork_uuid, modified
-            in (data for data in filmworks_data)
-        )
-        filmworks_str = "', '".join(filmworks_uuid_list)
-
-        # Получим недостающую информацию для elasticsearch
-        filmworks_additional_query = get_filmworks_additional_query_by_filmwork_uuid(filmworks_str)
-        filmworks_additional_data = movies_db.execute(filmworks_additional_query)
-
-    return filmworks_additional_data, state_filmwork_modified
+    return checkpoints, has_more
 
 
 def get_filmworks_by_changed_persons(
         movies_db: PostgresDB,
         state_person_modified: str = '',
+        state_person_id: str = '',
+        state_person_fanout: Optional[dict] = None,
         batch: int = 100,
-):
-    """Получение данных по измененным фильмам при изменении информации об участниках фильма.
+        fanout_batch: int = 1000,
+) -> Tuple[list[tuple[Optional[str], dict]], bool]:
+    """Получение идентификаторов измененных фильмов при изменении информации об участниках фильма.
 
     :param movies_db: Объект подключения к базе данных.
-    :param state_person_modified: Последняя обработанная запись.
+    :param state_person_modified: Время изменения последней обработанной записи.
+    :param state_person_id: UUID последней обработанной записи.
+    :param state_person_fanout: Незавершенная выборка фильмов по измененным персонам.
     :param batch: Сколько записей за раз запрашивать.
-    :return: Кортеж из списка строк по измененным фильмам из БД и время изменения последней записи.
+    :param fanout_batch: Сколько фильмов измененных персон запрашивать за раз.
+    :return: Кортеж из контрольных точек по фильмам и признака того, что в таблице
+             или в выборке фильмов могут остаться изменения.
     """
-    # Определим данные для результата
-    filmworks_additional_data = list()
-
-    # Получаем строку идентификаторов персон
-    persons_query = get_persons_query(
+    return get_filmworks_by_fanout(
+        movies_db,
+        name='person',
+        get_changed_query=get_persons_query,
+        get_filmworks_query=get_filmworks_query_by_person_uuid,
         state_modified=state_person_modified,
-        batch=batch
+        state_id=state_person_id,
+        state_fanout=state_person_fanout,
+        batch=batch,
+        fanout_batch=fanout_batch,
     )
-    persons_data = movies_db.execute(persons_query)
-
-    if persons_data:
-        state_person_modified = max(
-            modified
-            for person_uuid, modified
-            in (data for data in persons_data)
-        )
-        persons_uuid_list = list(
-            person_uuid
-            for person_uuid, modified
-            in (data for data in persons_data)
-        )
-        persons_str = "', '".join(persons_uuid_list)
-
-        # Получим строку фильмов в которых присутствовали персоны
-        filmworks_query = get_filmworks_query_by_person_uuid(persons_str)
-        filmworks_data = movies_db.execute(filmworks_query)
-        filmworks_uuid_list = list(
-            filmwork_uuid
-            for filmwork_uuid, modified
-            in (data for data in filmworks_data)
-        )
-        filmworks_str = "', '".join(filmworks_uuid_list)
-
-        # Получим недостающую информацию для elasticsearch
-        filmworks_additional_query = get_filmworks_additional_query_by_filmwork_uuid(filmworks_str)
-        filmworks_additional_data = movies_db.execute(filmworks_additional_query)
-
-    return filmworks_additional_data, state_person_modified
 
 
 def get_filmworks_by_changed_genre(
         movies_db: PostgresDB,
         state_genre_modified=None,
+        state_genre_id=None,
+        state_genre_fanout=None,
         batch=100,
-):
-    """Получение данных по измененным фильмам при изменении информации о жанрах фильма.
+        fanout_batch=1000,
+) -> Tuple[list[tuple[Optional[str], dict]], bool]:
+    """Получение идентификаторов измененных фильмов при изменении информации о жанрах фильма.
 
     :param movies_db: Объект подключения к базе данных.
-    :param state_genre_modified: Последняя обработанная запись.
+    :param state_genre_modified: Время изменения последней обработанной записи.
+    :param state_genre_id: UUID последней обработанной записи.
+    :param state_genre_fanout: Незавершенная выборка фильмов по измененным жанрам.
     :param batch: Сколько записей за раз запрашивать.
-    :return: Кортеж из списка строк по измененным фильмам из БД и время изменения последней записи.
+    :param fanout_batch: Сколько фильмов измененных жанров запрашивать за раз.
+    :return: Кортеж из контрольных точек по фильмам и признака того, что в таблице
+             или в выборке фильмов могут остаться изменения.
     """
-    # Определим данные для результата
-    filmworks_additional_data = list()
-
-    # Получаем строку идентификаторов жанров
-    genres_query = get_genres_query(
+    return get_filmworks_by_fanout(
+        movies_db,
+        name='genre',
+        get_changed_query=get_genres_query,
+        get_filmworks_query=get_filmworks_query_by_genre_uuid,
         state_modified=state_genre_modified,
-        batch=batch
+        state_id=state_genre_id,
+        state_fanout=state_genre_fanout,
+        batch=batch,
+        fanout_batch=fanout_batch,
     )
-    genres_data = movies_db.execute(genres_query)
 
-    if genres_data:
-        state_genre_modified = max(
-            modified
-            for genre_uuid, modified
-            in (data for data in genres_data)
-        )
-        genres_uuid_list = list(
-            genre_uuid
-            for genre_uuid, modified
-            in (data for data in genres_data)
-        )
-        genres_str = "', '".join(genres_uuid_list)
-
-        # Получим строку фильмов в которых присутствовали жанры
-        filmworks_query = get_filmworks_query_by_genre_uuid(genres_str)
-        filmworks_data = movies_db.execute(filmworks_query)
-        filmworks_uuid_list = list(
-            filmwork_uuid
-            for filmwork_uuid, modified
-            in (data for data in filmworks_data)
+
+def get_filmworks_by_fanout(
+        movies_db: PostgresDB,
+        name: str,
+        get_changed_query: Callable[[], str],
+        get_filmworks_query: Callable[[], str],
+        state_modified: str = '',
+        state_id: str = '',
+        state_fanout: Optional[dict] = None,
+        batch: int = 100,
+        fanout_batch: int = 1000,
+) -> Tuple[list[tuple[Optional[str], dict]], bool]:
+    """Получение фильмов, связанных с измененными персонами или жанрами, порциями.
+
+    Изменение одного популярного жанра затрагивает десятки тысяч фильмов, поэтому фильмы
+    выбираются порциями по fanout_batch. Пока выборка не завершена, набор измененных записей,
+    ключ (modified, id) последней из них и UUID последнего отданного фильма хранятся
+    в состоянии state_{name}_fanout, а state_{name}_modified и state_{name}_id не сдвигаются.
+    Они сдвигаются только контрольной точкой после последнего фильма последней порции.
+
+    :param movies_db: Объект подключения к базе данных.
+    :param name: Имя связанной таблицы, используется в именах подготовленных запросов и ключей состояния.
+    :param get_changed_query: Функция подготовки запроса измененных записей связанной таблицы.
+    :param get_filmworks_query: Функция подготовки запроса фильмов по UUID связанных записей.
+    :param state_modified: Время изменения последней обработанной записи.
+    :param state_id: UUID последней обработанной записи.
+    :param state_fanout: Незавершенная выборка фильмов.
+    :param batch: Сколько измененных записей за раз запрашивать.
+    :param fanout_batch: Сколько фильмов за раз запрашивать.
+    :return: Кортеж из контрольных точек по фильмам в порядке UUID и признака того,
+             что в таблице или в выборке фильмов могут остаться изменения. Последняя
+             контрольная точка завершенной выборки не привязана к фильму (UUID None).
+    """
+    fanout = dict(state_fanout) if state_fanout else dict()
+
+    if not fanout:
+        # Получаем идентификаторы измененных записей
+        changed_data = movies_db.execute_prepared(
+            f'get_{name}s',
+            get_changed_query(),
+            (state_modified or '-infinity', state_id or MIN_UUID, batch),
+            ('timestamptz', 'uuid', 'integer'),
         )
-        filmworks_str = "', '".join(filmworks_uuid_list)
+        if not changed_data:
+            return list(), False
+
+        last_changed_uuid, last_modified = changed_data[-1]
+        fanout = {
+            'uuid': list(changed_uuid for changed_uuid, modified in changed_data),
+            'modified': last_modified.isoformat(),
+            'id': last_changed_uuid,
+            'last_filmwork_uuid': '',
+            'has_more': len(changed_data) >= batch,
+        }
+
+    # Получим очередную порцию фильмов в которых присутствовали измененные записи
+    filmworks_data = movies_db.execute_prepared(
+        f'get_filmworks_by_{name}',
+        get_filmworks_query(),
+        (fanout['uuid'], fanout['last_filmwork_uuid'] or MIN_UUID, fanout_batch),
+        ('uuid[]', 'uuid', 'integer'),
+    ) or list()
+    checkpoints = list(
+        (data.id, {f'state_{name}_fanout': dict(fanout, last_filmwork_uuid=data.id)})
+        for data in filmworks_data
+    )
+
+    if len(checkpoints) >= fanout_batch:
+        return checkpoints, True
+
+    # Выборка завершена, после последнего фильма сдвигается состояние связанной таблицы
+    checkpoints.append((None, {
+        f'state_{name}_modified': fanout['modified'],
+        f'state_{name}_id': fanout.get('id', ''),
+        f'state_{name}_fanout': dict(),
+    }))
+    return checkpoints, fanout['has_more']
 
-        # Получим недостающую информацию для elasticsearch
-        filmworks_additional_query = get_filmworks_additional_query_by_filmwork_uuid(filmworks_str)
-        filmworks_additional_data = movies_db.execute(filmworks_additional_query)
 
-    return filmworks_additional_data, state_genre_modified
+def get_filmworks_by_uuid_range(
+        movies_db: PostgresDB,
+        last_filmwork_uuid: str,
+        upper_uuid: str,
+        batch: int = 1000,
+) -> list[str]:
+    """Получение очередной порции UUID фильмов из диапазона UUID.
+
+    :param movies_db: Объект подключения к базе данных.
+    :param last_filmwork_uuid: UUID последнего обработанного фильма, не включается в результат.
+    :param upper_uuid: Верхняя граница диапазона UUID включительно.
+    :param batch: Сколько фильмов за раз запрашивать.
+    :return: Список UUID фильмов в порядке возрастания.
+    """
+    filmworks_data = movies_db.execute_prepared(
+        'get_filmworks_by_uuid_range',
+        get_filmworks_query_by_uuid_range(),
+        (last_filmwork_uuid, upper_uuid, batch),
+        ('uuid', 'uuid', 'integer'),
+    ) or list()
+    return list(data.id for data in filmworks_data)
+
+
+def get_filmworks_additional_data(movies_db: PostgresDB, filmworks_uuid: Iterable[str]) -> list[Any]:
+    """Получение данных для elasticsearch по фильмам, по одной строке на фильм.
+
+    :param movies_db: Объект подключения к базе данных.
+    :param filmworks_uuid: UUID фильмов, для которых требуется собрать дополнительную информацию.
+    :return: Список строк по фильмам из БД.
+    """
+    filmworks_uuid_list = list(filmworks_uuid)
+    if not filmworks_uuid_list:
+        return list()
+
+    filmworks_additional_data = movies_db.execute_prepared(
+        'get_filmworks_additional',
+        get_filmworks_additional_query_by_filmwork_uuid(),
+        (filmworks_uuid_list,),
+        ('uuid[]',),
+    )
+    return filmworks_additional_data or list()
+
+
+def get_filmworks_persons_data(movies_db: PostgresDB, filmworks_uuid: Iterable[str]) -> list[Any]:
+    """Получение только участников фильмов для частичного обновления документов.
+
+    :param movies_db: Объект подключения к базе данных.
+    :param filmworks_uuid: UUID фильмов, затронутых изменением персон.
+    :return: Список строк по фильмам из БД.
+    """
+    filmworks_uuid_list = list(filmworks_uuid)
+    if not filmworks_uuid_list:
+        return list()
+
+    filmworks_persons_data = movies_db.execute_prepared(
+        'get_filmworks_persons',
+        get_filmworks_persons_query_by_filmwork_uuid(),
+        (filmworks_uuid_list,),
+        ('uuid[]',),
+    )
+    return filmworks_persons_data or list()
+
+
+def get_filmworks_genres_data(movies_db: PostgresDB, filmworks_uuid: Iterable[str]) -> list[Any]:
+    """Получение только жанров фильмов для частичного обновления документов.
+
+    :param movies_db: Объект подключения к базе данных.
+    :param filmworks_uuid: UUID фильмов, затронутых изменением жанров.
+    :return: Список строк по фильмам из БД.
+    """
+    filmworks_uuid_list = list(filmworks_uuid)
+    if not filmworks_uuid_list:
+        return list()
+
+    filmworks_genres_data = movies_db.execute_prepared(
+        'get_filmworks_genres',
+        get_filmworks_genres_query_by_filmwork_uuid(),
+        (filmworks_uuid_list,),
+        ('uuid[]',),
+    )
+    return filmworks_genres_data or list()
+
+
+def get_filmworks_uuid_from_notifies(payloads: Iterable[str]) -> set[str]:
+    """Получение UUID фильмов из уведомлений об изменениях.
+
+    Уведомления об изменении фильмов и связей фильмов с персонами и жанрами содержат UUID фильма.
+    Уведомления об изменении персон и жанров только будят ETL, фильмы по ним найдет опрос таблиц.
+
+    :param payloads: Payload уведомлений вида {"table": "film_work", "id": "..."}.
+    :return: Множество UUID фильмов.
+    """
+    filmworks_uuid = set()
+    for payload in payloads:
+        try:
+            notify = json.loads(payload)
+        except ValueError:
+            continue
+        if notify.get('table') in FILMWORK_NOTIFY_TABLES and notify.get('id'):
+            filmworks_uuid.add(notify['id'])
+    return filmworks_uuid
@@ -0,0 +1,123 @@
+"""Файл недоставленных документов Elasticsearch.
+
+Документы, которые Elasticsearch отклонил без возможности повтора (ошибка маппинга,
+невалидный документ), записываются в NDJSON файл ELASTIC_DEAD_LETTER_FILENAME,
+по одной записи на документ: время, статус и ошибку ответа и исходные строки bulk запроса.
+
+Повторная загрузка после исправления причины: python3 -m load.dead_letter (из каталога /etl_app).
+Фильмы загружаются заново по UUID из актуальных данных БД, а не из сохраненных строк,
+которые к этому времени могли устареть.
+"""
+
+import json
+import os
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Iterator, List
+
+from etl_app.config import settings
+from etl_app.logger import logger
+
+# Записи дописываются из нескольких потоков bulk загрузки
+_lock = Lock()
+
+
+def write_dead_letters(failed: List[tuple[bytes, dict]]) -> None:
+    """Запись недоставленных документов в конец файла.
+
+    :param failed: Список пар из строк NDJSON документа и результата bulk запроса по нему.
+    """
+    if not failed:
+        return
+    failed_at = datetime.now(timezone.utc).isoformat()
+    with _lock, open(settings.ELASTIC_DEAD_LETTER_FILENAME, 'a', encoding='utf-8') as file:
+        for line, action_result in failed:
+            record = {
+                'failed_at': failed_at,
+                'status': action_result.get('status'),
+                'error': action_result.get('error'),
+                'line': line.decode('utf-8'),
+            }
+            file.write(json.dumps(record, ensure_ascii=False) + '\n')
+    logger.warning(f' - Недоставленных документов записано в {settings.ELASTIC_DEAD_LETTER_FILENAME}: {len(failed)}')
+
+
+def read_dead_letters(file_path: str) -> Iterator[str]:
+    """Чтение идентификаторов недоставленных документов.
+
+    :param file_path: Путь к файлу недоставленных документов.
+    :return: Идентификаторы документов из строк действия bulk запроса.
+    """
+    with open(file_path, encoding='utf-8') as file:
+        for record in file:
+            if record.strip():
+                action_line = json.loads(record)['line'].split('\n', 1)[0]
+                action = json.loads(action_line)
+                yield next(iter(action.values()))['_id']
+
+
+def rotate_dead_letters(file_path: str, replay_path: str) -> None:
+    """Перенос недоставленных документов в файл повторной загрузки.
+
+    Если файл повторной загрузки остался от прерванного запуска, записи дописываются
+    в его конец, чтобы не потерять документы, которые еще не были загружены.
+
+    :param file_path: Путь к файлу недоставленных документов.
+    :param replay_path: Путь к файлу повторной загрузки.
+    """
+    if not os.path.exists(replay_path):
+        os.replace(file_path, replay_path)
+        return
+
+    logger.info(f' - Продолжение прерванной повторной загрузки {replay_path}')
+    with open(file_path, 'rb') as source, open(replay_path, 'ab') as target:
+        target.write(source.read())
+        target.flush()
+        os.fsync(target.fileno())
+    os.remove(file_path)
+
+
+def main() -> None:
+    """Повторная загрузка недоставленных документов.
+
+    Файл переименовывается перед загрузкой и удаляется только после нее, поэтому
+    прерванная загрузка продолжается при следующем запуске. Фильмы проходят обычный путь
+    extract -> transform -> load, документы, которые снова не удалось доставить,
+    записываются в новый файл недоставленных документов.
+    """
+    # Импорт здесь, т.к. load.utils и app сами используют файл недоставленных документов
+    from etl_app.app import load, transform
+    from etl_app.extract.utils import get_filmworks_additional_data, get_movies_database
+
+    file_path = settings.ELASTIC_DEAD_LETTER_FILENAME
+    replay_path = f'{file_path}.replay'
+    if os.path.exists(file_path):
+        rotate_dead_letters(file_path, replay_path)
+    if not os.path.exists(replay_path):
+        logger.info(f' Недоставленных документов нет')
+        return
+
+    logger.info(f' -> Повторная загрузка недоставленных документов из {replay_path}')
+
+    # Порядок сохраняется, повторы одного фильма отбрасываются
+    filmworks_uuid = list(dict.fromkeys(read_dead_letters(replay_path)))
+    movies_db = get_movies_database()
+    docs_count = 0
+    try:
+        for offset in range(0, len(filmworks_uuid), settings.ETL_EXTRACT_BATCH):
+            chunk = filmworks_uuid[offset:offset + settings.ETL_EXTRACT_BATCH]
+            extracted_data = get_filmworks_additional_data(movies_db, chunk)
+            load(transform(extracted_data), settings.ETL_LOAD_BATCH, skip_unchanged=False)
+            docs_count += len(extracted_data)
+    finally:
+        movies_db.close()
+
+    os.remove(replay_path)
+    logger.info(
+        f' <- Загружено фильмов {docs_count} из {len(filmworks_uuid)}, '
+        f'удаленные из БД фильмы пропущены'
+    )
+
+
+if __name__ == '__main__':
+    main()
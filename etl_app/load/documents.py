@@ -0,0 +1,124 @@
+"""Кодирование фильмов в пачки bulk запроса Elasticsearch.
+
+Пачки кодируются лениво, по мере отправки: строка действия и документ каждого фильма
+пишутся прямо в буфер пачки, без промежуточных словарей действия и _source и без копии
+каждого документа. Поля Movie совпадают с полями документа индекса, и dataclass
+сериализуется напрямую. Хеш _source считается по тем же байтам в буфере пачки.
+"""
+
+import json
+from dataclasses import dataclass, field
+from hashlib import blake2b
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+from etl_app.load.elastic import serialize_document
+from etl_app.load.hashes import HASH_SIZE
+from etl_app.transfrom.transform_dataclasses import Movie, MovieUpdate
+
+
+@dataclass(slots=True)
+class BulkChunk:
+    """Пачка документов одного bulk запроса.
+
+    body - строки действий и документов в формате NDJSON, offsets - начало строк каждого
+    документа в body, hashes - хеши _source полных документов (частичные обновления
+    не хешируются), skipped - UUID фильмов без изменений, пропущенных перед документами пачки.
+    """
+    body: bytearray = field(default_factory=bytearray)
+    ids: List[str] = field(default_factory=list)
+    offsets: List[int] = field(default_factory=list)
+    hashes: Dict[str, bytes] = field(default_factory=dict)
+    skipped: List[str] = field(default_factory=list)
+
+    def lines(self) -> List[memoryview]:
+        """Строки NDJSON каждого документа внутри body без копирования."""
+        view = memoryview(self.body)
+        ends = self.offsets[1:] + [len(self.body)]
+        return list(view[start:end] for start, end in zip(self.offsets, ends))
+
+
+def get_source_hash(body: bytearray, start: int, end: int) -> bytes:
+    """Хеш _source документа по байтам буфера без копирования.
+
+    :param body: Буфер пачки.
+    :param start: Начало _source.
+    :param end: Конец _source без перевода строки.
+    :return: Хеш содержимого.
+    """
+    # memoryview нужно освободить, иначе размер буфера нельзя будет изменить
+    with memoryview(body) as view:
+        return blake2b(view[start:end], digest_size=HASH_SIZE).digest()
+
+
+def encode_bulk_chunks(
+        batch_data: Iterable[Union[Movie, MovieUpdate]],
+        es_index: str,
+        chunk_size: int,
+        max_chunk_bytes: int,
+        hash_documents: bool = False,
+        stored_hashes: Optional[Dict[str, bytes]] = None,
+) -> Iterator[BulkChunk]:
+    """Кодирование данных по фильмам в пачки для bulk вставки в Elasticsearch.
+
+    Для MovieUpdate кодируется действие update только с изменившимися полями документа.
+    Пачка отдается, как только в нее не помещается следующий документ, поэтому
+    закодированным в памяти держится только текущая пачка, а не весь батч.
+
+    :param batch_data: Сгруппированные данные по фильмам.
+    :param es_index: Имя индекса или псевдонима в Elasticsearch.
+    :param chunk_size: Максимальное количество документов в пачке.
+    :param max_chunk_bytes: Максимальный размер пачки в байтах, документ больше этого размера уходит один.
+    :param hash_documents: Считать хеши _source полных документов.
+    :param stored_hashes: Сохраненные хеши документов, документ с тем же хешем не кодируется в пачку.
+    :return: Пачки документов.
+    """
+    action_meta = b'{"_index":' + json.dumps(es_index).encode('utf-8') + b',"_id":"'
+    index_action = b'{"index":' + action_meta
+    update_action = b'{"update":' + action_meta
+    stored_hashes = stored_hashes or dict()
+
+    chunk = BulkChunk()
+    for film in batch_data:
+        if len(chunk.ids) >= chunk_size:
+            yield chunk
+            chunk = BulkChunk()
+
+        body = chunk.body
+        start = len(body)
+        source_hash = None
+        if isinstance(film, MovieUpdate):
+            body += update_action
+            body += film.id.encode('utf-8')
+            body += b'"}}\n'
+            body += serialize_document({'doc': film.fields})
+            body += b'\n'
+        else:
+            body += index_action
+            body += film.id.encode('utf-8')
+            body += b'"}}\n'
+            source_start = len(body)
+            body += serialize_document(film)
+            body += b'\n'
+            if hash_documents:
+                source_hash = get_source_hash(body, source_start, len(body) - 1)
+                if stored_hashes.get(film.id) == source_hash:
+                    del body[start:]
+                    chunk.skipped.append(film.id)
+                    continue
+
+        if chunk.ids and len(body) > max_chunk_bytes:
+            # Документ не помещается в пачку и переносится в следующую, копируется только он
+            next_chunk = BulkChunk()
+            next_chunk.body += memoryview(body)[start:]
+            del body[start:]
+            yield chunk
+            chunk = next_chunk
+            start = 0
+
+        chunk.ids.append(film.id)
+        chunk.offsets.append(start)
+        if source_hash is not None:
+            chunk.hashes[film.id] = source_hash
+
+    if chunk.ids or chunk.skipped:
+        yield chunk
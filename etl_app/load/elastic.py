@@ -0,0 +1,87 @@
+"""Клиент Elasticsearch для загрузки данных.
+
+Клиент создается один раз на процесс и переиспользуется всеми запросами:
+проверкой и созданием индекса и bulk загрузкой. HTTP соединения держатся
+в пуле urllib3 с keep-alive.
+
+Тела запросов сериализуются orjson, если он установлен, иначе стандартным json.
+"""
+
+from dataclasses import fields, is_dataclass
+from functools import lru_cache
+from typing import Any
+
+from elasticsearch import Elasticsearch
+from elasticsearch.serializer import JsonSerializer
+from elastic_transport import SerializationError
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+from etl_app.config import settings
+from etl_app.logger import logger
+
+
+class OrjsonSerializer(JsonSerializer):
+    """Сериализатор JSON на orjson.
+
+    UUID, datetime, date и dataclass orjson кодирует сам, остальные типы
+    обрабатывает default стандартного сериализатора клиента.
+    """
+
+    def dumps(self, data: Any) -> bytes:
+        if isinstance(data, (str, bytes)):
+            return super().dumps(data)
+        try:
+            return orjson.dumps(data, default=self.default)
+        except orjson.JSONEncodeError as err:
+            raise SerializationError(message=f'Unable to serialize to JSON: {data!r} (type: {type(data).__name__})', errors=(err,))
+
+    def loads(self, data: bytes) -> Any:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError as err:
+            raise SerializationError(message=f'Unable to deserialize as JSON: {data!r}', errors=(err,))
+
+
+@lru_cache(maxsize=None)
+def get_elastic_client() -> Elasticsearch:
+    """Получение общего клиента Elasticsearch с пулом HTTP соединений."""
+    return Elasticsearch(
+        settings.es_url,
+        serializer=OrjsonSerializer() if orjson is not None else None,
+        connections_per_node=settings.ELASTIC_POOL_SIZE,
+        http_compress=settings.ELASTIC_HTTP_COMPRESS,
+        request_timeout=settings.ELASTIC_REQUEST_TIMEOUT,
+    )
+
+
+def serialize_document(document: Any) -> bytes:
+    """Сериализация документа в JSON сериализатором клиента.
+
+    orjson сериализует dataclass напрямую, для стандартного json dataclass переводится в словарь.
+    Поля документов - списки и словари без вложенных dataclass, поэтому словарь строится
+    по ссылкам на поля без глубокого копирования asdict, которое в разы дороже самой сериализации.
+
+    :param document: Словарь или dataclass.
+    :return: JSON документа в байтах.
+    """
+    if orjson is None and is_dataclass(document):
+        document = {field.name: getattr(document, field.name) for field in fields(document)}
+    return get_elastic_client().transport.serializers.dumps(document, mimetype='application/json')
+
+
+def log_elastic_stats() -> None:
+    """Вывод статистики переиспользования HTTP соединений с Elasticsearch."""
+    for node in get_elastic_client().transport.node_pool.all():
+        pool = getattr(node, 'pool', None)
+        if pool is None:
+            continue
+        connections = getattr(pool, 'num_connections', 0)
+        requests = getattr(pool, 'num_requests', 0)
+        logger.info(
+            f' - Соединения с {node.base_url}: открыто {connections}, запросов {requests}, '
+            f'запросов на соединение {requests / connections if connections else 0:.1f}'
+        )
@@ -0,0 +1,97 @@
+"""Хранилище хешей содержимого документов Elasticsearch.
+
+Изменение описания жанра или modified персоны отправляет в Elasticsearch
+все связанные фильмы, хотя их документы не изменились. Для каждого
+загруженного фильма в локальной SQLite базе хранится хеш его _source,
+документы с неизменным хешем при кодировании пачек отбрасываются.
+
+База хешей своя у каждого процесса ETL, поэтому при ETL_SHARDING_ENABLED хеши
+не используются: один и тот же фильм загружают разные процессы, и решение
+по истории одного процесса не учитывает то, что загрузили другие.
+"""
+
+import sqlite3
+from functools import lru_cache
+from threading import Lock
+from typing import Iterable
+
+from etl_app.config import settings
+
+# Размер хеша в байтах
+HASH_SIZE = 16
+
+
+class ContentHashStore:
+    """Хранилище хешей содержимого документов в SQLite."""
+
+    def __init__(self, file_path: str) -> None:
+        self.file_path = file_path
+        self._lock = Lock()
+        self._connection = sqlite3.connect(file_path, timeout=30, check_same_thread=False)
+        self._connection.execute('pragma journal_mode=wal')
+        self._connection.execute(
+            'create table if not exists content_hash (id text primary key, hash blob not null)'
+        )
+        self._connection.commit()
+
+    def get_hashes(self, documents_id: Iterable[str]) -> dict[str, bytes]:
+        """Получить сохраненные хеши документов.
+
+        :param documents_id: Идентификаторы документов.
+        :return: Словарь идентификатор документа - хеш содержимого, без документов, хеш которых не сохранен.
+        """
+        hashes = dict()
+        documents_id = list(documents_id)
+        with self._lock:
+            # Ограничение SQLite на количество параметров запроса
+            for start in range(0, len(documents_id), 500):
+                batch = documents_id[start:start + 500]
+                rows = self._connection.execute(
+                    f'select id, hash from content_hash where id in ({", ".join("?" * len(batch))})',
+                    batch,
+                )
+                hashes.update(rows)
+        return hashes
+
+    def save(self, hashes: dict[str, bytes]) -> None:
+        """Сохранить хеши загруженных документов.
+
+        :param hashes: Словарь идентификатор документа - хеш содержимого.
+        """
+        with self._lock:
+            self._connection.executemany(
+                'insert into content_hash (id, hash) values (?, ?) '
+                'on conflict (id) do update set hash = excluded.hash',
+                hashes.items(),
+            )
+            self._connection.commit()
+
+    def delete(self, documents_id: Iterable[str]) -> None:
+        """Удалить хеши документов, содержимое которых в индексе изменилось частично.
+
+        :param documents_id: Идентификаторы документов.
+        """
+        with self._lock:
+            self._connection.executemany(
+                'delete from content_hash where id = ?',
+                ((document_id,) for document_id in documents_id),
+            )
+            self._connection.commit()
+
+    def clear(self) -> None:
+        """Удалить все хеши, например после создания пустого индекса."""
+        with self._lock:
+            self._connection.execute('delete from content_hash')
+            self._connection.commit()
+
+
+def is_content_hash_enabled() -> bool:
+    """Включено ли хранение хешей содержимого, при шардировании ETL они отключены."""
+    return settings.ETL_CONTENT_HASH_ENABLED and not settings.ETL_SHARDING_ENABLED
+
+
+@lru_cache(maxsize=None)
+def get_content_hash_store() -> ContentHashStore:
+    """Получение общего для процесса хранилища хешей содержимого."""
+    return ContentHashStore(settings.ETL_CONTENT_HASH_FILENAME)
+
@@ -1,100 +1,438 @@
-from time import sleep
-from typing import List
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from random import uniform
+from time import monotonic, sleep
+from typing import Callable, Iterable, List, Optional
 
-import requests
 from backoff import on_exception, expo
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from elasticsearch import ApiError, ConnectionError as ElasticConnectionError, ConnectionTimeout
 
+from etl_app.config import settings
+from etl_app.load.dead_letter import write_dead_letters
+from etl_app.load.documents import BulkChunk
+from etl_app.load.elastic import get_elastic_client
+from etl_app.load.hashes import ContentHashStore, get_content_hash_store, is_content_hash_enabled
 from etl_app.logger import logger
-from etl_app.transfrom.transform_dataclasses import Movie
+
+# Индексы, наличие которых уже подтверждено в текущем процессе
+ready_indexes = set()
+# Подтвержденные индексы, которые являются псевдонимами, запись в них идет с require_alias,
+# чтобы после удаления псевдонима Elasticsearch не создал вместо него индекс с динамическим маппингом
+alias_indexes = set()
+
+# Базовая и максимальная пауза перед повторной отправкой отклоненных документов
+BULK_RETRY_BASE_DELAY_SEC = 0.5
+BULK_RETRY_MAX_DELAY_SEC = 30
+# Статусы отказа в bulk запросе целиком, при которых пачка делится пополам до одного плохого документа
+BULK_SPLIT_STATUSES = (400, 413)
+
+
+class IndexNotFoundError(Exception):
+    """Bulk вставка отклонена, т.к. индекс не найден."""
 
 
 @on_exception(expo, Exception)
-def check_index(es_url_with_index: str) -> bool:
+def check_index(es_index: str) -> bool:
     """Проверка наличия индекса в Elasticsearch.
 
-    :param es_url_with_index: Ссылка на индекс в Elasticsearch.
-    :return: Вернуть True, если запрос индекса вернул код 200.
+    :param es_index: Имя индекса в Elasticsearch.
+    :return: Вернуть True, если индекс существует.
     """
-    logger.info(f'-> Проверка индекса {es_url_with_index}')
-    r = requests.get(es_url_with_index)
-    logger.info(f' <- Проверка индекса завершилась с кодом {r.status_code}')
-    return r.status_code == 200
+    logger.info(f'-> Проверка индекса {es_index}')
+    exists = bool(get_elastic_client().indices.exists(index=es_index))
+    logger.info(f' <- Проверка индекса завершилась: {exists}')
+    return exists
 
 
 @on_exception(expo, Exception)
-def create_index_movie(es_url_with_index: str, es_index_file: str, es_index_timeout: int) -> None:
+def create_index_movie(es_index: str, es_index_file: str, es_index_timeout: int) -> None:
     """Проверка наличия индекса в Elasticsearch или его создание, если индекс не найден.
 
-    :param es_url_with_index: Ссылка на индекс в Elasticsearch.
+    После первой успешной проверки наличие индекса запоминается и повторно
+    не проверяется, пока bulk вставка не сообщит, что индекс не найден.
+
+    :param es_index: Имя индекса в Elasticsearch.
     :param es_index_file: Ссылка на файл, где лежит схема индекса.
     :param es_index_timeout: Длительность ожидания в секундах при следующей попытке создать индекс.
     """
-    logger.info(f'-> Поиск индекса {es_url_with_index}')
+    if es_index in ready_indexes:
+        return
 
-    # Подготовка данных если индекс не был найден:
-    headers = {'Content-Type': 'application/json', 'charset': 'UTF-8'}
+    logger.info(f'-> Поиск индекса {es_index}')
 
-    while not check_index(es_url_with_index):
-        logger.warning(f' - Индекс не обнаружен, попытка создать {es_url_with_index}')
+    while not check_index(es_index):
+        logger.warning(f' - Индекс не обнаружен, попытка создать {es_index}')
 
-        # Не хочу выносить попытку чтения файла в отдельный while цикл или делать конструкцию if - while.
         # Пускай если индекс не найден в es, то произойдет попытка чтения схемы из файла.
         # Если чтение завершилось ошибкой, то сообщить об этом и уход от сваливания программы
-        # через try - except. Заголовки вынес.
+        # через try - except.
         try:
             with open(es_index_file, encoding='utf-8') as file:
-                data = file.read()
+                index_schema = json.load(file)
+            get_elastic_client().indices.create(
+                index=es_index,
+                settings=index_schema.get('settings'),
+                mappings=index_schema.get('mappings'),
+            )
+            # Индекс пустой, сохраненные хеши содержимого больше не соответствуют индексу
+            if is_content_hash_enabled():
+                get_content_hash_store().clear()
         except Exception as err:
-            logger.warning(f' - Ошибка чтение схемы индекса - {err}')
-
-        requests.put(es_url_with_index, data=data, headers=headers)
+            logger.warning(f' - Ошибка создания индекса - {err}')
 
-        logger.warning(f' - Повторная попытка создания {es_url_with_index} через  {es_index_timeout} сек')
+        logger.warning(f' - Повторная попытка создания {es_index} через  {es_index_timeout} сек')
         sleep(es_index_timeout)
 
-    logger.info(f' <- Индекс {es_url_with_index} доступен')
-
-
-def get_prepared_data(batch_data: List[Movie]) -> List[dict]:
-    """Подготовка данных для вставки в Elasticsearch.
-
-    :param batch_data:  Список сгруппированных данных по фильмам.
-    :return: Список словарей сгруппированных данных по фильмам для bulk вставки в Elasticsearch.
-    """
-    logger.info(f' -> Подготовка данных для загрузки в elastic')
-    prepared_data = []
-    for film in batch_data:
-        film_data = {
-            "_index": "movies",
-            "_id": film.id,
-            "_source": {
-                "id": film.id,
-                "imdb_rating": film.imdb_rating,
-                "title": film.title,
-                "description": film.description,
-                "genre": film.genre,
-                "director": film.director,
-                "actors_names": film.actors_names,
-                "writers_names": film.writers_names,
-                "actors": film.actors,
-                "writers": film.writers,
-            }
-        }
-        prepared_data.append(film_data)
-    logger.info(f' <- Данные подготовлены для загрузки в elastic')
-    return prepared_data
+    if get_elastic_client().indices.exists_alias(name=es_index):
+        alias_indexes.add(es_index)
+    else:
+        alias_indexes.discard(es_index)
+    ready_indexes.add(es_index)
+    logger.info(f' <- Индекс {es_index} доступен')
 
 
-@on_exception(expo, Exception)
-def insert_data_to_elastic(bulk_data: List[dict], es_url: str) -> None:
+def get_index_versions(es_alias: str) -> List[str]:
+    """Получение версий индекса вида {es_alias}_v{N} в порядке возрастания версии.
+
+    :param es_alias: Имя псевдонима индекса в Elasticsearch.
+    :return: Список имен версий индекса.
+    """
+    prefix = f'{es_alias}_v'
+    indexes = get_elastic_client().indices.get(index=f'{prefix}*', allow_no_indices=True)
+    versions = list(index for index in indexes if index[len(prefix):].isdigit())
+    return sorted(versions, key=lambda index: int(index[len(prefix):]))
+
+
+def create_index_version(es_alias: str, es_index_file: str) -> str:
+    """Создание новой версии индекса для полной перестройки.
+
+    Новая версия создается без обновления поиска (refresh_interval: -1) и без реплик,
+    чтобы bulk загрузка шла максимально быстро.
+
+    :param es_alias: Имя псевдонима индекса в Elasticsearch.
+    :param es_index_file: Ссылка на файл, где лежит схема индекса.
+    :return: Имя созданной версии индекса.
+    """
+    versions = get_index_versions(es_alias)
+    version = int(versions[-1][len(f'{es_alias}_v'):]) + 1 if versions else 1
+    es_index = f'{es_alias}_v{version}'
+
+    with open(es_index_file, encoding='utf-8') as file:
+        index_schema = json.load(file)
+    index_settings = dict(index_schema.get('settings', {}))
+    index_settings['refresh_interval'] = '-1'
+    index_settings['number_of_replicas'] = 0
+
+    logger.info(f' - Создание версии индекса {es_index}')
+    get_elastic_client().indices.create(
+        index=es_index,
+        settings=index_settings,
+        mappings=index_schema.get('mappings'),
+    )
+    return es_index
+
+
+def finish_index_version(es_index: str, es_index_file: str, replicas: int) -> None:
+    """Восстановление настроек версии индекса после bulk загрузки и слияние сегментов.
+
+    :param es_index: Имя версии индекса в Elasticsearch.
+    :param es_index_file: Ссылка на файл, где лежит схема индекса.
+    :param replicas: Количество реплик индекса.
+    """
+    with open(es_index_file, encoding='utf-8') as file:
+        index_schema = json.load(file)
+
+    client = get_elastic_client()
+    logger.info(f' - Восстановление настроек версии индекса {es_index}')
+    client.indices.put_settings(
+        index=es_index,
+        settings={
+            'refresh_interval': index_schema.get('settings', {}).get('refresh_interval', '1s'),
+            'number_of_replicas': replicas,
+        },
+    )
+    client.indices.refresh(index=es_index)
+    logger.info(f' - Слияние сегментов версии индекса {es_index}')
+    client.options(request_timeout=3600).indices.forcemerge(index=es_index, max_num_segments=1)
+
+
+def swap_index_alias(es_alias: str, es_index: str) -> None:
+    """Атомарное переключение псевдонима на новую версию индекса.
+
+    Если вместо псевдонима существует обычный индекс с таким именем,
+    он удаляется в том же запросе.
+
+    :param es_alias: Имя псевдонима индекса в Elasticsearch.
+    :param es_index: Имя версии индекса, на которую переключается псевдоним.
+    """
+    client = get_elastic_client()
+    actions = list()
+    if client.indices.exists_alias(name=es_alias):
+        for current_index in client.indices.get_alias(name=es_alias):
+            actions.append({'remove': {'index': current_index, 'alias': es_alias}})
+    elif client.indices.exists(index=es_alias):
+        actions.append({'remove_index': {'index': es_alias}})
+    actions.append({'add': {'index': es_index, 'alias': es_alias}})
+
+    logger.info(f' - Переключение псевдонима {es_alias} на {es_index}')
+    client.indices.update_aliases(actions=actions)
+    ready_indexes.discard(es_alias)
+
+
+def delete_old_index_versions(es_alias: str, keep: int) -> None:
+    """Удаление старых версий индекса, на которые не указывает псевдоним.
+
+    :param es_alias: Имя псевдонима индекса в Elasticsearch.
+    :param keep: Сколько предыдущих версий оставить для отката.
+    """
+    client = get_elastic_client()
+    current_indexes = set()
+    if client.indices.exists_alias(name=es_alias):
+        current_indexes = set(client.indices.get_alias(name=es_alias))
+
+    old_versions = list(index for index in get_index_versions(es_alias) if index not in current_indexes)
+    for es_index in old_versions[:max(len(old_versions) - keep, 0)]:
+        logger.info(f' - Удаление старой версии индекса {es_index}')
+        client.indices.delete(index=es_index)
+
+
+def get_not_found_indexes(errors: List[dict]) -> set[str]:
+    """Получение индексов, которые не найдены при bulk вставке.
+
+    :param errors: Результаты bulk вставки по документам, завершившиеся ошибкой.
+    :return: Множество имен не найденных индексов.
+    """
+    not_found_indexes = set()
+    for action_result in errors:
+        if action_result.get('error', {}).get('type') == 'index_not_found_exception':
+            not_found_indexes.add(action_result.get('_index'))
+    return not_found_indexes
+
+
+def is_retryable_status(status: int) -> bool:
+    """Проверка, что документ, отклоненный с этим статусом, имеет смысл отправить повторно.
+
+    :param status: HTTP статус результата bulk запроса по документу.
+    :return: Вернуть True для перегрузки кластера (429) и ошибок на стороне Elasticsearch (5xx).
+    """
+    return status == 429 or status >= 500
+
+
+def get_retry_delay(attempt: int) -> float:
+    """Пауза перед повторной отправкой документов, экспоненциальная со случайным разбросом.
+
+    :param attempt: Номер повторной попытки, начиная с 1.
+    :return: Пауза в секундах.
+    """
+    return uniform(0, min(BULK_RETRY_MAX_DELAY_SEC, BULK_RETRY_BASE_DELAY_SEC * 2 ** attempt))
+
+
+def is_retryable_error(err: Exception) -> bool:
+    """Проверка, что bulk запрос, завершившийся исключением, имеет смысл отправить повторно.
+
+    :param err: Исключение клиента Elasticsearch.
+    :return: Вернуть True для ошибок соединения и таймаутов, а также для ответов 429 и 5xx.
+    """
+    if isinstance(err, ApiError):
+        return is_retryable_status(err.meta.status)
+    return isinstance(err, (ElasticConnectionError, ConnectionTimeout))
+
+
+@on_exception(
+    expo,
+    (ApiError, ElasticConnectionError, ConnectionTimeout),
+    giveup=lambda err: not is_retryable_error(err),
+    max_value=BULK_RETRY_MAX_DELAY_SEC,
+)
+def send_bulk_request(chunk: List[memoryview], require_alias: bool = False) -> dict:
+    """Отправка пачки документов одним bulk запросом.
+
+    Запрос целиком повторяется при ошибках соединения, таймаутах и ответах 429 и 5xx,
+    остальные ошибки (400, 413) пробрасываются сразу.
+
+    :param chunk: Пачка строк NDJSON внутри буфера пачки.
+    :param require_alias: Запись только через псевдоним, без автоматического создания индекса.
+    :return: Ответ Elasticsearch.
+    """
+    if require_alias:
+        return get_elastic_client().bulk(operations=b''.join(chunk), require_alias=True)
+    return get_elastic_client().bulk(operations=b''.join(chunk))
+
+
+def get_line_id(line: bytes) -> Optional[str]:
+    """Идентификатор документа из строки действия NDJSON.
+
+    :param line: Строки NDJSON документа.
+    :return: Идентификатор документа.
+    """
+    action = json.loads(line[:line.index(b'\n')])
+    return next(iter(action.values())).get('_id')
+
+
+def send_bulk_chunk(chunk: List[memoryview], require_alias: bool = False) -> tuple[int, float, set[str]]:
+    """Отправка пачки документов с разбором результата по каждому документу.
+
+    Документы, отклоненные из-за перегрузки или ошибки Elasticsearch (429, 5xx), отправляются
+    повторно с растущей паузой, пока пачка не подтверждена, но не больше ELASTIC_BULK_RETRY_MAX раз.
+    В файл недоставленных документов записываются документы, отклоненные без возможности
+    повтора (4xx), и документы, исчерпавшие повторы, чтобы один плохой документ не останавливал
+    загрузку. Если Elasticsearch отклонил запрос целиком со статусом 400 или 413, пачка делится
+    пополам, остальные отказы запроса целиком (401, 403, 404) пробрасываются: документы пачки
+    не подтверждаются и не записываются в файл недоставленных документов.
+
+    :param chunk: Пачка строк NDJSON внутри буфера пачки.
+    :param require_alias: Запись только через псевдоним, см. send_bulk_request.
+    :return: Кортеж из количества документов, длительности запросов в секундах
+             и идентификаторов недоставленных документов.
+    :raises IndexNotFoundError: Индекс не найден, его наличие нужно проверить заново.
+    :raises ApiError: Запрос отклонен целиком со статусом, при котором деление пачки не поможет.
+    """
+    started = monotonic()
+    body_size = sum(len(line) for line in chunk)
+    pending = chunk
+    failed = list()
+    failed_id = set()
+    attempt = 0
+
+    while pending:
+        try:
+            response = send_bulk_request(pending, require_alias)
+        except ApiError as err:
+            if err.meta.status not in BULK_SPLIT_STATUSES:
+                raise
+            if len(pending) == 1:
+                line = bytes(pending[0])
+                failed.append((line, {'status': err.meta.status, 'error': str(err.body)}))
+                failed_id.add(get_line_id(line))
+                break
+            logger.warning(f' - Запрос отклонен со статусом {err.meta.status}, пачка {len(pending)} документов делится')
+            middle = len(pending) // 2
+            for half in (pending[:middle], pending[middle:]):
+                failed_id.update(send_bulk_chunk(half, require_alias)[2])
+            break
+
+        if not response['errors']:
+            break
+
+        errors = list(
+            (line, action_result)
+            for line, item in zip(pending, response['items'])
+            for action_result in item.values()
+            if 'error' in action_result
+        )
+        not_found_indexes = get_not_found_indexes(list(action_result for line, action_result in errors))
+        if not_found_indexes:
+            ready_indexes.difference_update(not_found_indexes)
+            raise IndexNotFoundError(f'Индексы не найдены: {not_found_indexes}')
+
+        attempt += 1
+        retryable = list()
+        for line, action_result in errors:
+            if is_retryable_status(action_result.get('status', 0)) and attempt <= settings.ELASTIC_BULK_RETRY_MAX:
+                retryable.append(line)
+            else:
+                failed.append((bytes(line), action_result))
+                failed_id.add(action_result.get('_id'))
+
+        pending = retryable
+        if pending:
+            delay = get_retry_delay(attempt)
+            logger.warning(f' - Повторная отправка {len(pending)} документов через {delay:.2f} сек, попытка {attempt}')
+            sleep(delay)
+
+    write_dead_letters(failed)
+    latency = monotonic() - started
+
+    logger.info(
+        f' - Пачка {len(chunk)} документов, {body_size} байт за {latency:.3f} сек, '
+        f'{len(chunk) / latency if latency else 0:.1f} документов/сек, не доставлено {len(failed_id)}'
+    )
+    return len(chunk), latency, failed_id
+
+
+def save_chunk_hashes(hash_store: ContentHashStore, chunk: BulkChunk, failed_id: set[str]) -> None:
+    """Сохранение хешей содержимого документов пачки после ее загрузки.
+
+    Недоставленные документы нужно отправить при следующем изменении, даже если оно не меняет документ.
+
+    :param hash_store: Хранилище хешей содержимого.
+    :param chunk: Загруженная пачка документов.
+    :param failed_id: Идентификаторы недоставленных документов пачки.
+    """
+    hash_store.save({
+        document_id: source_hash
+        for document_id, source_hash in chunk.hashes.items()
+        if document_id not in failed_id
+    })
+    # Частично обновленные документы при следующей полной загрузке нужно отправить
+    hash_store.delete(
+        document_id
+        for document_id in chunk.ids
+        if document_id not in chunk.hashes and document_id not in failed_id
+    )
+
+
+def insert_data_to_elastic(
+        chunks: Iterable[BulkChunk],
+        thread_count: int = 4,
+        on_chunk_loaded: Optional[Callable[[List[str]], None]] = None,
+        require_alias: bool = False,
+        hash_store: Optional[ContentHashStore] = None,
+) -> set[str]:
     """Вставка данных в Elasticsearch.
 
-    :param bulk_data:  Список подготовленных данных для вставки в Elasticsearch.
-    :param es_url:  Ссылка для bulk вставки в Elasticsearch.
+    Пачки отправляются параллельно в thread_count потоков. Следующая пачка берется
+    из chunks, только когда освобождается поток, поэтому закодированными в памяти
+    держатся не больше thread_count + 1 пачек.
+
+    :param chunks: Пачки закодированных документов, см. encode_bulk_chunks.
+    :param thread_count: Сколько bulk запросов выполнять одновременно.
+    :param on_chunk_loaded: Вызывается с идентификаторами документов каждой пачки после ее загрузки
+                            (включая пропущенные без изменений), пачки подтверждаются строго по порядку.
+    :param require_alias: Запись только через псевдоним, см. send_bulk_request.
+    :param hash_store: Хранилище, в которое сохраняются хеши содержимого загруженных документов.
+    :return: Идентификаторы документов, записанных в файл недоставленных документов.
+    :raises IndexNotFoundError: Индекс не найден, его наличие нужно проверить заново.
     """
     logger.info(f' -> Загрузка данных в elastic')
-    es = Elasticsearch(es_url)
-    response = bulk(es, bulk_data)
-    logger.info(f' <- Данные загружены в elastic с response: {response}')
+    started = monotonic()
+    docs_count = 0
+    skipped_count = 0
+    failed_id = set()
+
+    def send_documents_chunk(chunk: BulkChunk) -> tuple[int, float, set[str]]:
+        if not chunk.ids:
+            return 0, 0.0, set()
+        return send_bulk_chunk(chunk.lines(), require_alias)
+
+    with ThreadPoolExecutor(max_workers=thread_count) as executor:
+        in_flight = deque()
+
+        def complete_chunk() -> None:
+            # Пачки завершаются в порядке отправки, поэтому подтверждение пачки
+            # означает, что все предыдущие пачки тоже загружены
+            nonlocal docs_count, skipped_count
+            chunk, future = in_flight.popleft()
+            chunk_docs_count, latency, chunk_failed_id = future.result()
+            docs_count += chunk_docs_count
+            skipped_count += len(chunk.skipped)
+            failed_id.update(chunk_failed_id)
+            if hash_store is not None:
+                save_chunk_hashes(hash_store, chunk, chunk_failed_id)
+            if on_chunk_loaded:
+                on_chunk_loaded(chunk.skipped + chunk.ids)
+
+        for chunk in chunks:
+            in_flight.append((chunk, executor.submit(send_documents_chunk, chunk)))
+            if len(in_flight) >= thread_count:
+                complete_chunk()
+        while in_flight:
+            complete_chunk()
+
+    duration = monotonic() - started
+    logger.info(
+        f' <- Загружено в elastic {docs_count} документов за {duration:.3f} сек, '
+        f'{docs_count / duration if duration else 0:.1f} документов/сек, без изменений пропущено {skipped_count}'
+    )
+    return failed_id
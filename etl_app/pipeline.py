@@ -0,0 +1,129 @@
+"""Конвейерный режим ETL.
+
+Этапы извлечения, трансформации и загрузки работают в отдельных потоках
+и обмениваются батчами через ограниченные очереди. Пока Elasticsearch
+загружает батч N, из PostgreSQL уже извлекается батч N+1. psycopg2 и HTTP клиент
+Elasticsearch отпускают GIL на время ввода-вывода, поэтому потоков достаточно.
+
+Состояние сохраняется строго в порядке извлечения батчей и только после
+их загрузки, поэтому при падении батчи после последнего сохраненного
+состояния будут извлечены повторно.
+"""
+
+from queue import Queue, Empty, Full
+from threading import Event, Thread
+from time import monotonic
+from typing import Any, Callable
+
+from etl_app.logger import logger
+
+# Таймаут ожидания очереди, чтобы потоки могли заметить остановку конвейера
+QUEUE_TIMEOUT_SEC = 1
+
+
+class PipelineStopped(Exception):
+    """Конвейер остановлен из-за ошибки в одном из этапов."""
+
+
+class Pipeline:
+    """Конвейер ETL из трех этапов с ограниченными очередями между ними.
+
+    :param extract: Извлечение батча, возвращает кортеж из данных, состояния после батча
+                    и признака того, что в БД остались необработанные изменения.
+    :param transform: Трансформация данных батча.
+    :param load: Загрузка трансформированных данных батча, получает и состояние батча.
+    :param save_state: Сохранение состояния после загрузки батча.
+    :param wait_for_changes: Пауза извлечения, когда изменения в БД закончились.
+                             Принимает признак того, что последний батч содержал данные.
+    :param queue_size: Сколько батчей может ожидать следующего этапа.
+    """
+
+    def __init__(
+            self,
+            extract: Callable[[], tuple[Any, Any, bool]],
+            transform: Callable[[Any], Any],
+            load: Callable[[Any, Any], None],
+            save_state: Callable[[Any], None],
+            wait_for_changes: Callable[[bool], None],
+            queue_size: int = 2,
+    ):
+        self.extract = extract
+        self.transform = transform
+        self.load = load
+        self.save_state = save_state
+        self.wait_for_changes = wait_for_changes
+        self._extracted = Queue(maxsize=queue_size)
+        self._transformed = Queue(maxsize=queue_size)
+        self._stopped = Event()
+        self._error = None
+
+    def run(self) -> None:
+        """Запуск конвейера, загрузка и сохранение состояния идут в текущем потоке."""
+        threads = (
+            Thread(target=self._stage, args=(self._extract_stage,), name='etl-extract', daemon=True),
+            Thread(target=self._stage, args=(self._transform_stage,), name='etl-transform', daemon=True),
+        )
+        for thread in threads:
+            thread.start()
+
+        try:
+            self._stage(self._load_stage)
+        finally:
+            self._stopped.set()
+            for thread in threads:
+                thread.join(QUEUE_TIMEOUT_SEC)
+
+        if self._error:
+            raise self._error
+
+    def _extract_stage(self) -> None:
+        batch_number = 0
+        while True:
+            data, state, has_more = self.extract()
+            self._put(self._extracted, (batch_number, data, state))
+            batch_number += 1
+            if not has_more:
+                self.wait_for_changes(bool(data))
+
+    def _transform_stage(self) -> None:
+        while True:
+            batch_number, data, state = self._get(self._extracted)
+            self._put(self._transformed, (batch_number, self.transform(data), state))
+
+    def _load_stage(self) -> None:
+        while True:
+            batch_number, data, state = self._get(self._transformed)
+            started = monotonic()
+            self.load(data, state)
+            self.save_state(state)
+            logger.info(
+                f' Конвейер: батч {batch_number} загружен за {monotonic() - started:.2f} сек, '
+                f'в очередях извлечено {self._extracted.qsize()}, трансформировано {self._transformed.qsize()}'
+            )
+
+    def _stage(self, target: Callable[[], None]) -> None:
+        try:
+            target()
+        except PipelineStopped:
+            pass
+        except Exception as err:
+            logger.error(f' Конвейер остановлен из-за ошибки: {err}')
+            self._error = self._error or err
+            self._stopped.set()
+
+    def _put(self, queue: Queue, item: Any) -> None:
+        while not self._stopped.is_set():
+            try:
+                queue.put(item, timeout=QUEUE_TIMEOUT_SEC)
+                return
+            except Full:
+                continue
+        raise PipelineStopped
+
+    def _get(self, queue: Queue) -> Any:
+        while not self._stopped.is_set():
+            try:
+                return queue.get(timeout=QUEUE_TIMEOUT_SEC)
+            except Empty:
+                continue
+        raise PipelineStopped
@@ -0,0 +1,290 @@
+"""Полная переиндексация фильмов в Elasticsearch.
+
+Таблица content.film_work делится на диапазоны UUID, каждый диапазон
+извлекается, трансформируется и загружается отдельным процессом.
+Все процессы читают данные в одном снимке, экспортированном координатором,
+поэтому результат согласован на момент запуска переиндексации.
+
+При ETL_REINDEX_BLUE_GREEN загрузка идет в новую версию индекса {ELASTIC_INDEX}_v{N}
+без обновления поиска и реплик. После загрузки в нее догружаются изменения,
+сделанные во время переиндексации, восстанавливаются настройки, сливаются сегменты,
+и псевдоним ELASTIC_INDEX атомарно переключается на новую версию.
+Поиск всё это время работает по старой версии. Инкрементальный ETL до переключения
+пишет в старую версию, поэтому после переключения изменения догружаются еще раз,
+начиная с первой догрузки.
+
+Ошибка запроса в любом процессе прерывает переиндексацию. Псевдоним не переключается,
+если количество загруженных фильмов не совпадает с количеством фильмов в снимке.
+
+Запуск: python3 -m reindex (из каталога /etl_app)
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from time import monotonic
+from uuid import UUID
+
+from etl_app.app import extract, load, transform
+from etl_app.config import settings
+from etl_app.extract.postgres import PostgresDB
+from etl_app.extract.utils import (
+    MIN_UUID,
+    get_movies_database,
+    get_filmworks_by_uuid_range,
+    get_filmworks_additional_data,
+)
+from etl_app.load.elastic import get_elastic_client
+from etl_app.load.hashes import get_content_hash_store
+from etl_app.load.utils import (
+    create_index_version,
+    delete_old_index_versions,
+    finish_index_version,
+    swap_index_alias,
+)
+from etl_app.logger import logger
+
+# Количество UUID
+UUID_SPACE = 2 ** 128
+
+# Запас времени при догрузке изменений, сделанных во время переиндексации:
+# modified проставляет приложение, и транзакции могут закоммититься позже снимка
+CATCH_UP_MARGIN = timedelta(minutes=1)
+
+
+def get_reindex_database() -> PostgresDB:
+    """Получение объекта подключения к БД из одного соединения, чтобы держать в нем снимок."""
+    return PostgresDB(
+        user=settings.POSTGRES_DB_USER,
+        password=settings.POSTGRES_DB_PASS,
+        host=settings.POSTGRES_DB_HOST,
+        port=settings.POSTGRES_DB_PORT,
+        database=settings.POSTGRES_DB_NAME,
+        max_connections=1,
+    )
+
+
+def init_worker() -> None:
+    """Инициализация процесса переиндексации.
+
+    Процессы создаются через fork и наследуют клиент Elasticsearch координатора
+    вместе с открытыми keep-alive соединениями его пула. Общий сокет в нескольких
+    процессах перемешивает ответы, поэтому каждый процесс создает свои клиенты.
+    """
+    get_elastic_client.cache_clear()
+    get_content_hash_store.cache_clear()
+
+
+class ReindexError(Exception):
+    """Переиндексация загрузила не все фильмы снимка, псевдоним не переключается."""
+
+
+def get_database_now() -> datetime:
+    """Текущее время сервера БД, от него отсчитываются догрузки изменений."""
+    movies_db = get_movies_database()
+    try:
+        return movies_db.execute('select now() as now')[0].now
+    finally:
+        movies_db.close()
+
+
+def get_partitions(partitions_count: int) -> list[tuple[str, str]]:
+    """Разбиение пространства UUID на равные диапазоны.
+
+    :param partitions_count: Количество диапазонов.
+    :return: Список диапазонов (нижняя граница не включительно, верхняя граница включительно).
+    """
+    upper_bounds = list(
+        str(UUID(int=UUID_SPACE * (number + 1) // partitions_count - 1))
+        for number in range(partitions_count)
+    )
+    lower_bounds = [MIN_UUID] + upper_bounds[:-1]
+    return list(zip(lower_bounds, upper_bounds))
+
+
+def reindex_partition(
+        snapshot_id: str,
+        partition_number: int,
+        lower_uuid: str,
+        upper_uuid: str,
+        extract_batch: int,
+        load_batch: int,
+        es_index: str,
+) -> tuple[int, int, float]:
+    """Переиндексация фильмов из диапазона UUID, выполняется в отдельном процессе.
+
+    :param snapshot_id: Идентификатор снимка данных координатора.
+    :param partition_number: Номер диапазона.
+    :param lower_uuid: Нижняя граница диапазона UUID не включительно.
+    :param upper_uuid: Верхняя граница диапазона UUID включительно.
+    :param extract_batch: Сколько фильмов извлекать за раз.
+    :param load_batch: Сколько фильмов загружать в Elasticsearch за раз.
+    :param es_index: Имя индекса в Elasticsearch, в который идет загрузка.
+    :return: Кортеж из номера диапазона, количества загруженных фильмов и длительности в секундах.
+    """
+    started = monotonic()
+    movies_db = get_reindex_database()
+    movies_db.import_snapshot(snapshot_id)
+
+    docs_count = 0
+    last_filmwork_uuid = lower_uuid
+    try:
+        while True:
+            filmworks_uuid = get_filmworks_by_uuid_range(
+                movies_db,
+                last_filmwork_uuid=last_filmwork_uuid,
+                upper_uuid=upper_uuid,
+                batch=extract_batch,
+            )
+            if not filmworks_uuid:
+                break
+
+            extracted_data = get_filmworks_additional_data(movies_db, filmworks_uuid)
+            transformed_data = transform(extracted_data)
+            load(transformed_data, load_batch=load_batch, es_index=es_index, skip_unchanged=False)
+
+            docs_count += len(transformed_data)
+            last_filmwork_uuid = filmworks_uuid[-1]
+            logger.info(f' Диапазон {partition_number}: загружено {docs_count} фильмов')
+
+            if len(filmworks_uuid) < extract_batch:
+                break
+    finally:
+        movies_db.close()
+
+    return partition_number, docs_count, monotonic() - started
+
+
+def catch_up(since: str, extract_batch: int, load_batch: int, es_index: str) -> int:
+    """Догрузка изменений, сделанных после снимка данных.
+
+    Работает как инкрементальный ETL, начиная с состояния since по всем таблицам.
+
+    :param since: Время, с которого догружаются изменения, в формате ISO.
+    :param extract_batch: Сколько записей собирать при изменении состояния по таблицам.
+    :param load_batch: Сколько фильмов загружать в Elasticsearch за раз.
+    :param es_index: Имя индекса в Elasticsearch, в который идет загрузка.
+    :return: Количество догруженных фильмов.
+    """
+    state = {
+        'state_filmwork_modified': since,
+        'state_person_modified': since,
+        'state_genre_modified': since,
+    }
+    docs_count = 0
+    movies_db = get_movies_database()
+    try:
+        has_more = True
+        while has_more:
+            extracted_data, state, has_more, checkpoints = extract(
+                movies_db,
+                state=state,
+                extract_batch=extract_batch,
+                fanout_batch=extract_batch,
+            )
+            transformed_data = transform(extracted_data)
+            load(transformed_data, load_batch=load_batch, es_index=es_index, skip_unchanged=False)
+            docs_count += len(transformed_data)
+    finally:
+        movies_db.close()
+    return docs_count
+
+
+def main(
+        workers: int = 4,
+        extract_batch: int = 1000,
+        load_batch: int = 100,
+        blue_green: bool = True,
+) -> None:
+    """Полная переиндексация фильмов.
+
+    :param workers: Количество процессов и диапазонов UUID.
+    :param extract_batch: Сколько фильмов извлекать за раз в каждом процессе.
+    :param load_batch: Сколько фильмов загружать в Elasticsearch за раз.
+    :param blue_green: Загружать в новую версию индекса и переключить на нее псевдоним.
+    """
+    logger.info(f' -> Полная переиндексация, процессов {workers}')
+    started = monotonic()
+
+    es_index = settings.ELASTIC_INDEX
+    if blue_green:
+        es_index = create_index_version(settings.ELASTIC_INDEX, settings.ELASTIC_INDEX_FILE)
+
+    # Снимок живет, пока открыта транзакция координатора
+    snapshot_db = get_reindex_database()
+    try:
+        snapshot_id = snapshot_db.export_snapshot()
+        snapshot_started = snapshot_db.execute('select now() as started')[0].started
+        snapshot_films = snapshot_db.execute('select count(*) as films from content.film_work')[0].films
+        logger.info(f' - Снимок данных {snapshot_id} на {snapshot_started}, фильмов {snapshot_films}')
+
+        docs_total = 0
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            futures = list(
+                executor.submit(
+                    reindex_partition,
+                    snapshot_id,
+                    partition_number,
+                    lower_uuid,
+                    upper_uuid,
+                    extract_batch,
+                    load_batch,
+                    es_index,
+                )
+                for partition_number, (lower_uuid, upper_uuid) in enumerate(get_partitions(workers))
+            )
+            for future in as_completed(futures):
+                partition_number, docs_count, duration = future.result()
+                docs_total += docs_count
+                logger.info(
+                    f' - Диапазон {partition_number}: {docs_count} фильмов за {duration:.1f} сек, '
+                    f'{docs_count / duration if duration else 0:.1f} фильмов/сек'
+                )
+    finally:
+        snapshot_db.close()
+
+    duration = monotonic() - started
+    logger.info(
+        f' - Загружено {docs_total} фильмов за {duration:.1f} сек, '
+        f'{docs_total / duration if duration else 0:.1f} фильмов/сек'
+    )
+    if docs_total != snapshot_films:
+        raise ReindexError(f'Загружено {docs_total} фильмов из {snapshot_films} в снимке')
+
+    if blue_green:
+        # Инкрементальный ETL во время переиндексации писал в старую версию индекса
+        catch_up_started = get_database_now()
+        caught_up = catch_up(
+            since=(snapshot_started - CATCH_UP_MARGIN).isoformat(),
+            extract_batch=extract_batch,
+            load_batch=load_batch,
+            es_index=es_index,
+        )
+        logger.info(f' - Догружено изменений после снимка: {caught_up} фильмов')
+
+        finish_index_version(es_index, settings.ELASTIC_INDEX_FILE, settings.ELASTIC_INDEX_REPLICAS)
+        # Документы, не принятые Elasticsearch, уходят в dead letter, и в индексе их не будет
+        indexed_films = get_elastic_client().count(index=es_index)['count']
+        if indexed_films < snapshot_films:
+            raise ReindexError(f'В версии индекса {es_index} {indexed_films} фильмов из {snapshot_films} в снимке')
+        swap_index_alias(settings.ELASTIC_INDEX, es_index)
+
+        # Изменения, которые инкрементальный ETL до переключения записал в старую версию
+        caught_up = catch_up(
+            since=(catch_up_started - CATCH_UP_MARGIN).isoformat(),
+            extract_batch=extract_batch,
+            load_batch=load_batch,
+            es_index=settings.ELASTIC_INDEX,
+        )
+        logger.info(f' - Догружено изменений после переключения: {caught_up} фильмов')
+        delete_old_index_versions(settings.ELASTIC_INDEX, keep=settings.ELASTIC_INDEX_KEEP_VERSIONS)
+
+    logger.info(f' <- Полная переиндексация завершена за {monotonic() - started:.1f} сек')
+
+
+if __name__ == '__main__':
+    main(
+        workers=settings.ETL_REINDEX_WORKERS,
+        extract_batch=settings.ETL_REINDEX_BATCH,
+        load_batch=settings.ETL_LOAD_BATCH,
+        blue_green=settings.ETL_REINDEX_BLUE_GREEN,
+    )
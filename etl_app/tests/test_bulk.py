@@ -0,0 +1,93 @@
+"""Тесты разбора ошибок bulk запроса: деление пачки, повторы и недоставленные документы."""
+
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from elasticsearch import ApiError
+
+from etl_app.config import settings
+from etl_app.load import utils
+from etl_app.load.documents import encode_bulk_chunks
+from etl_app.transfrom.transform_dataclasses import MovieUpdate
+
+FILMS_COUNT = 4
+
+
+def get_api_error(status: int) -> ApiError:
+    return ApiError(f'status {status}', meta=SimpleNamespace(status=status), body={'status': status})
+
+
+def get_line_ids(chunk) -> list[str]:
+    return list(utils.get_line_id(bytes(line)) for line in chunk)
+
+
+class SendBulkChunkTest(unittest.TestCase):
+
+    def setUp(self):
+        films = list(MovieUpdate(id=f'film-{number}', fields={'title': str(number)}) for number in range(FILMS_COUNT))
+        self.lines = next(encode_bulk_chunks(films, 'movies', 500, 10 * 1024 * 1024)).lines()
+
+        dead_letter_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(dead_letter_dir.cleanup)
+        self.dead_letter_file = os.path.join(dead_letter_dir.name, 'dead_letter.ndjson')
+        patches = [
+            mock.patch.object(settings, 'ELASTIC_DEAD_LETTER_FILENAME', self.dead_letter_file),
+            mock.patch.object(settings, 'ELASTIC_BULK_RETRY_MAX', 2),
+            mock.patch('etl_app.load.utils.sleep'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def get_dead_letter_ids(self) -> list[str]:
+        if not os.path.exists(self.dead_letter_file):
+            return list()
+        with open(self.dead_letter_file, encoding='utf-8') as file:
+            return list(utils.get_line_id(json.loads(line)['line'].encode('utf-8')) for line in file)
+
+    def test_request_error_not_split_is_raised(self):
+        for status in (401, 403, 404):
+            with mock.patch('etl_app.load.utils.send_bulk_request', side_effect=get_api_error(status)) as request:
+                with self.assertRaises(ApiError):
+                    utils.send_bulk_chunk(self.lines)
+            self.assertEqual(request.call_count, 1)
+        self.assertEqual(self.get_dead_letter_ids(), [])
+
+    def test_too_large_request_split_to_bad_document(self):
+        def send_bulk_request(chunk, require_alias=False):
+            if 'film-2' in get_line_ids(chunk):
+                raise get_api_error(413 if len(chunk) > 1 else 400)
+            return {'errors': False, 'items': list()}
+
+        with mock.patch('etl_app.load.utils.send_bulk_request', side_effect=send_bulk_request):
+            docs_count, latency, failed_id = utils.send_bulk_chunk(self.lines)
+
+        self.assertEqual(docs_count, FILMS_COUNT)
+        self.assertEqual(failed_id, {'film-2'})
+        self.assertEqual(self.get_dead_letter_ids(), ['film-2'])
+
+    def test_retryable_items_dead_lettered_after_retry_max(self):
+        def send_bulk_request(chunk, require_alias=False):
+            items = list()
+            for document_id in get_line_ids(chunk):
+                status = 429 if document_id == 'film-1' else 200
+                result = {'_index': 'movies', '_id': document_id, 'status': status}
+                if status == 429:
+                    result['error'] = {'type': 'es_rejected_execution_exception'}
+                items.append({'update': result})
+            return {'errors': any('error' in item['update'] for item in items), 'items': items}
+
+        with mock.patch('etl_app.load.utils.send_bulk_request', side_effect=send_bulk_request) as request:
+            docs_count, latency, failed_id = utils.send_bulk_chunk(self.lines)
+
+        self.assertEqual(request.call_count, settings.ELASTIC_BULK_RETRY_MAX + 1)
+        self.assertEqual(failed_id, {'film-1'})
+        self.assertEqual(self.get_dead_letter_ids(), ['film-1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,250 @@
+"""Тесты продолжения ETL после падения посреди загрузки батча.
+
+PostgreSQL и Elasticsearch заменены фейками в памяти процесса: PostgresDB.execute_prepared
+отдает фильмы из списка, send_bulk_request запоминает загруженные фильмы и имитирует
+падение процесса перед заданным bulk запросом.
+"""
+
+import json
+import os
+import tempfile
+import unittest
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+from uuid import UUID, uuid4
+
+from etl_app import app
+from etl_app.config import settings
+from etl_app.coordination import SHARD_STATE_KEYS
+from etl_app.utils import JsonFileStorage, PostgresStorage, State
+
+FilmworkRow = namedtuple('FilmworkRow', 'id modified')
+FilmworkData = namedtuple(
+    'FilmworkData',
+    'fw_id title description rating genres directors actors_names writers_names actors writers',
+)
+
+FILMS_COUNT = 10
+LOAD_BATCH = 3
+
+
+class ProcessKilled(BaseException):
+    """Имитация падения процесса ETL, не перехватывается обработчиками Exception."""
+
+
+class FakePostgresDB:
+    """Таблица film_work в памяти, отвечает на подготовленные запросы ETL по их именам."""
+
+    def __init__(self, films: list[FilmworkRow]) -> None:
+        self.films = films
+
+    def execute_prepared(self, name, sql, params, param_types):
+        if name == 'get_filmworks':
+            modified, filmwork_id, batch = params
+            after = (
+                datetime.min.replace(tzinfo=timezone.utc) if modified == '-infinity' else datetime.fromisoformat(modified),
+                UUID(filmwork_id),
+            )
+            return list(film for film in self.films if (film.modified, UUID(film.id)) > after)[:batch]
+        if name == 'get_filmworks_additional':
+            filmworks_uuid = set(params[0])
+            return list(
+                FilmworkData(film.id, f'Film {film.id}', '', 7.0, ['Drama'], [], [], [], [], [])
+                for film in self.films if film.id in filmworks_uuid
+            )
+        # Персоны и жанры не менялись
+        return list()
+
+    def log_stats(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class FakeElastic:
+    """Bulk API в памяти, падение процесса перед bulk запросом с номером kill_before и всеми следующими."""
+
+    def __init__(self, kill_before: int = 0) -> None:
+        self.kill_before = kill_before
+        self.requests = 0
+        self.loaded = list()
+
+    def send_bulk_request(self, chunk, require_alias=False):
+        self.requests += 1
+        # Пачки, уже отданные в пул потоков, после падения процесса тоже не доходят
+        if self.kill_before and self.requests >= self.kill_before:
+            raise ProcessKilled
+        items = list()
+        for line in chunk:
+            action = json.loads(bytes(line).split(b'\n', 1)[0])
+            filmwork_id = action['index']['_id']
+            self.loaded.append(filmwork_id)
+            items.append({'index': {'_id': filmwork_id, 'status': 201}})
+        return {'errors': False, 'items': items}
+
+
+class StopEtl(Exception):
+    """Все изменения обработаны, ETL ушел в ожидание."""
+
+
+def stop_etl(*args, **kwargs):
+    raise StopEtl
+
+
+class CheckpointResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        started = datetime(2023, 1, 1, tzinfo=timezone.utc)
+        self.films = list(
+            FilmworkRow(str(uuid4()), started + timedelta(minutes=number))
+            for number in range(FILMS_COUNT)
+        )
+        self.movies_db = FakePostgresDB(self.films)
+
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+        self.state_file = os.path.join(state_dir.name, 'state_storage.json')
+
+        patches = [
+            mock.patch.object(settings, 'ETL_STATE_FILENAME', self.state_file),
+            mock.patch.object(settings, 'ETL_STATE_CHECKPOINT_LOG', ''),
+            mock.patch.object(settings, 'ETL_STATE_SAVE_INTERVAL_SEC', 0),
+            mock.patch.object(settings, 'ETL_CONTENT_HASH_ENABLED', False),
+            mock.patch.object(settings, 'ETL_PARTIAL_UPDATES_ENABLED', False),
+            mock.patch.object(settings, 'ETL_LISTEN_ENABLED', False),
+            mock.patch.object(settings, 'ETL_PIPELINE_ENABLED', False),
+            mock.patch.object(settings, 'ETL_SHARDING_ENABLED', False),
+            mock.patch.object(settings, 'ELASTIC_BULK_THREADS', 1),
+            mock.patch('etl_app.app.get_movies_database', return_value=self.movies_db),
+            mock.patch('etl_app.app.log_elastic_stats'),
+            mock.patch('etl_app.app.wait_for_changes', stop_etl),
+            mock.patch('etl_app.load.utils.ready_indexes', {settings.ELASTIC_INDEX}),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def run_etl(self, elastic: FakeElastic) -> None:
+        with mock.patch('etl_app.load.utils.send_bulk_request', elastic.send_bulk_request):
+            app.main(extract_batch=FILMS_COUNT * 2, load_batch=LOAD_BATCH)
+
+    def read_state(self) -> dict:
+        with open(self.state_file) as file:
+            return json.load(file)
+
+    def test_resumes_after_last_acknowledged_chunk(self):
+        films_id = list(film.id for film in self.films)
+        for kill_before in range(2, -(-FILMS_COUNT // LOAD_BATCH) + 1):
+            with self.subTest(kill_before=kill_before):
+                if os.path.exists(self.state_file):
+                    os.remove(self.state_file)
+                acknowledged = (kill_before - 1) * LOAD_BATCH
+
+                killed_elastic = FakeElastic(kill_before=kill_before)
+                with self.assertRaises(ProcessKilled):
+                    self.run_etl(killed_elastic)
+                self.assertEqual(killed_elastic.loaded, films_id[:acknowledged])
+
+                last_film = self.films[acknowledged - 1]
+                state = self.read_state()
+                self.assertEqual(state['state_filmwork_id'], last_film.id)
+                self.assertEqual(state['state_filmwork_modified'], last_film.modified.isoformat())
+
+                resumed_elastic = FakeElastic()
+                with self.assertRaises(StopEtl):
+                    self.run_etl(resumed_elastic)
+                self.assertEqual(resumed_elastic.loaded, films_id[acknowledged:])
+                self.assertEqual(self.read_state()['state_filmwork_id'], films_id[-1])
+
+    def test_kill_before_first_chunk_keeps_initial_state(self):
+        with self.assertRaises(ProcessKilled):
+            self.run_etl(FakeElastic(kill_before=1))
+        if os.path.exists(self.state_file):
+            self.assertFalse(self.read_state().get('state_filmwork_id'))
+
+        resumed_elastic = FakeElastic()
+        with self.assertRaises(StopEtl):
+            self.run_etl(resumed_elastic)
+        self.assertEqual(resumed_elastic.loaded, list(film.id for film in self.films))
+
+
+class JsonFileStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+        self.storage = JsonFileStorage(
+            os.path.join(state_dir.name, 'state_storage.json'),
+            checkpoint_log_path=os.path.join(state_dir.name, 'state_checkpoints.log'),
+        )
+
+    def test_checkpoint_log_appended_on_every_write(self):
+        for number in range(3):
+            self.storage.save_state({'state_filmwork_id': str(number)})
+        with open(self.storage.checkpoint_log_path) as file:
+            self.assertEqual(len(file.readlines()), 3)
+        self.assertEqual(self.storage.retrieve_state(), {'state_filmwork_id': '2'})
+
+    def test_state_restored_from_log_when_crashed_before_replace(self):
+        self.storage.save_state({'state_filmwork_id': '1'})
+        with mock.patch('etl_app.utils.os.replace', side_effect=ProcessKilled):
+            with self.assertRaises(ProcessKilled):
+                self.storage.save_state({'state_filmwork_id': '2'})
+        # Основной файл цел, но старше журнала
+        with open(self.storage.file_path) as file:
+            self.assertEqual(json.load(file), {'state_filmwork_id': '1'})
+        self.assertEqual(self.storage.retrieve_state(), {'state_filmwork_id': '2'})
+
+    def test_incomplete_log_line_ignored(self):
+        self.storage.save_state({'state_filmwork_id': '1'})
+        with open(self.storage.checkpoint_log_path, 'a') as file:
+            file.write('{"state_filmwork')
+        self.assertEqual(self.storage.retrieve_state(), {'state_filmwork_id': '1'})
+
+        self.storage.save_state({'state_filmwork_id': '2'})
+        self.assertEqual(self.storage.retrieve_state(), {'state_filmwork_id': '2'})
+
+    def test_state_read_from_file_without_log(self):
+        self.storage.save_state({'state_filmwork_id': '1'})
+        os.remove(self.storage.checkpoint_log_path)
+        self.assertEqual(self.storage.retrieve_state(), {'state_filmwork_id': '1'})
+
+
+class FakeStateDB:
+    """Таблица content.etl_state в памяти."""
+
+    def __init__(self) -> None:
+        self.rows = dict()
+
+    def execute(self, sql, params=None):
+        if sql.startswith('insert'):
+            shard, state = params
+            self.rows[shard] = json.loads(state)
+            return list()
+        return list(namedtuple('Row', 'shard state')(shard, state) for shard, state in self.rows.items())
+
+
+class PostgresStorageTest(unittest.TestCase):
+
+    def test_shard_acquired_after_extract_keeps_stored_state(self):
+        movies_db = FakeStateDB()
+        movies_db.rows['person'] = {'state_person_modified': '2023-01-02T00:00:00+00:00', 'state_person_id': 'p'}
+        owned_shards = {'filmwork'}
+        etl_state = State(PostgresStorage(movies_db, shard_keys=SHARD_STATE_KEYS, owned_shards=owned_shards))
+
+        # Батч извлечен до захвата шарда person, а загружен после
+        batch_shards = set(owned_shards)
+        owned_shards.add('person')
+        etl_state.set_state({'state_filmwork_id': 'f', 'state_person_modified': ''}, batch_shards)
+
+        self.assertEqual(movies_db.rows['filmwork']['state_filmwork_id'], 'f')
+        self.assertEqual(movies_db.rows['person']['state_person_id'], 'p')
+
+        etl_state.set_state({'state_filmwork_id': 'f', 'state_person_id': 'q'}, set(owned_shards))
+        self.assertEqual(movies_db.rows['person']['state_person_id'], 'q')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""Тесты кодирования фильмов в пачки bulk запроса."""
+
+import json
+import unittest
+
+from etl_app.load.documents import encode_bulk_chunks
+from etl_app.transfrom.transform_dataclasses import Movie, MovieUpdate
+
+ES_INDEX = 'movies'
+
+
+def get_movie(number: int, title: str = 'Фильм') -> Movie:
+    return Movie(
+        id=f'00000000-0000-0000-0000-{number:012d}', imdb_rating=7.5, title=f'{title} {number}', description='',
+        genre=['Drama'], director=list(), actors_names=list(), writers_names=list(), actors=list(), writers=list(),
+    )
+
+
+def parse_chunk(chunk) -> list[tuple[dict, dict]]:
+    lines = bytes(chunk.body).splitlines()
+    return list(zip(map(json.loads, lines[::2]), map(json.loads, lines[1::2])))
+
+
+class EncodeBulkChunksTest(unittest.TestCase):
+
+    def test_chunks_split_by_count_and_bytes(self):
+        movies = list(get_movie(number) for number in range(7))
+        chunks = list(encode_bulk_chunks(movies, ES_INDEX, chunk_size=3, max_chunk_bytes=10 * 1024 * 1024))
+        self.assertEqual(list(len(chunk.ids) for chunk in chunks), [3, 3, 1])
+
+        document_size = len(chunks[0].lines()[0])
+        chunks = list(encode_bulk_chunks(movies, ES_INDEX, chunk_size=500, max_chunk_bytes=document_size * 2))
+        self.assertEqual(list(len(chunk.ids) for chunk in chunks), [2, 2, 2, 1])
+
+        documents = list(document for chunk in chunks for document in parse_chunk(chunk))
+        self.assertEqual(list(source['id'] for action, source in documents), list(movie.id for movie in movies))
+        self.assertEqual(documents[0][0], {'index': {'_index': ES_INDEX, '_id': movies[0].id}})
+        for chunk in chunks:
+            self.assertEqual(b''.join(chunk.lines()), bytes(chunk.body))
+
+    def test_unchanged_documents_skipped(self):
+        movies = list(get_movie(number) for number in range(4))
+        stored_hashes = dict()
+        for chunk in encode_bulk_chunks(movies, ES_INDEX, 500, 10 * 1024 * 1024, hash_documents=True):
+            stored_hashes.update(chunk.hashes)
+        self.assertEqual(set(stored_hashes), set(movie.id for movie in movies))
+
+        movies[1] = get_movie(1, title='Другой фильм')
+        movies.append(MovieUpdate(id=movies[2].id, fields={'title': 'Новое название'}))
+        chunks = list(encode_bulk_chunks(
+            movies, ES_INDEX, 500, 10 * 1024 * 1024, hash_documents=True, stored_hashes=stored_hashes,
+        ))
+
+        self.assertEqual(len(chunks), 1)
+        chunk = chunks[0]
+        self.assertEqual(chunk.ids, [movies[1].id, movies[2].id])
+        self.assertEqual(chunk.skipped, [movies[0].id, movies[2].id, movies[3].id])
+        self.assertEqual(list(chunk.hashes), [movies[1].id])
+        self.assertEqual(
+            list(action for action, source in parse_chunk(chunk)),
+            [{'index': {'_index': ES_INDEX, '_id': movies[1].id}}, {'update': {'_index': ES_INDEX, '_id': movies[2].id}}],
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
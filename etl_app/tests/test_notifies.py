@@ -0,0 +1,185 @@
+"""Тесты уведомлений LISTEN/NOTIFY: триггеры таблиц content и ограничение количества фильмов за итерацию.
+
+Тесты с БД выполняются на локальном PostgreSQL с заполненной схемой content
+и пропускаются, если параметры подключения не заданы или БД недоступна:
+
+    POSTGRES_DB_HOST=localhost python3 -m unittest discover -s etl_app/tests -t .
+"""
+
+import json
+import os
+import unittest
+from uuid import uuid4
+
+from etl_app.utils import NotifiedFilmworks
+
+NOTIFY_CHANNEL = 'etl_test_notifies'
+NOTIFY_BATCH = 1000
+
+
+class NotifiedFilmworksTest(unittest.TestCase):
+
+    def test_take_caps_batch_and_carries_rest_over(self):
+        filmworks_uuid = list(str(uuid4()) for _ in range(2500))
+        notified_filmworks = NotifiedFilmworks(NOTIFY_BATCH)
+        notified_filmworks.add(filmworks_uuid)
+
+        batches = list()
+        while notified_filmworks:
+            batches.append(notified_filmworks.take())
+
+        self.assertEqual(list(len(batch) for batch in batches), [1000, 1000, 500])
+        self.assertEqual(sum(batches, []), filmworks_uuid)
+
+    def test_add_skips_queued_duplicates(self):
+        notified_filmworks = NotifiedFilmworks(NOTIFY_BATCH)
+        notified_filmworks.add(['a', 'b'])
+        notified_filmworks.add(['b', 'c'])
+
+        self.assertEqual(notified_filmworks.take(), ['a', 'b', 'c'])
+        self.assertEqual(len(notified_filmworks), 0)
+
+
+@unittest.skipUnless(os.environ.get('POSTGRES_DB_HOST'), 'POSTGRES_DB_HOST не задан')
+class NotifiedFilmworksPostgresTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        import psycopg2
+        from etl_app.extract.utils import get_movies_database
+
+        try:
+            cls.movies_db = get_movies_database()
+            cls.movies_db.listen(NOTIFY_CHANNEL)
+        except psycopg2.OperationalError as err:
+            raise unittest.SkipTest(f'PostgreSQL недоступен: {err}')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.movies_db.close()
+
+    def notify_filmworks(self, filmworks_uuid):
+        self.movies_db.execute(
+            "select pg_notify(%s, json_build_object('table', 'film_work', 'id', id)::text) "
+            "from unnest(%s::uuid[]) as id",
+            (NOTIFY_CHANNEL, list(filmworks_uuid)),
+        )
+
+    def wait_notified_filmworks(self, count):
+        from etl_app.extract.utils import get_filmworks_uuid_from_notifies
+
+        filmworks_uuid = set()
+        while len(filmworks_uuid) < count:
+            payloads = self.movies_db.wait_notifies(5)
+            self.assertTrue(payloads, 'Уведомления не получены')
+            filmworks_uuid.update(get_filmworks_uuid_from_notifies(payloads))
+        return filmworks_uuid
+
+    def test_notify_storm_is_extracted_in_capped_batches(self):
+        from etl_app.extract.utils import get_filmworks_additional_data
+
+        rows = self.movies_db.execute('select id from content.film_work order by id limit 2500')
+        filmworks_uuid = set(str(row.id) for row in rows)
+        if len(filmworks_uuid) <= NOTIFY_BATCH:
+            self.skipTest('Для проверки нужно больше ETL_NOTIFY_BATCH фильмов в content.film_work')
+
+        self.notify_filmworks(filmworks_uuid)
+        notified_filmworks = NotifiedFilmworks(NOTIFY_BATCH)
+        notified_filmworks.add(self.wait_notified_filmworks(len(filmworks_uuid)))
+
+        extracted_uuid = set()
+        iterations = 0
+        while notified_filmworks:
+            batch = notified_filmworks.take()
+            self.assertLessEqual(len(batch), NOTIFY_BATCH)
+            extracted_data = get_filmworks_additional_data(self.movies_db, batch)
+            self.assertEqual(len(extracted_data), len(batch))
+            extracted_uuid.update(str(filmwork.fw_id) for filmwork in extracted_data)
+            iterations += 1
+
+        self.assertEqual(extracted_uuid, filmworks_uuid)
+        self.assertEqual(iterations, -(-len(filmworks_uuid) // NOTIFY_BATCH))
+
+
+
+@unittest.skipUnless(os.environ.get('POSTGRES_DB_HOST'), 'POSTGRES_DB_HOST не задан')
+class NotifyTriggersPostgresTest(unittest.TestCase):
+    """Триггеры миграции 0004 отправляют UUID фильмов в канал, который слушает ETL."""
+
+    def setUp(self):
+        import psycopg2
+        from etl_app.extract.utils import ETL_NOTIFY_CHANNEL, get_movies_database
+
+        try:
+            self.movies_db = get_movies_database()
+            self.movies_db.listen(ETL_NOTIFY_CHANNEL)
+        except psycopg2.OperationalError as err:
+            raise unittest.SkipTest(f'PostgreSQL недоступен: {err}')
+        self.addCleanup(self.movies_db.close)
+
+        genre = self.movies_db.execute('select id from content.genre limit 1')
+        person = self.movies_db.execute('select id from content.person limit 1')
+        if not genre or not person:
+            self.skipTest('Для проверки нужны жанр и персона в content.genre и content.person')
+        self.genre_id = str(genre[0].id)
+        self.person_id = str(person[0].id)
+        self.filmworks_uuid = list(str(uuid4()) for _ in range(3))
+        self.addCleanup(self.delete_filmworks)
+
+    def delete_filmworks(self):
+        for table in ('genre_film_work', 'person_film_work'):
+            self.movies_db.execute(
+                f'delete from content.{table} where film_work_id = any(%s::uuid[]) returning id', (self.filmworks_uuid,)
+            )
+        self.movies_db.execute(
+            'delete from content.film_work where id = any(%s::uuid[]) returning id', (self.filmworks_uuid,)
+        )
+
+    def wait_notifies(self, expected):
+        """Уведомления о фильмах теста, пока не придут все ожидаемые пары таблица - UUID."""
+        notifies = set()
+        payloads = list()
+        while not expected <= notifies:
+            received = self.movies_db.wait_notifies(5)
+            self.assertTrue(received, f'Уведомления не получены, ожидались {expected - notifies}')
+            for payload in received:
+                notify = json.loads(payload)
+                if notify['id'] in self.filmworks_uuid:
+                    notifies.add((notify['table'], notify['id']))
+                    payloads.append(payload)
+        return notifies, payloads
+
+    def test_triggers_notify_changed_filmworks(self):
+        from etl_app.extract.utils import get_filmworks_uuid_from_notifies
+
+        film, genre_film, person_film = self.filmworks_uuid
+        self.movies_db.execute(
+            "insert into content.film_work (id, title, description, rating, type, created, modified) "
+            "select id, 'Notify test ' || id, '', 0, 'movie', now(), now() from unnest(%s::uuid[]) as id returning id",
+            (self.filmworks_uuid,),
+        )
+        self.wait_notifies(set(('film_work', filmwork_uuid) for filmwork_uuid in self.filmworks_uuid))
+
+        self.movies_db.execute(
+            "update content.film_work set rating = 1, modified = now() where id = %s returning id",
+            (film,),
+        )
+        self.movies_db.execute(
+            'insert into content.genre_film_work (id, film_work_id, genre_id, created) '
+            'values (%s, %s, %s, now()) returning id',
+            (str(uuid4()), genre_film, self.genre_id),
+        )
+        self.movies_db.execute(
+            'insert into content.person_film_work (id, film_work_id, person_id, role, created) '
+            "values (%s, %s, %s, 'actor', now()) returning id",
+            (str(uuid4()), person_film, self.person_id),
+        )
+        expected = {('film_work', film), ('genre_film_work', genre_film), ('person_film_work', person_film)}
+        notifies, payloads = self.wait_notifies(expected)
+
+        self.assertEqual(notifies, expected)
+        self.assertEqual(get_filmworks_uuid_from_notifies(payloads), set(self.filmworks_uuid))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""Тесты пула соединений PostgresDB и подготовленных запросов.
+
+Выполняются на локальном PostgreSQL и пропускаются, если параметры подключения
+не заданы или БД недоступна:
+
+    POSTGRES_DB_HOST=localhost python3 -m unittest discover -s etl_app/tests -t .
+"""
+
+import os
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+PREPARED_NAME = 'etl_test_prepared'
+PREPARED_SQL = 'select $1::int + 1 as value'
+
+
+@unittest.skipUnless(os.environ.get('POSTGRES_DB_HOST'), 'POSTGRES_DB_HOST не задан')
+class PostgresDBTest(unittest.TestCase):
+
+    def setUp(self):
+        import psycopg2
+        from etl_app.config import settings
+        from etl_app.extract.postgres import PostgresDB
+
+        try:
+            self.movies_db = PostgresDB(
+                user=settings.POSTGRES_DB_USER,
+                password=settings.POSTGRES_DB_PASS,
+                host=settings.POSTGRES_DB_HOST,
+                port=settings.POSTGRES_DB_PORT,
+                database=settings.POSTGRES_DB_NAME,
+                max_connections=3,
+            )
+        except psycopg2.OperationalError as err:
+            raise unittest.SkipTest(f'PostgreSQL недоступен: {err}')
+        self.addCleanup(self.movies_db.close)
+
+    def execute_prepared(self, value):
+        rows = self.movies_db.execute_prepared(PREPARED_NAME, PREPARED_SQL, (value,), ('int',))
+        return rows[0].value
+
+    def test_concurrent_checkouts_reuse_connections(self):
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            for _ in range(10):
+                self.assertEqual(list(executor.map(self.execute_prepared, range(3))), [1, 2, 3])
+
+        backends = set()
+        for _ in range(10):
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                backends.update(executor.map(lambda _: self.movies_db.execute('select pg_backend_pid() as pid')[0].pid,
+                                             range(3)))
+        self.assertLessEqual(len(backends), 3)
+        self.assertEqual(self.movies_db._stats['opened'], 3)
+
+    def test_statement_prepared_again_after_server_forgets_it(self):
+        self.assertEqual(self.execute_prepared(1), 2)
+        for _ in range(self.movies_db.max_connections):
+            with self.movies_db.connection() as connection, connection.cursor() as cursor:
+                cursor.execute('deallocate all')
+
+        self.assertEqual(self.execute_prepared(2), 3)
+
+    def test_query_errors_are_raised(self):
+        import psycopg2
+
+        with self.assertRaises(psycopg2.errors.UndefinedTable):
+            self.movies_db.execute('select * from content.etl_test_missing_table')
+        with self.assertRaises(psycopg2.errors.UndefinedTable):
+            self.movies_db.execute_prepared(
+                'etl_test_missing_table', 'select * from content.etl_test_missing_table where id = $1', (1,), ('int',)
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
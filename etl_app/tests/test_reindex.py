@@ -0,0 +1,110 @@
+"""Тесты полной переиндексации в новую версию индекса с переключением псевдонима.
+
+Выполняются на локальных PostgreSQL с заполненной схемой content и Elasticsearch
+и пропускаются, если параметры подключения не заданы или сервисы недоступны:
+
+    POSTGRES_DB_HOST=localhost ELASTIC_HOST=localhost python3 -m unittest discover -s etl_app/tests -t .
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+TEST_ALIAS = 'etl_test_movies'
+INDEX_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'load', 'movie_index.json')
+
+
+def load_without_first_film(transformed_data, *args, **kwargs):
+    """Загрузка, которая теряет первый фильм каждого батча."""
+    from etl_app.app import load
+
+    return load(transformed_data[1:], *args, **kwargs)
+
+
+@unittest.skipUnless(
+    os.environ.get('POSTGRES_DB_HOST') and os.environ.get('ELASTIC_HOST'),
+    'POSTGRES_DB_HOST или ELASTIC_HOST не заданы',
+)
+class BlueGreenReindexTest(unittest.TestCase):
+
+    def setUp(self):
+        from elastic_transport import ConnectionError as ElasticConnectionError
+
+        from etl_app.config import settings
+        from etl_app.extract.utils import get_movies_database
+        from etl_app.load.elastic import get_elastic_client
+
+        dead_letter_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(dead_letter_dir.cleanup)
+        patches = [
+            mock.patch.object(settings, 'ELASTIC_INDEX', TEST_ALIAS),
+            mock.patch.object(settings, 'ELASTIC_INDEX_FILE', INDEX_FILE),
+            mock.patch.object(settings, 'ELASTIC_INDEX_REPLICAS', 0),
+            mock.patch.object(settings, 'ELASTIC_INDEX_KEEP_VERSIONS', 1),
+            mock.patch.object(settings, 'ETL_CONTENT_HASH_ENABLED', False),
+            mock.patch.object(
+                settings, 'ELASTIC_DEAD_LETTER_FILENAME', os.path.join(dead_letter_dir.name, 'dead_letter.ndjson')
+            ),
+            mock.patch('etl_app.load.utils.ready_indexes', set()),
+            mock.patch('etl_app.load.utils.alias_indexes', set()),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        get_elastic_client.cache_clear()
+        self.client = get_elastic_client()
+        try:
+            self.client.info()
+        except ElasticConnectionError as err:
+            raise unittest.SkipTest(f'Elasticsearch недоступен: {err}')
+        self.addCleanup(self.delete_test_indexes)
+
+        movies_db = get_movies_database()
+        try:
+            self.films_count = movies_db.execute('select count(*) as films from content.film_work')[0].films
+        finally:
+            movies_db.close()
+
+    def delete_test_indexes(self):
+        from etl_app.load.utils import get_index_versions
+
+        for index in get_index_versions(TEST_ALIAS):
+            self.client.indices.delete(index=index)
+
+    def get_alias_indexes(self):
+        return list(self.client.indices.get_alias(name=TEST_ALIAS))
+
+    def reindex(self):
+        from etl_app import reindex
+
+        reindex.main(workers=2, extract_batch=5000, load_batch=500, blue_green=True)
+
+    def test_alias_swapped_to_complete_index(self):
+        self.reindex()
+
+        indexes = self.get_alias_indexes()
+        self.assertEqual(indexes, [f'{TEST_ALIAS}_v1'])
+        self.assertEqual(self.client.count(index=TEST_ALIAS)['count'], self.films_count)
+
+        self.reindex()
+        self.assertEqual(self.get_alias_indexes(), [f'{TEST_ALIAS}_v2'])
+        self.assertEqual(self.client.count(index=TEST_ALIAS)['count'], self.films_count)
+
+    def test_incomplete_reindex_keeps_alias(self):
+        from etl_app.reindex import ReindexError
+
+        self.reindex()
+
+        # Процессы переиндексации создаются через fork и наследуют подмену
+        with mock.patch('etl_app.reindex.load', load_without_first_film):
+            with self.assertRaises(ReindexError):
+                self.reindex()
+
+        self.assertEqual(self.get_alias_indexes(), [f'{TEST_ALIAS}_v1'])
+        self.assertEqual(self.client.count(index=TEST_ALIAS)['count'], self.films_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
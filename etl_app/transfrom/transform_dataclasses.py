@@ -1,7 +1,7 @@
 from dataclasses import dataclass
 
 
-@dataclass
+@dataclass(slots=True)
 class Movie:
     """Класс для группировки данных об измененных фильмах."""
     id: str
@@ -14,3 +14,10 @@ class Movie:
     writers_names: list
     actors: list
     writers: list
+
+
+@dataclass(slots=True)
+class MovieUpdate:
+    """Класс для частичного обновления документа фильма, только перечисленные поля."""
+    id: str
+    fields: dict
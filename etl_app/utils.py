@@ -1,7 +1,10 @@
 import abc
 import json
-from datetime import datetime
-from typing import Any, Dict
+import os
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from time import monotonic
+from typing import Any, Dict, Iterable, Optional
 
 
 class BaseStorage(abc.ABC):
@@ -14,54 +17,307 @@ class BaseStorage(abc.ABC):
     """
 
     @abc.abstractmethod
-    def save_state(self, state: Dict[str, Any]) -> None:
-        """Сохранить состояние в хранилище."""
+    def save_state(self, state: Dict[str, Any], shards: Optional[Iterable[str]] = None) -> None:
+        """Сохранить состояние в хранилище.
+
+        :param state: Состояние.
+        :param shards: Шарды, для которых состояние актуально, None - все.
+                       Хранилища без шардов параметр не учитывают.
+        """
 
     @abc.abstractmethod
     def retrieve_state(self) -> Dict[str, Any]:
         """Получить состояние из хранилища."""
 
 
+def fsync_directory(path: str) -> None:
+    """Сброс на диск записи каталога, например после переименования файла в нем."""
+    fd = os.open(path or os.curdir, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 class JsonFileStorage(BaseStorage):
     """Реализация хранилища, использующего локальный файл.
 
     Формат хранения: JSON
+
+    Состояние пишется во временный файл рядом с основным, который после fsync
+    атомарно заменяет основной, поэтому падение во время записи не портит состояние.
+    После замены fsync каталога фиксирует на диске саму замену файла.
+    Если задан checkpoint_log_path, каждое состояние перед записью основного файла
+    дописывается строкой в журнал, журнал только дописывается. Последняя целиком записанная
+    строка журнала не старше основного файла: при падении после записи в журнал, но до замены
+    основного файла, новое состояние есть только в журнале. Поэтому при непустом журнале
+    состояние читается из него, а основной файл - только когда журнала нет.
     """
 
-    def __init__(self, file_path: str) -> None:
+    def __init__(self, file_path: str, checkpoint_log_path: Optional[str] = None) -> None:
         self.file_path = file_path
+        self.checkpoint_log_path = checkpoint_log_path
 
-    def save_state(self, state: Dict[str, Any]) -> None:
+    def save_state(self, state: Dict[str, Any], shards: Optional[Iterable[str]] = None) -> None:
         """Сохранить состояние в хранилище."""
+        state = dict(state)
         for key_state, value_state in state.items():
             if type(value_state) is datetime:
                 state[key_state] = value_state.isoformat()
+        data = json.dumps(state)
+
+        if self.checkpoint_log_path:
+            with open(self.checkpoint_log_path, 'ab+') as file:
+                # Недописанная при падении строка не должна склеиться с новой
+                if file.seek(0, os.SEEK_END):
+                    file.seek(-1, os.SEEK_END)
+                    if file.read(1) != b'\n':
+                        file.write(b'\n')
+                file.write(data.encode('utf-8') + b'\n')
+                file.flush()
+                os.fsync(file.fileno())
 
-        with open(self.file_path, 'w') as file:
-            json.dump(state, file)
+        tmp_file_path = f'{self.file_path}.tmp'
+        with open(tmp_file_path, 'w') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_file_path, self.file_path)
+        fsync_directory(os.path.dirname(self.file_path))
 
     def retrieve_state(self) -> Dict[str, Any]:
         """Получить состояние из хранилища."""
-        state = dict()
+        state = self.retrieve_checkpoint()
+        if state:
+            return state
         try:
             with open(self.file_path) as file:
                 state = json.load(file)
-        except Exception as err:
-            pass
+        except Exception:
+            state = dict()
         return state if state else dict()
 
+    def retrieve_checkpoint(self) -> Dict[str, Any]:
+        """Получить последнее целиком записанное состояние из журнала."""
+        state = dict()
+        if not self.checkpoint_log_path or not os.path.exists(self.checkpoint_log_path):
+            return state
+        with open(self.checkpoint_log_path) as file:
+            for line in file:
+                try:
+                    state = json.loads(line)
+                except ValueError:
+                    # Последняя строка могла не дописаться
+                    continue
+        return state
+
+
+class PostgresStorage(BaseStorage):
+    """Реализация хранилища, использующего таблицу content.etl_state в PostgreSQL.
+
+    Состояние делится на шарды, каждый шард хранится отдельной строкой только со своими ключами.
+    Записываются только шарды из owned_shards, поэтому несколько процессов ETL пишут
+    состояние своих шардов, не затирая чужие. Состояние, извлеченное до захвата шарда,
+    не содержит его отметок, поэтому из owned_shards записываются только переданные shards.
+    """
+
+    def __init__(self, movies_db: Any, shard_keys: Dict[str, Iterable[str]], owned_shards: set[str]) -> None:
+        self.movies_db = movies_db
+        self.shard_keys = shard_keys
+        self.owned_shards = owned_shards
+
+    def save_state(self, state: Dict[str, Any], shards: Optional[Iterable[str]] = None) -> None:
+        """Сохранить состояние в хранилище."""
+        owned_shards = set(self.owned_shards)
+        if shards is not None:
+            owned_shards.intersection_update(shards)
+        for shard in sorted(owned_shards):
+            shard_state = dict()
+            for key_state in self.shard_keys[shard]:
+                value_state = state.get(key_state, '')
+                if type(value_state) is datetime:
+                    value_state = value_state.isoformat()
+                shard_state[key_state] = value_state
+            self.movies_db.execute(
+                'insert into content.etl_state (shard, state, modified) values (%s, %s, now()) '
+                'on conflict (shard) do update set state = excluded.state, modified = excluded.modified '
+                'returning shard',
+                (shard, json.dumps(shard_state)),
+            )
+
+    def retrieve_state(self) -> Dict[str, Any]:
+        """Получить состояние из хранилища."""
+        state = dict()
+        for row in self.movies_db.execute('select shard, state from content.etl_state') or list():
+            state.update(row.state)
+        return state
+
 
 class State:
-    """Класс для работы с состояниями."""
+    """Класс для работы с состояниями.
+
+    Состояние читается из хранилища один раз и хранится в памяти. Запись в хранилище
+    выполняется не чаще раза в save_interval_sec секунд, при 0 - при каждом изменении.
+    Отложенное состояние записывается методом flush.
+    """
 
-    def __init__(self, storage: BaseStorage) -> None:
+    def __init__(self, storage: BaseStorage, save_interval_sec: float = 0) -> None:
         self.storage = storage
+        self.save_interval_sec = save_interval_sec
+        self._state = storage.retrieve_state()
+        self._shards = None
+        self._saved_at = monotonic()
+        self._dirty = False
+
+    def set_state(self, state_dict, shards: Optional[Iterable[str]] = None) -> None:
+        """Установить состояние для определённого ключа.
 
-    def set_state(self, state_dict) -> None:
-        """Установить состояние для определённого ключа."""
-        self.storage.save_state(state_dict)
+        :param state_dict: Состояние.
+        :param shards: Шарды, для которых состояние актуально, None - все.
+        """
+        self._state = dict(state_dict)
+        self._shards = None if shards is None else set(shards)
+        self._dirty = True
+        if monotonic() - self._saved_at >= self.save_interval_sec:
+            self.flush()
 
     def get_state(self, key: str) -> Any:
         """Получить состояние по определённому ключу."""
-        state = self.storage.retrieve_state()
-        return state.get(key, '')
+        return self._state.get(key, '')
+
+    def flush(self) -> None:
+        """Записать отложенное состояние в хранилище."""
+        if not self._dirty:
+            return
+        self.storage.save_state(self._state, self._shards)
+        self._saved_at = monotonic()
+        self._dirty = False
+
+
+class BatchCheckpoints:
+    """Контрольные точки состояния внутри батча ETL.
+
+    Источники изменений отдают UUID фильмов вместе с состоянием, которое можно сохранить
+    после загрузки фильма. Точки применяются строго по порядку: состояние сдвигается
+    до последней точки, все фильмы до которой подтверждены Elasticsearch,
+    поэтому после падения посреди загрузки батч продолжается с этого места.
+
+    :param state: Состояние до батча.
+    :param final_state: Состояние после загрузки всего батча.
+    :param checkpoints: Контрольные точки, пары из UUID фильма (None - без фильма) и изменения состояния.
+    :param shards: Шарды, которыми процесс владел при извлечении батча, None - все.
+    """
+
+    def __init__(
+            self,
+            state: dict,
+            final_state: dict,
+            checkpoints: list[tuple[Optional[str], dict]],
+            shards: Optional[Iterable[str]] = None,
+    ) -> None:
+        self.state = dict(state)
+        self.final_state = final_state
+        self.shards = None if shards is None else frozenset(shards)
+        self._checkpoints = checkpoints
+        self._positions = dict()
+        for position, (filmwork_uuid, state_update) in enumerate(checkpoints):
+            if filmwork_uuid is not None:
+                self._positions.setdefault(filmwork_uuid, position)
+        self._next = 0
+        self._acknowledged = set()
+
+    @property
+    def filmworks_uuid(self) -> set[str]:
+        """UUID фильмов, к которым привязаны контрольные точки."""
+        return set(self._positions)
+
+    def position(self, filmwork_uuid: str) -> int:
+        """Порядковый номер первой контрольной точки фильма, фильмы без точек идут в конце."""
+        return self._positions.get(filmwork_uuid, len(self._checkpoints))
+
+    def acknowledge(self, filmworks_uuid: Iterable[str]) -> bool:
+        """Отметить фильмы загруженными.
+
+        :param filmworks_uuid: UUID загруженных фильмов.
+        :return: Вернуть True, если состояние сдвинулось.
+        """
+        self._acknowledged.update(filmworks_uuid)
+        start = self._next
+        while self._next < len(self._checkpoints):
+            filmwork_uuid, state_update = self._checkpoints[self._next]
+            if filmwork_uuid is not None and filmwork_uuid not in self._acknowledged:
+                break
+            self.state.update(state_update)
+            self._next += 1
+        return self._next > start
+
+
+def get_state_lag(state_modified: Any) -> Optional[timedelta]:
+    """Получить отставание состояния от текущего времени.
+
+    :param state_modified: Время изменения последней обработанной записи (datetime или строка ISO).
+    :return: Отставание от текущего времени или None, если состояние еще не задано.
+    """
+    if not state_modified:
+        return None
+    if not isinstance(state_modified, datetime):
+        try:
+            state_modified = datetime.fromisoformat(str(state_modified))
+        except ValueError:
+            return None
+    if state_modified.tzinfo is None:
+        state_modified = state_modified.replace(tzinfo=timezone.utc)
+    return datetime.now(timezone.utc) - state_modified
+
+
+class IdleBackoff:
+    """Адаптивная пауза между итерациями ETL.
+
+    Пауза удваивается от timeout_sec до timeout_max_sec, пока изменений нет,
+    и сбрасывается до timeout_sec при появлении изменений.
+    """
+
+    def __init__(self, timeout_sec: float, timeout_max_sec: float) -> None:
+        self.timeout_sec = timeout_sec
+        self.timeout_max_sec = max(timeout_sec, timeout_max_sec)
+        self.current = timeout_sec
+
+    def reset(self) -> None:
+        """Сбросить паузу до минимальной."""
+        self.current = self.timeout_sec
+
+    def increase(self) -> None:
+        """Увеличить паузу вдвое, но не более максимальной."""
+        self.current = min(self.current * 2, self.timeout_max_sec)
+
+
+class NotifiedFilmworks:
+    """Очередь UUID фильмов из уведомлений LISTEN/NOTIFY.
+
+    Массовое изменение связей может прислать уведомления по десяткам тысяч фильмов
+    за одну паузу. За итерацию из очереди берется не больше batch фильмов
+    в порядке поступления, остальные переносятся на следующие итерации.
+    """
+
+    def __init__(self, batch: int) -> None:
+        self.batch = batch
+        # Словарь вместо множества сохраняет порядок поступления
+        self._filmworks_uuid = dict()
+
+    def __len__(self) -> int:
+        return len(self._filmworks_uuid)
+
+    def add(self, filmworks_uuid: Iterable[str]) -> None:
+        """Добавить UUID фильмов в конец очереди, повторы не добавляются."""
+        self._filmworks_uuid.update(dict.fromkeys(filmworks_uuid))
+
+    def take(self) -> list[str]:
+        """Забрать из начала очереди UUID фильмов для одной итерации."""
+        filmworks_uuid = list(islice(self._filmworks_uuid, self.batch))
+        for filmwork_uuid in filmworks_uuid:
+            del self._filmworks_uuid[filmwork_uuid]
+        return filmworks_uuid
+
+    def clear(self) -> None:
+        """Очистить очередь."""
+        self._filmworks_uuid.clear()